@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+#
+#    benchmark_denss.py
+#    Time denss reconstructions over a matrix of datasets, grid sizes,
+#    oversampling ratios and modes, and save the results as JSON.
+#
+#    Part of DENSS
+#    DENSS: DENsity from Solution Scattering
+#    A tool for calculating an electron density map from solution scattering data
+#
+#    Copyright 2018 The Research Foundation for SUNY
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+#    Each case runs in its own process, so that its peak memory is not
+#    hidden by the cases run before it. For example, a quick check of the
+#    FAST mode on the bundled data:
+#
+#        python benchmarks/benchmark_denss.py -n 32 64 -m F -s 500 -o new.json
+#
+#    and a comparison against the results of a previous release:
+#
+#        python benchmarks/benchmark_denss.py -n 32 64 -m F -s 500 -o new.json --compare old.json
+#
+#    The steps run and final chi2 of the convergence tests can be compared
+#    the same way, over several seeds of the full runs:
+#
+#        python benchmarks/benchmark_denss.py -d 6lyz.out lysozyme.out -n 32 -m F --seeds 1 2 3 4 -o chi.json
+#        python benchmarks/benchmark_denss.py -d 6lyz.out lysozyme.out -n 32 -m F --seeds 1 2 3 4 --convergence adaptive -o adaptive.json --compare chi.json
+#
+
+from __future__ import print_function
+import argparse
+import copy
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+#run against the source tree this script belongs to, rather than an installed copy
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+import saxstats.saxstats as saxs
+import saxstats.denssopts as dopts
+from saxstats._version import __version__
+
+try:
+    import resource
+except ImportError:
+    #not available on windows
+    resource = None
+
+_timer = getattr(time, "perf_counter", time.time)
+
+DATASETS = {
+    "6lyz.dat": os.path.join(REPO, "6lyz.dat"),
+    "6lyz.out": os.path.join(REPO, "6lyz.out"),
+    "lysozyme.out": os.path.join(REPO, "lysozyme.out"),
+    "sphere": None,
+    "ellipsoid": None,
+    }
+
+#synthetic particles, as (radius, axial ratio) in angstroms
+SYNTHETIC = {
+    "sphere": (25.0, 1.0),
+    "ellipsoid": (15.0, 2.5),
+    }
+
+MODES = {"F": "FAST", "S": "SLOW", "M": "MEMBRANE"}
+
+def ellipsoid(R, nu, q=np.linspace(0,0.5,501), I0=1., nx=200):
+    """Calculate the scattering of a uniform ellipsoid of revolution.
+
+    R - radius of the two equal semi-axes
+    nu - ratio of the third semi-axis to R
+    nx - number of orientations used for the average
+    """
+    #midpoints of the cosine of the angle to the symmetry axis
+    x = (np.arange(nx)+0.5)/nx
+    Rx = R*np.sqrt(1+x**2*(nu**2-1))
+    I = np.zeros(len(q))
+    for r in Rx:
+        I += saxs.sphere(r, q=q, amp=True)**2
+    return I0 * I/nx
+
+def write_synthetic_profile(name, filename):
+    """Write a synthetic profile with 1% errors to filename, and return its dmax."""
+    R, nu = SYNTHETIC[name]
+    q = np.linspace(0.001, 0.5, 500)
+    I = ellipsoid(R, nu, q=q, I0=1e4)
+    sigq = 0.01*I + 1e-6*I[0]
+    np.savetxt(filename, np.vstack((q, I, sigq)).T, delimiter=" ", fmt="%.8e")
+    return 2*R*max(1.0, nu)
+
+def peak_rss_mb():
+    """Peak resident memory of this process in MB, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #kilobytes on linux, bytes on macOS
+    if sys.platform == "darwin":
+        return rss / 1024.**2
+    return rss / 1024.
+
+def run_case(case, workdir):
+    """Run a single benchmark case in this process and return its results."""
+    os.chdir(workdir)
+    filename = DATASETS[case["dataset"]]
+    argv = ["denss.py", "-m", case["mode"], "-n", str(case["n"]),
+        "-os", str(case["oversampling"]), "--seed", str(case["seed"]),
+        "-o", "bench", "--plot_off", "-q", "--checkpoint_freq", "0"]
+    if filename is None:
+        filename = os.path.join(workdir, case["dataset"]+".dat")
+        dmax = write_synthetic_profile(case["dataset"], filename)
+        argv += ["-d", str(dmax)]
+    argv += ["-f", filename]
+    if case["steps"] is not None:
+        argv += ["-s", str(case["steps"])]
+    if case["profile"]:
+        argv += ["--profile"]
+    if case["precision"] is not None:
+        argv += ["--precision", case["precision"]]
+    if case.get("convergence") is not None:
+        argv += ["--convergence", case["convergence"]]
+
+    #parse the options exactly as denss.py does
+    sys.argv = argv
+    parser = argparse.ArgumentParser()
+    superargs = dopts.parse_arguments(parser)
+    args = copy.copy(superargs)
+    for arg in ["units", "file", "plot", "nsamples", "mode",
+            "shrinkwrap_sigma_start_in_A", "shrinkwrap_sigma_end_in_A",
+            "shrinkwrap_sigma_start_in_vox", "shrinkwrap_sigma_end_in_vox"]:
+        delattr(args, arg)
+
+    start = _timer()
+    results = saxs.denss(**vars(args))
+    elapsed = _timer() - start
+
+    chis, rg, supportV, rho = results[5], results[6], results[7], results[8]
+    steps_run = int(np.count_nonzero(chis > 0))
+    result = dict(case,
+        nsamples=int(rho.shape[0]),
+        voxel=float(superargs.voxel),
+        dmax=float(superargs.dmax),
+        max_steps=int(len(chis)),
+        steps_run=steps_run,
+        converged=steps_run < len(chis),
+        total_time=elapsed,
+        time_per_step=elapsed/max(steps_run, 1),
+        peak_rss_mb=peak_rss_mb(),
+        final_chi2=float(chis[chis>0][-1]),
+        final_rg=float(rg[rg>0][-1]),
+        final_supportV=float(supportV[supportV>0][-1]),
+        )
+    if case["profile"] and os.path.exists("bench_profile.json"):
+        with open("bench_profile.json") as f:
+            result["phases"] = json.load(f)["phases"]
+    return result
+
+def environment():
+    """Versions and hardware the benchmarks ran on."""
+    import scipy
+    return {
+        "denss_version": __version__,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "scipy": scipy.__version__,
+        "fft_backend": saxs.FFT_BACKEND,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "platform": platform.platform(),
+        "cpu_count": multiprocessing.cpu_count(),
+        "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+def case_key(case):
+    #the convergence test is left out, so that the tests can be compared with each other
+    return (case["dataset"], case["mode"], case["n"], case["oversampling"],
+        case["seed"], case["steps"], case.get("precision"))
+
+def compare(results, filename):
+    """Print the change in time per step, steps run and final chi2 from the results saved in filename."""
+    with open(filename) as f:
+        old = dict((case_key(case), case) for case in json.load(f)["cases"])
+    print()
+    print("%-14s %-9s %4s %5s %12s %12s %8s %11s %21s" % ("dataset", "mode", "n", "os",
+        "old s/step", "new s/step", "ratio", "steps", "chi2"))
+    for case in results:
+        other = old.get(case_key(case))
+        if other is None:
+            continue
+        print("%-14s %-9s %4i %5.1f %12.5f %12.5f %8.3f %5i/%-5i %10.3e/%-10.3e" % (case["dataset"],
+            MODES[case["mode"]], case["n"], case["oversampling"], other["time_per_step"],
+            case["time_per_step"], case["time_per_step"]/other["time_per_step"],
+            other["steps_run"], case["steps_run"], other["final_chi2"], case["final_chi2"]))
+
+if __name__ == "__main__":
+    __spec__ = None
+
+    parser = argparse.ArgumentParser(description="Benchmark denss reconstructions and save the results as JSON.")
+    parser.add_argument("-d", "--datasets", nargs="+", default=sorted(DATASETS), choices=sorted(DATASETS), help="Datasets to run (default all). sphere and ellipsoid are synthetic profiles.")
+    parser.add_argument("-n", "--nsamples", nargs="+", type=int, default=[32, 64, 128, 192], help="Grid sizes to run (default 32 64 128 192).")
+    parser.add_argument("-os", "--oversampling", nargs="+", type=float, default=[3.0], help="Oversampling ratios to run (default 3).")
+    parser.add_argument("-m", "--modes", nargs="+", type=str.upper, default=["F", "S", "M"], choices=["F", "S", "M"], help="Modes to run: F(AST), S(LOW), M(EMBRANE) (default all).")
+    parser.add_argument("-s", "--steps", default=None, type=int, help="Maximum number of steps (default as set by each mode).")
+    parser.add_argument("--seeds", nargs="+", type=int, default=[1], help="Random seeds, one run of each case per seed (default 1).")
+    parser.add_argument("--precision", default=None, type=str.lower, choices=["double", "single"], help="Floating point precision (default as denss.py).")
+    parser.add_argument("--convergence", default=None, type=str.lower, choices=["chi", "adaptive"], help="Convergence test (default as denss.py).")
+    parser.add_argument("--profile", action="store_true", help="Also record the time spent in each phase of each run.")
+    parser.add_argument("-o", "--output", default="denss_benchmark.json", help="JSON file for the results (default denss_benchmark.json).")
+    parser.add_argument("--compare", default=None, help="JSON file from a previous benchmark to compare the time per step against.")
+    parser.add_argument("--run_case", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--result", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case is not None:
+        #worker process, running a single case
+        case = json.loads(args.run_case)
+        workdir = tempfile.mkdtemp(prefix="denss_benchmark_")
+        try:
+            result = run_case(case, workdir)
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        sys.exit(0)
+
+    cases = []
+    for dataset, mode, n, oversampling, seed in itertools.product(args.datasets,
+            args.modes, args.nsamples, args.oversampling, args.seeds):
+        cases.append({"dataset": dataset, "mode": mode, "n": n,
+            "oversampling": oversampling, "seed": seed, "steps": args.steps,
+            "precision": args.precision, "convergence": args.convergence,
+            "profile": args.profile})
+
+    results = []
+    fd, resultfile = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        for i, case in enumerate(cases):
+            print("%i / %i: %s, mode %s, n = %i, oversampling = %.1f, seed %i" % (i+1,
+                len(cases), case["dataset"], MODES[case["mode"]], case["n"],
+                case["oversampling"], case["seed"]))
+            sys.stdout.flush()
+            status = subprocess.call([sys.executable, os.path.abspath(__file__),
+                "--run_case", json.dumps(case), "--result", resultfile])
+            if status != 0:
+                print("   failed with exit status %i" % status)
+                continue
+            with open(resultfile) as f:
+                result = json.load(f)
+            results.append(result)
+            print("   %i steps, %.2f s, %.4f s/step, chi2 %.3e, peak memory %s MB" % (
+                result["steps_run"], result["total_time"], result["time_per_step"],
+                result["final_chi2"], "%.0f" % result["peak_rss_mb"]
+                if result["peak_rss_mb"] is not None else "?"))
+            #save as we go, so that an interrupted benchmark is not lost
+            with open(args.output, "w") as f:
+                json.dump({"environment": environment(), "cases": results}, f, indent=2)
+    finally:
+        os.remove(resultfile)
+
+    print("Results written to %s" % args.output)
+
+    if args.compare is not None:
+        compare(results, args.compare)
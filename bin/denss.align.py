@@ -81,6 +81,8 @@ if __name__ == "__main__":
 
     allrhos = np.array(allrhos)
     sides = np.array(sides)
+    #maps are written in the background while the next ones are calculated
+    map_writer = saxs.get_map_writer()
 
     if args.ref is None:
         print("Need reference file (.mrc or .pdb)")
@@ -94,12 +96,8 @@ if __name__ == "__main__":
             refoutput = refbasename+"_centered.pdb"
             refside = sides[0]
             voxel = (refside/allrhos[0].shape)[0]
-            halfside = refside/2
             n = int(refside/voxel)
             dx = refside/n
-            x_ = np.linspace(-halfside,halfside,n)
-            x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-            xyz = np.column_stack((x.ravel(),y.ravel(),z.ravel()))
             pdb = saxs.PDB(args.ref)
             if args.center:
                 pdb.coords -= pdb.coords.mean(axis=0)
@@ -122,7 +120,7 @@ if __name__ == "__main__":
             pdb2mrc.calc_rho_with_modified_params(pdb2mrc.params)
             refrho = pdb2mrc.rho_insolvent
             refrho = refrho*np.sum(allrhos[0])/np.sum(refrho)
-            saxs.write_mrc(refrho,pdb2mrc.side,filename=refbasename+'_pdb.mrc')
+            map_writer.write_mrc(refrho,pdb2mrc.side,filename=refbasename+'_pdb.mrc')
         if args.ref.endswith('.mrc'):
             refrho, refside = saxs.read_mrc(args.ref)
         if (not args.ref.endswith('.mrc')) and (not args.ref.endswith('.pdb')):
@@ -154,10 +152,11 @@ if __name__ == "__main__":
             ioutput = output+"_"+basename+"_to_"+refbasename
         else:
             ioutput = output
-        saxs.write_mrc(aligned[i], sides[0], ioutput+'.mrc')
+        map_writer.write_mrc(aligned[i], sides[0], ioutput+'.mrc')
         print("%s.mrc written. Score = %0.3e" % (ioutput,scores[i]))
         logging.info('Correlation score to reference: %s.mrc %.3e', ioutput, scores[i])
 
+    map_writer.flush()
     logging.info('END')
 
 
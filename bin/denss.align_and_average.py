@@ -80,6 +80,8 @@ if __name__ == "__main__":
         sides.append(side)
     allrhos = np.array(allrhos)
     sides = np.array(sides)
+    #maps are written in the background while the next ones are calculated
+    map_writer = saxs.get_map_writer()
 
     if nmaps<2:
         print("Not enough maps to align. Please input more maps again...")
@@ -95,12 +97,8 @@ if __name__ == "__main__":
             refoutput = refbasename+"_centered.pdb"
             refside = sides[0]
             voxel = (refside/allrhos[0].shape)[0]
-            halfside = refside/2
             n = int(refside/voxel)
             dx = refside/n
-            x_ = np.linspace(-halfside,halfside,n)
-            x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-            xyz = np.column_stack((x.ravel(),y.ravel(),z.ravel()))
             pdb = saxs.PDB(args.ref)
             if args.center:
                 pdb.coords -= pdb.coords.mean(axis=0)
@@ -123,7 +121,7 @@ if __name__ == "__main__":
             pdb2mrc.calc_rho_with_modified_params(pdb2mrc.params)
             refrho = pdb2mrc.rho_insolvent
             refrho = refrho*np.sum(allrhos[0])/np.sum(refrho)
-            saxs.write_mrc(refrho,pdb2mrc.side,filename=refbasename+'_pdb.mrc')
+            map_writer.write_mrc(refrho,pdb2mrc.side,filename=refbasename+'_pdb.mrc')
         if args.ref.endswith('.mrc'):
             refrho, refside = saxs.read_mrc(args.ref)
         if (not args.ref.endswith('.mrc')) and (not args.ref.endswith('.pdb')):
@@ -144,7 +142,7 @@ if __name__ == "__main__":
         print(" Generating reference...")
         try:
             refrho = saxs.binary_average(allrhos, args.cores)
-            saxs.write_mrc(refrho, sides[0], output+"_reference.mrc")
+            map_writer.write_mrc(refrho, sides[0], output+"_reference.mrc")
         except KeyboardInterrupt:
             sys.exit(1)
 
@@ -170,7 +168,7 @@ if __name__ == "__main__":
         fname_nopath = os.path.basename(args.files[i])
         basename, ext = os.path.splitext(fname_nopath)
         ioutput = basename+"_aligned"
-        saxs.write_mrc(aligned[i], sides[0], ioutput+'.mrc')
+        map_writer.write_mrc(aligned[i], sides[0], ioutput+'.mrc')
         print("%s.mrc written. Score = %0.3e %s " % (ioutput,scores[i],filtered[i]))
         logging.info('Correlation score to reference: %s.mrc %.3e %s', ioutput, scores[i], filtered[i])
 
@@ -184,7 +182,8 @@ if __name__ == "__main__":
     logging.info('Total number of input maps for alignment: %i',allrhos.shape[0])
     logging.info('Number of aligned maps accepted: %i', aligned.shape[0])
     logging.info('Correlation score between average and reference: %.3e', -saxs.rho_overlap_score(average_rho, refrho))
-    saxs.write_mrc(average_rho, sides[0], output+'_avg.mrc')
+    map_writer.write_mrc(average_rho, sides[0], output+'_avg.mrc')
+    map_writer.flush()
     logging.info('END')
 
 
@@ -80,12 +80,8 @@ if __name__ == "__main__":
             refoutput = refbasename+"_centered.pdb"
             refside = side
             voxel = (refside/rho.shape[0])
-            halfside = refside/2
             n = int(refside/voxel)
             dx = refside/n
-            x_ = np.linspace(-halfside,halfside,n)
-            x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-            xyz = np.column_stack((x.ravel(),y.ravel(),z.ravel()))
             pdb = saxs.PDB(args.ref)
             if args.center:
                 pdb.coords -= pdb.coords.mean(axis=0)
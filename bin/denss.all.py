@@ -35,7 +35,12 @@ import argparse
 import os, shutil
 import copy
 import time
-from functools import partial
+import json
+try:
+    import queue
+except ImportError:
+    #python 2
+    import Queue as queue
 
 import numpy as np
 
@@ -51,8 +56,13 @@ parser.add_argument("-en_off", "--enantiomer_off", action = "store_false", dest=
 parser.add_argument("-ref", "--ref", default=None, type=str, help="Input reference model (.mrc or .pdb file, optional).")
 parser.add_argument("-c_on", "--center_on", dest="center", action="store_true", help="Center reference PDB map.")
 parser.add_argument("-c_off", "--center_off", dest="center", action="store_false", help="Do not center reference PDB map (default).")
+parser.add_argument("-b", "--batch_size", default=1, type=int, help="Number of maps each process runs together as one batch (default 1).")
 parser.add_argument("-r", "--resolution", default=15.0, type=float, help="Resolution of map calculated from reference PDB file (default 15 angstroms).")
+parser.add_argument("-cull_on", "--cull_on", dest="cull", action="store_true", help="Stop runs whose chi2, Rg or support volume are outliers among the other runs once the shrinkwrap schedule is finished, and replace them with new runs (only with a batch size of 1).")
+parser.add_argument("-cull_off", "--cull_off", dest="cull", action="store_false", help="Run every map to the end (default).")
+parser.add_argument("--cull_threshold", default=6.0, type=float, help="Modified z-score beyond which a run is an outlier, for three reports in a row (default 6).")
 parser.set_defaults(enan = True)
+parser.set_defaults(cull = False)
 parser.set_defaults(center = True)
 superargs = dopts.parse_arguments(parser)
 
@@ -71,20 +81,59 @@ del args.nsamples
 del args.mode
 del args.resolution
 del args.center
+del args.batch_size
+del args.cull
+del args.cull_threshold
 del args.shrinkwrap_sigma_start_in_A
 del args.shrinkwrap_sigma_end_in_A
 del args.shrinkwrap_sigma_start_in_vox
 del args.shrinkwrap_sigma_end_in_vox
 
+#several denss runs execute at once, so unless told otherwise split
+#the cores between them rather than giving every FFT all of the cores
+if args.fft_threads is None:
+    args.fft_threads = max(1, multiprocessing.cpu_count() // superargs.cores)
+
+#each worker process keeps one workspace and reuses it for each of its
+#reconstructions, since they are all on the same grid
+workspace = None
+
+def setup_logger(output):
+    fname = output+'.log'
+    logger = logging.getLogger(output)
+    logger.setLevel(logging.INFO)
+    #the replacement of a culled map may run in the same process, and
+    #carries on in the same log
+    if not logger.handlers:
+        fh = logging.FileHandler(fname)
+        formatter = logging.Formatter('%(asctime)s - %(message)s')
+        fh.setFormatter(formatter)
+        logger.addHandler(fh)
+
+    logger.info('BEGIN')
+    logger.info('Script name: %s', sys.argv[0])
+    logger.info('DENSS Version: %s', __version__)
+    logger.info('Data filename: %s', superargs.file)
+    logger.info('Output prefix: %s', output)
+    logger.info('Mode: %s', superargs.mode)
+    return logger
+
 def multi_denss(niter, **kwargs):
+    global workspace
     try:
         # time.sleep(1)
 
         # Processing keyword args for compatibility with RAW GUI
         kwargs['path'] = '.'
 
+        if workspace is None:
+            workspace = saxs.DenssWorkspace()
+        kwargs['workspace'] = workspace
+
         kwargs['output'] = kwargs['output'] +'_'+str(niter)
-        np.random.seed(niter+int(time.time()))
+        #a map that was culled is run again with a different seed
+        attempt = kwargs.pop('attempt', 0)
+        np.random.seed(niter+superargs.nmaps*attempt+int(time.time()))
         kwargs['seed'] = np.random.randint(2**31-1)
         kwargs['quiet'] = True
 
@@ -92,22 +141,9 @@ def multi_denss(niter, **kwargs):
             sys.stdout.write( "\r Running denss job: %i / %i " % (niter+1,superargs.nmaps))
             sys.stdout.flush()
 
-        fname = kwargs['output']+'.log'
-        logger = logging.getLogger(kwargs['output'])
-        logger.setLevel(logging.INFO)
-        fh = logging.FileHandler(fname)
-        formatter = logging.Formatter('%(asctime)s - %(message)s')
-        fh.setFormatter(formatter)
-        logger.addHandler(fh)
-
+        logger = setup_logger(kwargs['output'])
         kwargs['my_logger'] = logger
 
-        logger.info('BEGIN')
-        logger.info('Script name: %s', sys.argv[0])
-        logger.info('DENSS Version: %s', __version__)
-        logger.info('Data filename: %s', superargs.file)
-        logger.info('Output prefix: %s', kwargs['output'])
-        logger.info('Mode: %s', superargs.mode)
         result = saxs.denss(**kwargs)
         logger.info('END')
         return result
@@ -116,6 +152,312 @@ def multi_denss(niter, **kwargs):
         print("KeyboardInterrupt")
         pass
 
+def multi_denss_batch(niters, **kwargs):
+    """Run the maps numbered in niters together with denss_batch()."""
+    global workspace
+    try:
+        kwargs['path'] = '.'
+
+        if workspace is None:
+            workspace = saxs.DenssWorkspace()
+        kwargs['workspace'] = workspace
+
+        outputs = [kwargs['output'] +'_'+str(niter) for niter in niters]
+        del kwargs['output']
+        #each map in the batch gets its own random seed
+        del kwargs['seed']
+        seeds = []
+        for niter in niters:
+            np.random.seed(niter+int(time.time()))
+            seeds.append(np.random.randint(2**31-1))
+        kwargs['quiet'] = True
+
+        sys.stdout.write( "\r Running denss jobs: %i-%i / %i " % (niters[0]+1,niters[-1]+1,superargs.nmaps))
+        sys.stdout.flush()
+
+        loggers = [setup_logger(output) for output in outputs]
+
+        results = saxs.denss_batch(seeds=seeds, output=outputs, my_logger=loggers, **kwargs)
+        for logger in loggers:
+            logger.info('END')
+        return results
+
+    except KeyboardInterrupt:
+        print("KeyboardInterrupt")
+        pass
+
+def run_timed(func, func_args, func_kwargs):
+    """Call func in a worker process, and return its result and how long it took."""
+    start = time.time()
+    result = func(*func_args, **func_kwargs)
+    return result, time.time() - start
+
+def align_map(refrho, rho, side):
+    """Align rho to the reference, and return it with its score and its FSC to the reference."""
+    rho = saxs.shift_to_reference(refrho, rho)
+    aligned, score = saxs.align(refrho, rho)
+    fsc = saxs.calc_fsc(aligned, refrho, side)
+    return aligned, score, fsc
+
+def reference_from_file(side, rho):
+    """Read the reference given with --ref, on the grid of the map rho with the given side."""
+    if superargs.ref.endswith('.pdb'):
+        reffname_nopath = os.path.basename(superargs.ref)
+        refbasename, refext = os.path.splitext(reffname_nopath)
+        refoutput = refbasename+"_centered.pdb"
+        refside = side
+        voxel = (refside/rho.shape)[0]
+        n = int(refside/voxel)
+        dx = refside/n
+        pdb = saxs.PDB(superargs.ref)
+        if superargs.center:
+            pdb.coords -= pdb.coords.mean(axis=0)
+            pdb.write(filename=refoutput)
+        pdb2mrc = saxs.PDB2MRC(
+            pdb=pdb,
+            center_coords=False, #done above
+            voxel=dx,
+            side=refside,
+            nsamples=n,
+            ignore_warnings=True,
+            )
+        pdb2mrc.scale_radii()
+        pdb2mrc.make_grids()
+        pdb2mrc.calculate_global_B()
+        pdb2mrc.calculate_invacuo_density()
+        pdb2mrc.calculate_excluded_volume()
+        pdb2mrc.calculate_hydration_shell()
+        pdb2mrc.calculate_structure_factors()
+        pdb2mrc.calc_rho_with_modified_params(pdb2mrc.params)
+        refrho = pdb2mrc.rho_insolvent
+        refrho = refrho*np.sum(rho)/np.sum(refrho)
+        saxs.get_map_writer().write_mrc(refrho,pdb2mrc.side,filename=refbasename+'_pdb.mrc')
+    if superargs.ref.endswith('.mrc'):
+        refrho, refside = saxs.read_mrc(superargs.ref)
+    return refrho
+
+def reference_tree_size(nmaps):
+    """Number of maps binary averaged into the reference, as by saxs.binary_average."""
+    twos = 2**np.arange(20)
+    nbinary = np.max([np.max(twos[twos<=nmaps]), 8])
+    #binary_average keeps the first of the last two averages
+    return int(min(nbinary//2, np.max(twos[twos<=nmaps])))
+
+class Pipeline(object):
+    """Run the reconstructions and the processing of their maps in one pool of processes.
+
+    Rather than waiting for every map before each stage, each map moves on as
+    soon as what it needs exists. Its best enantiomer is selected against the
+    first map to finish. The first maps to get that far are averaged in pairs
+    as they arrive, and the averages in pairs again, up to the reference. Every
+    map is then aligned to the reference, and its FSC calculated, as soon as
+    both exist. Processing a map goes before starting another reconstruction,
+    and no more tasks than cores run at once, so that little is left to do
+    after the last reconstruction has finished.
+
+    With --cull_on, each run also reports its progress through a queue, and
+    is stopped through its abort_event once EnsembleCuller finds it to be an
+    outlier, and run again with a new seed. At most nmaps runs are culled.
+    """
+    def __init__(self, pool, denss_inputs, logger, profiler):
+        self.pool = pool
+        self.denss_inputs = denss_inputs
+        self.logger = logger
+        self.profiler = profiler
+        self.nmaps = superargs.nmaps
+        self.map_writer = saxs.get_map_writer()
+
+        #reconstructions waiting to start, as lists of map numbers
+        if superargs.batch_size > 1:
+            self.waiting = [list(range(i, min(i+superargs.batch_size, self.nmaps)))
+                for i in range(0, self.nmaps, superargs.batch_size)]
+        else:
+            self.waiting = [[niter] for niter in range(self.nmaps)]
+        #tasks ready to run on the maps, as (priority, key, func, args)
+        self.ready = []
+        #tasks running, by key
+        self.running = {}
+        self.attempts = {}
+        self.abort_events = {}
+
+        self.outputs = [None]*self.nmaps
+        self.selected = [None]*self.nmaps
+        self.aligned = [None]*self.nmaps
+        self.side = None
+        self.enan_ref = None
+        self.refrho = None
+        #maps and averages waiting to be paired, at each level of the reference tree
+        self.levels = {}
+        self.nleaves = 0
+        self.nref = 0 if superargs.ref is not None else reference_tree_size(self.nmaps)
+        self.last_map_time = None
+        #wall time from the last reconstruction finishing to the last alignment
+        self.tail_time = 0.0
+
+        self.cull = superargs.cull and superargs.batch_size == 1
+        self.nculled = 0
+        if self.cull:
+            self.manager = multiprocessing.Manager()
+            self.progress_queue = self.manager.Queue()
+            #runs are only judged once shrinkwrap has reached its smallest sigma
+            #and connectivity has been enforced, before which good runs vary a lot
+            decay_steps = saxs.shrinkwrap_schedule_steps(shrinkwrap_iter=args.shrinkwrap_iter,
+                shrinkwrap_sigma_start=args.shrinkwrap_sigma_start, shrinkwrap_sigma_end=args.shrinkwrap_sigma_end,
+                shrinkwrap_sigma_decay=args.shrinkwrap_sigma_decay, enforce_connectivity_steps=[0], shrinkwrap_minstep=0)
+            minstep = max(list(args.enforce_connectivity_steps) + [args.shrinkwrap_minstep + decay_steps])
+            self.culler = saxs.EnsembleCuller(minstep=minstep, threshold=superargs.cull_threshold)
+            self.niters = dict((args.output+'_'+str(niter), niter) for niter in range(self.nmaps))
+            logger.info('Culling outlying runs from step %i, z-score threshold %.1f', minstep, superargs.cull_threshold)
+
+    def queue_task(self, priority, key, func, *args):
+        """Queue func(*args) to run once a process is free. Lower priorities go first."""
+        self.ready.append((priority, len(self.ready), key, func, args))
+        self.ready.sort(key=lambda task: task[:2])
+
+    def start_tasks(self):
+        """Start the tasks that are ready, then reconstructions, while processes are free."""
+        while len(self.running) < superargs.cores:
+            if self.ready:
+                priority, order, key, func, args = self.ready.pop(0)
+                self.running[key] = self.pool.apply_async(run_timed, (func, args, {}))
+            elif self.waiting:
+                niters = self.waiting.pop(0)
+                if superargs.batch_size > 1:
+                    key = ('denss_batch', tuple(niters))
+                    self.running[key] = self.pool.apply_async(run_timed, (multi_denss_batch, (niters,), self.denss_inputs))
+                else:
+                    niter = niters[0]
+                    kwargs = dict(self.denss_inputs, attempt=self.attempts.get(niter, 0))
+                    if self.cull:
+                        kwargs['abort_event'] = self.abort_events[niter] = self.manager.Event()
+                        kwargs['progress_queue'] = self.progress_queue
+                    self.running[('denss', niter)] = self.pool.apply_async(run_timed, (multi_denss, (niter,), kwargs))
+            else:
+                break
+
+    def check_progress(self):
+        """Pass the progress reported by the runs to the culler, and stop runs it finds to be outliers."""
+        while True:
+            try:
+                output, seed, step, chi, rg, supportV = self.progress_queue.get_nowait()
+            except queue.Empty:
+                return
+            niter = self.niters[output]
+            #runs are labelled by their seed too, since a replacement reuses the output prefix
+            reason = self.culler.add((output, seed), step, chi, rg, supportV)
+            if reason is not None and self.nculled < self.nmaps and ('denss', niter) in self.running:
+                self.culler.cull((output, seed))
+                self.abort_events[niter].set()
+                self.nculled += 1
+                self.logger.info('Culled map %i at step %i, %s', niter, step, reason)
+
+    def run(self):
+        """Run everything, and return when every map has been aligned to the reference."""
+        while self.running or self.ready or self.waiting:
+            self.start_tasks()
+            if self.cull:
+                self.check_progress()
+            finished = [key for key in self.running if self.running[key].ready()]
+            if not finished:
+                time.sleep(0.05)
+            for key in finished:
+                result, elapsed = self.running.pop(key).get()
+                self.finish(key, result, elapsed)
+        if self.last_map_time is not None:
+            self.tail_time = time.time() - self.last_map_time
+
+    def finish(self, key, result, elapsed):
+        """Use the result of a finished task, and queue the tasks that were waiting for it."""
+        stage = key[0]
+        if stage == 'denss':
+            niter = key[1]
+            if result:
+                self.add_map(niter, result)
+            elif self.cull and self.abort_events[niter].is_set():
+                #start the map again from scratch with a new seed
+                checkpoint = args.output+'_'+str(niter)+'_checkpoint.npz'
+                if os.path.exists(checkpoint):
+                    os.remove(checkpoint)
+                self.attempts[niter] = self.attempts.get(niter, 0) + 1
+                self.waiting.insert(0, [niter])
+            else:
+                #the run was interrupted rather than culled
+                raise KeyboardInterrupt
+        elif stage == 'denss_batch':
+            if not result:
+                raise KeyboardInterrupt
+            for niter, denss_output in zip(key[1], result):
+                self.add_map(niter, denss_output)
+        elif stage == 'enantiomer':
+            self.profiler.merge({'select_enantiomers': {"time": elapsed, "calls": 1}})
+            niter = key[1]
+            best_enan, score = result
+            self.map_writer.write_mrc(best_enan, self.side, args.output+"_"+str(niter)+"_enan.mrc")
+            self.add_selected(niter, best_enan)
+        elif stage == 'average':
+            self.profiler.merge({'generate_reference': {"time": elapsed, "calls": 1}})
+            level = key[1]
+            if 2**level == self.nref:
+                self.set_reference(saxs.center_rho_roll(result))
+                self.map_writer.write_mrc(self.refrho, self.side, args.output+"_reference.mrc")
+            else:
+                self.add_to_tree(level, result)
+        elif stage == 'align':
+            self.profiler.merge({'align': {"time": elapsed, "calls": 1}})
+            self.aligned[key[1]] = result
+
+    def add_map(self, niter, denss_output):
+        """Take in the result of a reconstruction."""
+        self.outputs[niter] = denss_output
+        rho = denss_output[8]
+        if self.side is None:
+            self.side = denss_output[9]
+            if superargs.ref is not None:
+                self.set_reference(reference_from_file(self.side, rho))
+        if sum(output is not None for output in self.outputs) == self.nmaps:
+            print("\r Finishing denss job: %i / %i" % (self.nmaps,self.nmaps))
+            sys.stdout.flush()
+            self.logger.info('Finished DENSS runs')
+            self.last_map_time = time.time()
+        if superargs.enan:
+            if self.enan_ref is None:
+                #enantiomers are selected against the first map to finish
+                self.enan_ref = rho
+                self.logger.info('Selecting best enantiomers against map %i', niter)
+            self.queue_task(1, ('enantiomer', niter), saxs.select_best_enantiomer, self.enan_ref, rho)
+        else:
+            self.add_selected(niter, rho)
+
+    def add_selected(self, niter, rho):
+        """Take in a map of the chosen hand, for the reference and for alignment."""
+        self.selected[niter] = rho
+        if self.nleaves < self.nref:
+            if self.nleaves == 0:
+                self.logger.info('Generating reference from %i maps', self.nref)
+            self.nleaves += 1
+            self.add_to_tree(0, rho)
+        if self.refrho is not None:
+            self.queue_task(2, ('align', niter), align_map, self.refrho, rho, self.side)
+
+    def add_to_tree(self, level, rho):
+        """Add a map or average to the reference tree, and average it with the one before it, if waiting."""
+        self.levels.setdefault(level, []).append(rho)
+        if self.nref == 1:
+            self.set_reference(saxs.center_rho_roll(rho))
+            self.map_writer.write_mrc(self.refrho, self.side, args.output+"_reference.mrc")
+        elif len(self.levels[level]) == 2:
+            rho1, rho2 = self.levels.pop(level)
+            #averages go first, since every alignment waits for the reference
+            self.queue_task(0, ('average', level+1, self.nleaves), saxs.average_two, rho1, rho2)
+
+    def set_reference(self, refrho):
+        """Set the reference, and align to it the maps that are waiting for it."""
+        self.refrho = refrho
+        self.logger.info('Aligning maps to reference')
+        for niter in range(self.nmaps):
+            if self.selected[niter] is not None:
+                self.queue_task(2, ('align', niter), align_map, self.refrho, self.selected[niter], self.side)
+
 
 if __name__ == "__main__":
     __spec__ = None
@@ -134,17 +476,24 @@ if __name__ == "__main__":
     out_dir = output
     dirn = 0
     while os.path.isdir(out_dir):
+        last_dir = out_dir
         out_dir = output + "_" + str(dirn)
         dirn += 1
 
-    print(out_dir)
-    os.mkdir(out_dir)
+    if superargs.resume and dirn > 0:
+        #continue in the most recent output directory for this prefix
+        out_dir = last_dir
+        print(out_dir)
+    else:
+        print(out_dir)
+        os.mkdir(out_dir)
     output = out_dir+'/'+output
     args.output = output
     superargs.output = output
 
     #for convenience and record keeping, make a copy of the input file in the output directory
-    shutil.copy(superargs.file, out_dir)
+    if not os.path.exists(os.path.join(out_dir, os.path.basename(superargs.file))):
+        shutil.copy(superargs.file, out_dir)
 
     fname = output+'_final.log'
     superlogger = logging.getLogger(output+'_final')
@@ -165,15 +514,21 @@ if __name__ == "__main__":
     for arg in vars(args):
         denss_inputs[arg]= getattr(args, arg)
 
+    #time spent by the worker processes, summed over all of them, is kept
+    #apart from the wall time of the phases run by this process
+    profiler = saxs.PhaseProfiler(enabled=saxs.profiling_enabled(superargs.profile))
+    main_profiler = saxs.PhaseProfiler(enabled=profiler.enabled)
+
     pool = multiprocessing.Pool(superargs.cores)
 
     superlogger.info('Starting DENSS runs')
 
+    #maps are processed as they finish, rather than once all of them have
+    pipeline = Pipeline(pool, denss_inputs, superlogger, profiler)
     try:
-        mapfunc = partial(multi_denss, **denss_inputs)
-        denss_outputs = pool.map(mapfunc, list(range(superargs.nmaps)))
-        print("\r Finishing denss job: %i / %i" % (superargs.nmaps,superargs.nmaps))
-        sys.stdout.flush()
+        main_profiler.start('pipeline')
+        pipeline.run()
+        main_profiler.stop('pipeline')
         pool.close()
         pool.join()
     except KeyboardInterrupt:
@@ -181,7 +536,22 @@ if __name__ == "__main__":
         pool.close()
         sys.exit(1)
 
-    superlogger.info('Finished DENSS runs')
+    if superargs.cull:
+        if superargs.batch_size > 1:
+            superlogger.info('Culling is only done with a batch size of 1, so no runs were culled')
+        else:
+            superlogger.info('Runs culled and replaced: %i', pipeline.nculled)
+
+    if profiler.enabled:
+        #add up the time each worker spent in each phase. a batch of maps
+        #writes one profile, named after the first map of the batch
+        for i in range(superargs.nmaps):
+            fname = output+"_"+str(i)+"_profile.json"
+            if os.path.exists(fname):
+                with open(fname) as f:
+                    profiler.merge(json.load(f)["phases"])
+
+    denss_outputs = pipeline.outputs
 
     qdata = denss_outputs[0][0]
     Idata = denss_outputs[0][1]
@@ -219,78 +589,12 @@ if __name__ == "__main__":
     np.savetxt(output+'_rg_by_step.fit',all_rg.T,delimiter=" ",fmt="%.5e",header=",".join(rg_header))
     np.savetxt(output+'_supportV_by_step.fit',all_supportV.T,delimiter=" ",fmt="%.5e",header=",".join(supportV_header))
 
-    allrhos = np.array([denss_outputs[i][8] for i in np.arange(superargs.nmaps)])
     sides = np.array([denss_outputs[i][9] for i in np.arange(superargs.nmaps)])
-
-    if superargs.ref is not None:
-        #allow input of reference structure
-        if superargs.ref.endswith('.pdb'):
-            reffname_nopath = os.path.basename(superargs.ref)
-            refbasename, refext = os.path.splitext(reffname_nopath)
-            refoutput = refbasename+"_centered.pdb"
-            refside = sides[0]
-            voxel = (refside/allrhos[0].shape)[0]
-            halfside = refside/2
-            n = int(refside/voxel)
-            dx = refside/n
-            x_ = np.linspace(-halfside,halfside,n)
-            x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-            xyz = np.column_stack((x.ravel(),y.ravel(),z.ravel()))
-            pdb = saxs.PDB(superargs.ref)
-            if superargs.center:
-                pdb.coords -= pdb.coords.mean(axis=0)
-                pdb.write(filename=refoutput)
-            pdb2mrc = saxs.PDB2MRC(
-                pdb=pdb,
-                center_coords=False, #done above
-                voxel=dx,
-                side=refside,
-                nsamples=n,
-                ignore_warnings=True,
-                )
-            pdb2mrc.scale_radii()
-            pdb2mrc.make_grids()
-            pdb2mrc.calculate_global_B()
-            pdb2mrc.calculate_invacuo_density()
-            pdb2mrc.calculate_excluded_volume()
-            pdb2mrc.calculate_hydration_shell()
-            pdb2mrc.calculate_structure_factors()
-            pdb2mrc.calc_rho_with_modified_params(pdb2mrc.params)
-            refrho = pdb2mrc.rho_insolvent
-            refrho = refrho*np.sum(allrhos[0])/np.sum(refrho)
-            saxs.write_mrc(refrho,pdb2mrc.side,filename=refbasename+'_pdb.mrc')
-        if superargs.ref.endswith('.mrc'):
-            refrho, refside = saxs.read_mrc(superargs.ref)
-
-    if superargs.enan:
-        print()
-        print(" Selecting best enantiomers...")
-        superlogger.info('Selecting best enantiomers')
-        try:
-            allrhos, scores = saxs.select_best_enantiomers(allrhos, cores=superargs.cores)
-        except KeyboardInterrupt:
-            sys.exit(1)
-        for i in range(superargs.nmaps):
-            ioutput = output+"_"+str(i)+"_enan"
-            saxs.write_mrc(allrhos[i], sides[0], ioutput+".mrc")
-
-    if superargs.ref is None:
-        print()
-        print(" Generating reference...")
-        superlogger.info('Generating reference')
-        try:
-            refrho = saxs.binary_average(allrhos, superargs.cores)
-            saxs.write_mrc(refrho, sides[0], output+"_reference.mrc")
-        except KeyboardInterrupt:
-            sys.exit(1)
-
-    print()
-    print(" Aligning all maps to reference...")
-    superlogger.info('Aligning all maps to reference')
-    try:
-        aligned, scores = saxs.align_multiple(refrho, allrhos, superargs.cores)
-    except KeyboardInterrupt:
-        sys.exit(1)
+    map_writer = pipeline.map_writer
+    refrho = pipeline.refrho
+    aligned = np.array([pipeline.aligned[i][0] for i in range(superargs.nmaps)])
+    scores = np.array([pipeline.aligned[i][1] for i in range(superargs.nmaps)])
+    fscs = np.array([pipeline.aligned[i][2] for i in range(superargs.nmaps)])
 
     #filter rhos with scores below the mean - 2*standard deviation.
     mean = np.mean(scores)
@@ -305,35 +609,30 @@ if __name__ == "__main__":
         else:
             filtered[i] = ' '
         ioutput = output+"_"+str(i)+"_aligned"
-        saxs.write_mrc(aligned[i], sides[0], ioutput+".mrc")
+        map_writer.write_mrc(aligned[i], sides[0], ioutput+".mrc")
         print("%s.mrc written. Score = %0.3f %s " % (ioutput,scores[i],filtered[i]))
         superlogger.info('Correlation score to reference: %s.mrc %.3f %s', ioutput, scores[i], filtered[i])
 
     idx_keep = np.where(scores>threshold)
     kept_ids = np.arange(superargs.nmaps)[idx_keep]
     aligned = aligned[idx_keep]
+    fscs = fscs[idx_keep]
     average_rho = np.mean(aligned,axis=0)
 
     superlogger.info('Mean of correlation scores: %.3f', mean)
     superlogger.info('Standard deviation of the scores: %.3f', std)
-    superlogger.info('Total number of input maps for alignment: %i',allrhos.shape[0])
+    superlogger.info('Total number of input maps for alignment: %i',superargs.nmaps)
     superlogger.info('Number of aligned maps accepted: %i', aligned.shape[0])
     superlogger.info('Correlation score between average and reference: %.3f', -saxs.rho_overlap_score(average_rho, refrho))
     superlogger.info('Mean Density of Avg Map (all voxels): %3.5f', np.mean(average_rho))
     superlogger.info('Std. Dev. of Density (all voxels): %3.5f', np.std(average_rho))
     superlogger.info('RMSD of Density (all voxels): %3.5f', np.sqrt(np.mean(np.square(average_rho))))
-    saxs.write_mrc(average_rho, sides[0], output+'_avg.mrc')
+    map_writer.write_mrc(average_rho, sides[0], output+'_avg.mrc')
 
-    #rather than compare two halves, average all fsc's to the reference
-    fscs = []
-    resns = []
-    for calc_map in range(len(aligned)):
-        fsc_map = saxs.calc_fsc(aligned[calc_map],refrho,sides[0])
-        fscs.append(fsc_map)
-        resn_map = saxs.fsc2res(fsc_map)
-        resns.append(resn_map)
-
-    fscs = np.array(fscs)
+    #rather than compare two halves, average all fsc's to the reference.
+    #each map's fsc was calculated when it was aligned
+    main_profiler.start('fsc')
+    resns = [saxs.fsc2res(fsc_map) for fsc_map in fscs]
 
     #save a file containing all fsc curves
     fscs_header = ['res(1/A)']
@@ -348,6 +647,7 @@ if __name__ == "__main__":
     fsc = np.mean(fscs,axis=0)
     resn, x, y, resx = saxs.fsc2res(fsc, return_plot=True)
     resn_sd = np.std(resns)
+    main_profiler.stop('fsc')
     if np.min(fsc[:,1]) > 0.5:
         print("Resolution: < %.1f +- %.1f A (maximum possible)" % (resn,resn_sd))
     else:
@@ -356,6 +656,25 @@ if __name__ == "__main__":
     np.savetxt(output+'_fsc.dat',fsc,delimiter=" ",fmt="%.5e",header="1/resolution, FSC; Resolution=%.1f +- %.1f A" % (resn,resn_sd))
 
     superlogger.info('Resolution = %.1f +- %.1f A' % (resn,resn_sd))
+    main_profiler.start('write_maps')
+    map_writer.flush()
+    main_profiler.stop('write_maps')
+
+    if profiler.enabled:
+        #phases of the denss runs and of the processing of their maps are
+        #summed over all of the workers, so their total can be up to cores
+        #times the wall time of the pipeline phase of this process
+        profiler.log(superlogger, title="worker phase")
+        main_profiler.log(superlogger, title="main process phase")
+        superlogger.info('Profile: time from the last map to the last alignment: %.3f s', pipeline.tail_time)
+        profiler.save(output+'_profile.json', nmaps=superargs.nmaps, cores=superargs.cores,
+            batch_size=superargs.batch_size, main_phases=main_profiler.stats,
+            after_last_map=pipeline.tail_time)
+
+    #all of the maps are finished, so their checkpoints are no longer needed
+    for i in range(superargs.nmaps):
+        if os.path.exists(output+"_"+str(i)+"_checkpoint.npz"):
+            os.remove(output+"_"+str(i)+"_checkpoint.npz")
     superlogger.info('END')
 
     if superargs.plot:
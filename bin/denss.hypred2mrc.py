@@ -89,9 +89,8 @@ xxmax = np.max([xmax,ymax,zmax])
 
 #create the density array
 x_ = np.arange(xxmin, xxmax, dx)
-x, y, z = np.meshgrid(x_,x_,x_,indexing='ij')
-rho_prot = np.zeros(x.shape)
-rho_h2o = np.zeros(x.shape)
+rho_prot = np.zeros((len(x_),)*3)
+rho_h2o = np.zeros((len(x_),)*3)
 side = x_[-1]-x_[0] + dx
 
 #replace the zeros of the density with the b-factor column of the hypred pdb
@@ -83,32 +83,16 @@ if __name__ == "__main__":
 
     #read density map and calculate scattering profile
     rho, side = saxs.read_mrc(args.file)
-    halfside = side/2
     nx, ny, nz = rho.shape[0], rho.shape[1], rho.shape[2]
     n = nx
-    x_ = np.linspace(-halfside,halfside,n)
-    x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-    df = 1/side
-    qx_ = np.fft.fftfreq(x_.size)*n*df*2*np.pi
-    qz_ = np.fft.rfftfreq(x_.size)*n*df*2*np.pi
-    qx, qy, qz = np.meshgrid(qx_,qx_,qx_,indexing='ij')
-    qr = np.sqrt(qx**2+qy**2+qz**2)
-    qmax = np.max(qr)
-    qstep = np.min(qr[qr>0]) - 1e-8
-    nbins = int(qmax/qstep)
-    qbins = np.linspace(0,nbins*qstep,nbins+1)
-    #create an array labeling each voxel according to which qbin it belongs
-    qbin_labels = np.searchsorted(qbins,qr,"right")
-    qbin_labels -= 1
-    qblravel = qbin_labels.ravel()
-    xcount = np.bincount(qblravel)
-    #create modified qbins and put qbins in center of bin rather than at left edge of bin.
-    qbinsc = saxs.mybinmean(qr.ravel(), qblravel, xcount)
+    grid = saxs.get_grid(n, side, rfft=False)
+    qx_ = grid.qx_
+    qbinsc = grid.qbinsc
 
     #calculate scattering profile from density
     F = saxs.myfftn(rho)
     I3D = saxs.abs2(F)
-    Imean = saxs.mybinmean(I3D.ravel(), qblravel, xcount=xcount)
+    Imean = grid.binmean(I3D)
     Iq_calc = np.vstack((qbinsc, Imean, Imean*.01)).T
 
     if args.data is not None:
@@ -184,9 +184,7 @@ if __name__ == "__main__":
     dx = side/n
     dV = dx**3
     x_ = np.linspace(-halfside,halfside,n)
-    x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-
-    xyz = np.column_stack((x.ravel(),y.ravel(),z.ravel()))
+    x,y,z = np.meshgrid(x_,x_,x_,indexing='ij',sparse=True)
 
     if args.resolution is None and not args.use_b:
         resolution = 0.3 * dx 
@@ -46,7 +46,11 @@ if __name__ == "__main__":
     # h1.setLevel(logging.INFO)
     # h1.setFormatter(formatter)
 
-    h2 = logging.FileHandler(os.path.join('.', args.output+'.log'), mode='w')
+    #keep the log of the interrupted run when resuming
+    if args.resume:
+        h2 = logging.FileHandler(os.path.join('.', args.output+'.log'), mode='a')
+    else:
+        h2 = logging.FileHandler(os.path.join('.', args.output+'.log'), mode='w')
     h2.setLevel(logging.INFO)
     h2.setFormatter(formatter)
 
@@ -102,8 +106,28 @@ if __name__ == "__main__":
         cutout=args.cutout,
         quiet=args.quiet,
         DENSS_GPU=args.DENSS_GPU,
+        fft_backend=args.fft_backend,
+        fft_threads=args.fft_threads,
+        grid_cache_dir=args.grid_cache_dir,
+        precision=args.precision,
+        checkpoint_freq=args.checkpoint_freq,
+        resume=args.resume,
+        profile=args.profile,
+        multires_steps=args.multires_steps,
+        projector=args.projector,
+        projector_beta=args.projector_beta,
+        projector_beta_start=args.projector_beta_start,
+        projector_beta_steps=args.projector_beta_steps,
+        projector_er_step=args.projector_er_step,
+        convergence=args.convergence,
+        convergence_tol=args.convergence_tol,
+        shrinkwrap_skip_decay=args.shrinkwrap_skip_decay,
         my_logger=my_logger)
 
+    #the run finished, so its checkpoint is no longer needed
+    if os.path.exists(args.output+'_checkpoint.npz'):
+        os.remove(args.output+'_checkpoint.npz')
+
     print("\n%s"%args.output)
 
     if args.plot:
@@ -81,33 +81,15 @@ if __name__ == "__main__":
     #want n to be even for speed/memory optimization with the FFT, ideally a power of 2, but wont enforce that
     #store n for later use if needed
     n_orig = n
-    dx = side/n
-    dV = dx**3
-    V = side**3
-    x_ = np.linspace(-halfside,halfside,n)
-    x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-    df = 1/side
-    qx_ = np.fft.fftfreq(x_.size)*n*df*2*np.pi
-    qz_ = np.fft.rfftfreq(x_.size)*n*df*2*np.pi
-    qx, qy, qz = np.meshgrid(qx_,qx_,qx_,indexing='ij')
-    qr = np.sqrt(qx**2+qy**2+qz**2)
-    qmax = np.max(qr)
-    qstep = np.min(qr[qr>0]) - 1e-8
-    nbins = int(qmax/qstep)
-    qbins = np.linspace(0,nbins*qstep,nbins+1)
-    #create an array labeling each voxel according to which qbin it belongs
-    qbin_labels = np.searchsorted(qbins,qr,"right")
-    qbin_labels -= 1
-    qblravel = qbin_labels.ravel()
-    xcount = np.bincount(qblravel)
-    #create modified qbins and put qbins in center of bin rather than at left edge of bin.
-    qbinsc = saxs.mybinmean(qr.ravel(), qblravel, xcount)
+    grid = saxs.get_grid(n, side, rfft=False)
+    qx_ = grid.qx_
+    qbinsc = grid.qbinsc
 
     #calculate scattering profile from density
     F = saxs.myfftn(rho)
     F[F.real==0] = 1e-16
     I3D = saxs.abs2(F)
-    Imean = saxs.mybinmean(I3D.ravel(), qblravel, xcount=xcount)
+    Imean = grid.binmean(I3D)
 
     if args.plot: 
         qmax_to_use = np.max(qx_)
@@ -139,31 +121,10 @@ if __name__ == "__main__":
             n = int(desired_n)
             if n%2==1: n+=1
         side = voxel*n
-        halfside = side/2
-        dx = side/n
-        dV = dx**3
-        V = side**3
-        x_ = np.linspace(-halfside,halfside,n)
-        x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-        df = 1/side
-        print(n, 2*np.pi*df)
-        qx_ = np.fft.fftfreq(x_.size)*n*df*2*np.pi
-        qx, qy, qz = np.meshgrid(qx_,qx_,qx_,indexing='ij')
-        qr = np.sqrt(qx**2+qy**2+qz**2)
-        qmax = np.max(qr)
-        qstep = np.min(qr[qr>0]) - 1e-8
-        nbins = int(qmax/qstep)
-        qbins = np.linspace(0,nbins*qstep,nbins+1)
-        #create modified qbins and put qbins in center of bin rather than at left edge of bin.
-        # qbinsc = np.copy(qbins)
-        # qbinsc[1:] += qstep/2.
-
-        #create an array labeling each voxel according to which qbin it belongs
-        qbin_labels = np.searchsorted(qbins,qr,"right")
-        qbin_labels -= 1
-        qblravel = qbin_labels.ravel()
-        xcount = np.bincount(qblravel)
-        qbinsc = saxs.mybinmean(qr.ravel(), qblravel, xcount)
+        grid = saxs.get_grid(n, side, rfft=False)
+        print(n, 2*np.pi*grid.df)
+        qx_ = grid.qx_
+        qbinsc = grid.qbinsc
         rho_pad = np.zeros((n,n,n))
         a = n//2-n_orig//2
         b = n//2+n_orig//2
@@ -172,7 +133,7 @@ if __name__ == "__main__":
 
     F = saxs.myfftn(rho)
     I3D = saxs.abs2(F)
-    Imean = saxs.mybinmean(I3D.ravel(), qblravel, xcount=xcount)
+    Imean = grid.binmean(I3D)
 
     qmax_to_use = np.max(qx_)
     print("qmax to use: %f" % qmax_to_use)
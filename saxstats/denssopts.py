@@ -68,6 +68,9 @@ def parse_arguments(parser):
     parser.add_argument("-ec_steps","--enforce_connectivity_steps", default=None, type=int, nargs='+', help="List of steps to enforce connectivity")
     parser.add_argument("-ec_max","--enforce_connectivity_max_features", default=1, type=int, help="Maximum number of features (i.e. disconnected blobs) allowed in support during enforce_connectivity step.")
     parser.add_argument("-cef", "--chi_end_fraction", default=0.001, type=float, help="Convergence criterion. Minimum threshold of chi2 std dev, as a fraction of the median chi2 of last 100 steps.")
+    parser.add_argument("--convergence", default="chi", type=str.lower, choices=["chi","adaptive"], help="Convergence test: chi stops when chi2 is flat to within chi_end_fraction, adaptive also stops once the shrinkwrap sigma has reached its end and the fitted chi2, Rg and support volume have stopped changing. (default chi)")
+    parser.add_argument("--convergence_tol", default=0.005, type=float, help="Largest relative change over 100 steps of the fitted chi2, Rg and support volume for the adaptive convergence test. (default 0.005)")
+    parser.add_argument("-sw_skip_decay","--shrinkwrap_skip_decay", action="store_true", help="Go straight to the ending shrinkwrap sigma once the support volume has stopped changing. (default False)")
     parser.add_argument("--write_xplor_format", default=False, action="store_true", help="Write out XPLOR map format (default only write MRC format).")
     parser.add_argument("--write_freq", default=100, type=int, help="How often to write out current density map (in steps, default 100).")
     parser.add_argument("--cutout_on", dest="cutout", action="store_true", help="When writing final map, cut out the particle to make smaller files.")
@@ -76,6 +79,19 @@ def parse_arguments(parser):
     parser.add_argument("--plot_off", dest="plot", action="store_false", help="Do not create simple plots of results. (Default if Matplotlib does not exist)")
     parser.add_argument("-q", "--quiet", action="store_true", help="Do not display running statistics. (default False)")
     parser.add_argument("-gpu", "--gpu", dest="DENSS_GPU", action="store_true", help="Use GPU acceleration (requires CuPy). (default False)")
+    parser.add_argument("--fft_backend", default="scipy", type=str.lower, choices=["scipy","pyfftw","numpy"], help="Library used for FFTs on the CPU (scipy, pyfftw or numpy). Falls back to scipy (then numpy) if unavailable. (default scipy)")
+    parser.add_argument("--precision", default="double", type=str.lower, choices=["double","single"], help="Floating point precision of the reconstruction. Single precision halves the memory used and runs faster. (default double)")
+    parser.add_argument("--fft_threads", default=None, type=int, help="Number of threads used for each FFT. (default all cores)")
+    parser.add_argument("--grid_cache", dest="grid_cache_dir", default=None, nargs='?', const=os.path.join(saxs.denss_cache_dir(), "grids"), help="Keep the real and reciprocal space grids on disk, so that later runs and other processes on the same grid can reuse them. Optionally give the directory to keep them in. The directory is not cleaned up. (default off, or %s if no directory is given)" % os.path.join(saxs.denss_cache_dir(), "grids").replace("%","%%"))
+    parser.add_argument("--checkpoint_freq", default=500, type=int, help="How often to save a checkpoint of the run, for use with --resume (in steps, default 500, 0 to disable).")
+    parser.add_argument("--resume", action="store_true", help="Resume an interrupted run with the same options from its last checkpoint.")
+    parser.add_argument("--multires_steps", default=None, type=int, nargs='+', help="Space separated list of steps at which to move to a finer grid. The first steps run on a grid with 2^(number of steps) times fewer voxels along each side, doubling at each step until the requested voxel size. Faster for large particles. (default off)")
+    parser.add_argument("--projector", default="er", type=str.lower, choices=["er","hio","raar","dm"], help="Real space projection algorithm: er (error reduction), hio (hybrid input-output), raar (relaxed averaged alternating reflections) or dm (difference map). Error reduction is always used to polish the map at the end. (default er)")
+    parser.add_argument("--projector_beta", default=0.9, type=float, help="Feedback parameter beta of the hio, raar and dm projectors. (default 0.9)")
+    parser.add_argument("--projector_beta_start", default=None, type=float, help="Starting value of beta, which then moves to projector_beta over about projector_beta_steps steps. (default constant beta)")
+    parser.add_argument("--projector_beta_steps", default=500, type=int, help="Number of steps over which beta moves from projector_beta_start to projector_beta. (default 500)")
+    parser.add_argument("--projector_er_step", default=None, type=int, help="Step from which error reduction is used to polish the map. Steps later than 100 before the last step are moved back to it. (default end of the shrinkwrap schedule)")
+    parser.add_argument("--profile", action="store_true", default=None, help="Record the time spent in each phase of the reconstruction, written to the log and to output_profile.json. (default False, or the DENSS_PROFILE environment variable)")
     parser.set_defaults(shrinkwrap=None)
     parser.set_defaults(shrinkwrap_old_method=None)
     parser.set_defaults(recenter=None)
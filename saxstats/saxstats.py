@@ -50,12 +50,23 @@ import logging
 from functools import partial
 import multiprocessing
 import datetime, time
-from time import sleep
 import warnings
 import pickle
+import shutil
+import threading
+import atexit
+from collections import OrderedDict
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
 
 import numpy as np
-from scipy import ndimage, interpolate, spatial, special, optimize, signal, stats, fft
+from scipy import ndimage, interpolate, spatial, special, optimize, signal, stats, fft, sparse
 from functools import reduce
 
 #load some dictionaries
@@ -87,82 +98,161 @@ try:
 except ImportError:
     CUPY_LOADED = False
 
-# try:
-#     import pyfftw
-#     pyfftw.config.NUM_THREADS = multiprocessing.cpu_count()
-#     pyfftw.interfaces.cache.enable()
-#     PYFFTW = True
-#     # Try to load FFTW wisdom but don't panic if we can't
-#     try:
-#         with open("fft.wisdom", "rb") as the_file:
-#             wisdom = pickle.load(the_file)
-#             pyfftw.import_wisdom(wisdom)
-#             print("pyfftw wisdom imported")
-#     except FileNotFoundError:
-#         print("Warning: pyfftw wisdom could not be imported")
-# except:
-#     PYFFTW = False
-
-#disable pyfftw until we can make it more stable
-#it works, but often results in nans randomly
+#FFT backend used by myfftn, myrfftn, myifftn and myirfftn for CPU transforms.
+#"scipy" uses scipy.fft with worker threads, "pyfftw" uses FFTW plans cached
+#per array shape with wisdom kept in the user cache directory, and "numpy"
+#uses np.fft. Select with set_fft_backend().
+FFT_BACKENDS = ["scipy", "pyfftw", "numpy"]
+FFT_BACKEND = "scipy"
+#number of threads per transform, -1 uses all cores
+FFT_THREADS = -1
 PYFFTW = False
+_fftw_plans = {}
+
+def denss_cache_dir():
+    """Return the directory DENSS uses for cached files, e.g. FFTW wisdom.
 
+    Uses $DENSS_CACHE_DIR if set, otherwise $XDG_CACHE_HOME/denss or ~/.cache/denss.
+    """
+    cache_dir = os.environ.get("DENSS_CACHE_DIR")
+    if not cache_dir:
+        cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+        cache_dir = os.path.join(cache_home, "denss")
+    return cache_dir
+
+def fftw_wisdom_file():
+    """Return the path of the file storing FFTW wisdom."""
+    return os.path.join(denss_cache_dir(), "fftw_wisdom.pickle")
+
+def load_fftw_wisdom():
+    """Import previously saved FFTW wisdom, if there is any."""
+    try:
+        with open(fftw_wisdom_file(), "rb") as the_file:
+            pyfftw.import_wisdom(pickle.load(the_file))
+        return True
+    except Exception:
+        #no wisdom yet, or unreadable. FFTW will just plan from scratch.
+        return False
+
+def save_fftw_wisdom():
+    """Save the current FFTW wisdom to the user cache directory."""
+    fname = fftw_wisdom_file()
+    try:
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        #write to a temporary file first so that parallel runs
+        #never read a partially written wisdom file
+        tmpname = "%s.%i.tmp" % (fname, os.getpid())
+        with open(tmpname, "wb") as the_file:
+            pickle.dump(pyfftw.export_wisdom(), the_file)
+        os.replace(tmpname, fname)
+        return True
+    except Exception:
+        return False
+
+def get_fft_threads():
+    """Return the number of threads used per CPU transform."""
+    if FFT_THREADS is None or FFT_THREADS < 1:
+        return multiprocessing.cpu_count()
+    return FFT_THREADS
+
+def set_fft_backend(backend="scipy", threads=None, my_logger=logging.getLogger()):
+    """Select the library used for CPU Fourier transforms.
+
+    backend - "scipy", "pyfftw" or "numpy". If the requested library cannot be
+              used, falls back to scipy, and then to numpy.
+    threads - number of threads per transform (None or -1 for all cores).
+              numpy is always single threaded.
+
+    Returns the name of the backend actually in use.
+    """
+    global FFT_BACKEND, FFT_THREADS, PYFFTW, pyfftw
+    if backend is None:
+        backend = "scipy"
+    backend = backend.lower()
+    if backend not in FFT_BACKENDS:
+        my_logger.warning("Unknown FFT backend %s, using scipy", backend)
+        backend = "scipy"
+    if threads is None:
+        threads = -1
+    if backend == "pyfftw":
+        try:
+            import pyfftw
+            import pyfftw.builders
+            load_fftw_wisdom()
+        except ImportError:
+            my_logger.warning("pyFFTW could not be imported, using scipy for FFTs")
+            backend = "scipy"
+    if backend == "scipy":
+        try:
+            fft.rfftn(np.zeros((2,2,2)), workers=1)
+        except Exception:
+            my_logger.warning("scipy.fft is not available, using numpy for FFTs")
+            backend = "numpy"
+    if backend != FFT_BACKEND or threads != FFT_THREADS:
+        _fftw_plans.clear()
+    FFT_BACKEND = backend
+    FFT_THREADS = threads
+    PYFFTW = backend == "pyfftw"
+    return backend
+
+def _fftw(kind, x, axes=None):
+    """Run x through a cached pyFFTW plan for the given numpy.fft function name."""
+    x = np.asarray(x)
+    if axes is not None:
+        axes = tuple(axes)
+    key = (kind, x.shape, x.dtype.str, axes)
+    plan = _fftw_plans.get(key)
+    if plan is None:
+        builder = getattr(pyfftw.builders, kind)
+        plan = builder(pyfftw.empty_aligned(x.shape, dtype=x.dtype), axes=axes,
+            threads=get_fft_threads(), planner_effort="FFTW_MEASURE")
+        _fftw_plans[key] = plan
+        save_fftw_wisdom()
+    #the plan copies x into its own input array, so x is left untouched.
+    #the output array is reused by the next call, so return a copy.
+    return plan(x).copy()
+
+def _cpu_fft(kind, x, axes=None):
+    """Calculate an FFT of x on the CPU with the selected backend."""
+    if FFT_BACKEND == "pyfftw":
+        try:
+            return _fftw(kind, x, axes)
+        except Exception:
+            #fall back to scipy if FFTW fails for this array
+            pass
+    if FFT_BACKEND != "numpy":
+        try:
+            #try running the parallelized version of scipy fft
+            return getattr(fft, kind)(x, axes=axes, workers=FFT_THREADS)
+        except Exception:
+            pass
+    #fall back to numpy
+    return getattr(np.fft, kind)(x, axes=axes)
 
-def myfftn(x, DENSS_GPU=False):
+def myfftn(x, DENSS_GPU=False, axes=None):
     if DENSS_GPU:
-        return cp.fft.fftn(x)
+        return cp.fft.fftn(x, axes=axes)
     else:
-        if PYFFTW:
-            return pyfftw.interfaces.numpy_fft.fftn(x)
-        else:
-            try:
-                #try running the parallelized version of scipy fft
-                return fft.fftn(x,workers=-1)
-            except:
-                #fall back to numpy
-                return np.fft.fftn(x)
+        return _cpu_fft("fftn", x, axes)
 
-def myrfftn(x, DENSS_GPU=False):
+def myrfftn(x, DENSS_GPU=False, axes=None):
     if DENSS_GPU:
-        return cp.fft.rfftn(x)
+        return cp.fft.rfftn(x, axes=axes)
     else:
-        if PYFFTW:
-            return pyfftw.interfaces.numpy_fft.rfftn(x)
-        else:
-            try:
-                #try running the parallelized version of scipy fft
-                return fft.rfftn(x,workers=-1)
-            except:
-                #fall back to numpy
-                return np.fft.rfftn(x)
+        return _cpu_fft("rfftn", x, axes)
 
-def myifftn(x, DENSS_GPU=False):
+def myifftn(x, DENSS_GPU=False, axes=None):
     if DENSS_GPU:
-        return cp.fft.ifftn(x)
+        return cp.fft.ifftn(x, axes=axes)
     else:
-        if PYFFTW:
-            return pyfftw.interfaces.numpy_fft.ifftn(x)
-        else:
-            try:
-                #try running the parallelized version of scipy fft
-                return fft.ifftn(x,workers=-1)
-            except:
-                #fall back to numpy
-                return np.fft.ifftn(x)
+        return _cpu_fft("ifftn", x, axes)
 
-def myirfftn(x, DENSS_GPU=False):
+def myirfftn(x, DENSS_GPU=False, axes=None):
     if DENSS_GPU:
-        return cp.fft.irfftn(x)
+        return cp.fft.irfftn(x, axes=axes)
     else:
-        if PYFFTW:
-            return pyfftw.interfaces.numpy_fft.irfftn(x)
-        else:
-            try:
-                #try running the parallelized version of scipy fft
-                return fft.irfftn(x,workers=-1)
-            except:
-                #fall back to numpy
-                return np.fft.irfftn(x)
+        return _cpu_fft("irfftn", x, axes)
 
 def myabs(x, out=None,DENSS_GPU=False):
     if DENSS_GPU:
@@ -256,7 +346,7 @@ def rho2rg(rho,side=None,r=None,support=None,dx=None):
     if side is not None and r is None:
         n = rho.shape[0]
         x_ = np.linspace(-side/2.,side/2.,n)
-        x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
+        x,y,z = np.meshgrid(x_,x_,x_,indexing='ij',sparse=True)
         r = np.sqrt(x**2 + y**2 + z**2)
     if support is None:
         support = np.ones_like(rho,dtype=bool)
@@ -264,93 +354,210 @@ def rho2rg(rho,side=None,r=None,support=None,dx=None):
         print("Error: To calculate Rg, must provide dx")
         sys.exit()
     gridcenter = (np.array(rho.shape)-1.)/2.
-    com = np.array(ndimage.measurements.center_of_mass(np.abs(rho)))
+    com = center_of_mass(rho)
     rhocom = (gridcenter-com)*dx
     rg2 = np.sum(r[support]**2*rho[support])/np.sum(rho[support])
     rg2 = rg2 - np.linalg.norm(rhocom)**2
     rg = np.sign(rg2)*np.abs(rg2)**0.5
     return rg
 
-def write_mrc(rho,side,filename="map.mrc"):
-    """Write an MRC formatted electron density map.
-       See here: http://www2.mrc-lmb.cam.ac.uk/research/locally-developed-software/image-processing-software/#image
-    """
+#numpy dtypes of the MRC data modes that can be read
+MRC_MODES = {
+    0: np.int8,
+    1: np.int16,
+    2: np.float32,
+    12: np.float16,
+    }
+
+def mrc_header(rho,side):
+    """Return the 1024 byte header of an MRC file for the given map."""
     xs, ys, zs = rho.shape
     nxstart = -xs//2+1
     nystart = -ys//2+1
     nzstart = -zs//2+1
     side = np.atleast_1d(side)
     if len(side) == 1:
-        a,b,c = side, side, side
+        a,b,c = side[0], side[0], side[0]
     elif len(side) == 3:
         a,b,c = side
     else:
         print("Error. Argument 'side' must be float or 3-tuple")
-    with open(filename, "wb") as fout:
+    header = [
         # NC, NR, NS, MODE = 2 (image : 32-bit reals)
-        fout.write(struct.pack('<iiii', xs, ys, zs, 2))
+        struct.pack('<iiii', xs, ys, zs, 2),
         # NCSTART, NRSTART, NSSTART
-        fout.write(struct.pack('<iii', nxstart, nystart, nzstart))
+        struct.pack('<iii', nxstart, nystart, nzstart),
         # MX, MY, MZ
-        fout.write(struct.pack('<iii', xs, ys, zs))
+        struct.pack('<iii', xs, ys, zs),
         # X length, Y, length, Z length
-        fout.write(struct.pack('<fff', a, b, c))
+        struct.pack('<fff', a, b, c),
         # Alpha, Beta, Gamma
-        fout.write(struct.pack('<fff', 90.0, 90.0, 90.0))
+        struct.pack('<fff', 90.0, 90.0, 90.0),
         # MAPC, MAPR, MAPS
-        fout.write(struct.pack('<iii', 1, 2, 3))
+        struct.pack('<iii', 1, 2, 3),
         # DMIN, DMAX, DMEAN
-        fout.write(struct.pack('<fff', np.min(rho), np.max(rho), np.average(rho)))
-        # ISPG, NSYMBT, mlLSKFLG
-        fout.write(struct.pack('<iii', 1, 0, 0))
+        struct.pack('<fff', np.min(rho), np.max(rho), np.average(rho)),
+        # ISPG, NSYMBT, mlLSKFLG
+        struct.pack('<iii', 1, 0, 0),
         # EXTRA
-        fout.write(struct.pack('<'+'f'*12, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0))
-        for i in range(0, 12):
-            fout.write(struct.pack('<f', 0.0))
-
+        struct.pack('<'+'f'*12, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0),
+        struct.pack('<'+'f'*12, *[0.0]*12),
         # XORIGIN, YORIGIN, ZORIGIN
-        fout.write(struct.pack('<fff', 0.,0.,0. )) #nxstart*(a/xs), nystart*(b/ys), nzstart*(c/zs) ))
+        struct.pack('<fff', 0.,0.,0. ), #nxstart*(a/xs), nystart*(b/ys), nzstart*(c/zs) ))
         # MAP
-        fout.write('MAP '.encode())
+        'MAP '.encode(),
         # MACHST (little endian)
-        fout.write(struct.pack('<BBBB', 0x44, 0x41, 0x00, 0x00))
+        struct.pack('<BBBB', 0x44, 0x41, 0x00, 0x00),
         # RMS (std)
-        fout.write(struct.pack('<f', np.std(rho)))
+        struct.pack('<f', np.std(rho)),
         # NLABL
-        fout.write(struct.pack('<i', 0))
+        struct.pack('<i', 0),
         # LABEL(20,10) 10 80-character text labels
-        for i in range(0, 800):
-            fout.write(struct.pack('<B', 0x00))
+        bytes(bytearray(800)),
+        ]
+    return b''.join(header)
 
-        # Write out data
-        s = struct.pack('=%sf' % rho.size, *rho.flatten('F'))
-        fout.write(s)
+def write_mrc(rho,side,filename="map.mrc"):
+    """Write an MRC formatted electron density map.
+       See here: http://www2.mrc-lmb.cam.ac.uk/research/locally-developed-software/image-processing-software/#image
+    """
+    header = mrc_header(rho,side)
+    with open(filename, "wb") as fout:
+        fout.write(header)
+        # Write out data, x fastest (i.e. the transpose in C order)
+        fout.write(np.asarray(rho, dtype='<f4').T.tobytes())
 
 def read_mrc(filename="map.mrc",returnABC=False,float64=True):
     """
         See MRC format at http://bio3d.colorado.edu/imod/doc/mrc_format.txt for offsets
+
+        The data block is memory mapped rather than read. Unless float64 is True,
+        a float32 (MODE 2) map is returned as a lazy copy-on-write view of the file.
     """
     with open(filename, 'rb') as fin:
-        MRCdata=fin.read()
-        nx = struct.unpack_from('<i',MRCdata, 0)[0]
-        ny = struct.unpack_from('<i',MRCdata, 4)[0]
-        nz = struct.unpack_from('<i',MRCdata, 8)[0]
-
-        #side = struct.unpack_from('<f',MRCdata,40)[0]
-        a, b, c = struct.unpack_from('<fff',MRCdata,40)
-        side = a
-
-        #header is 1024 bytes long. To read data, skip ahead to that point in the file
-        fin.seek(1024, os.SEEK_SET)
-        rho = np.fromfile(file=fin, dtype=np.dtype(np.float32)).reshape((nx,ny,nz),order='F')
-        fin.close()
+        header = fin.read(1024)
+    #MACHST gives the byte order of the file
+    if header[212:214] == b'\x11\x11':
+        endian = '>'
+    else:
+        endian = '<'
+    nx, ny, nz, mode = struct.unpack_from(endian+'iiii',header, 0)
+
+    #side = struct.unpack_from('<f',MRCdata,40)[0]
+    a, b, c = struct.unpack_from(endian+'fff',header,40)
+    side = a
+
+    #data follows the 1024 byte header and any extended header (NSYMBT bytes)
+    nsymbt = struct.unpack_from(endian+'i',header,92)[0]
+    if mode not in MRC_MODES:
+        raise ValueError("MRC mode %i not supported (supported modes: %s)" % (mode, sorted(MRC_MODES)))
+    dtype = np.dtype(MRC_MODES[mode]).newbyteorder(endian)
+    rho = np.memmap(filename, dtype=dtype, mode='c', offset=1024+nsymbt, shape=(nx,ny,nz), order='F')
     if float64:
-        rho = rho.astype(np.float64)
+        rho = np.array(rho, dtype=np.float64)
+    else:
+        rho = np.asarray(rho, dtype=np.float32)
     if returnABC:
         return rho, (a,b,c)
     else:
         return rho, side
 
+class AsyncMapWriter(object):
+    """Write maps to disk on a background thread.
+
+    Maps are copied when submitted, so the caller may keep modifying them.
+    The queue is bounded, so submitting blocks when the writer falls behind.
+    Coalesced writes (e.g. the _current maps written during refinement) keep
+    only the newest snapshot of each file that has not been written yet.
+
+    maxsize - maximum number of writes waiting in the queue
+    """
+    def __init__(self, maxsize=8):
+        self.queue = queue.Queue(maxsize)
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.error = None
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                coalesced, job = item
+                if coalesced:
+                    with self.lock:
+                        job = self.pending.pop(job)
+                func, args = job
+                func(*args)
+            except Exception as e:
+                #keep the first error, which is usually the cause of any later ones
+                if self.error is None:
+                    self.error = e
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func, args, filename, coalesce=False):
+        """Queue func(*args), which writes filename."""
+        if not self.thread.is_alive():
+            raise RuntimeError("map writer has been closed")
+        if coalesce:
+            with self.lock:
+                queued = filename in self.pending
+                self.pending[filename] = (func, args)
+            #an older snapshot is still waiting, it has just been replaced
+            if not queued:
+                self.queue.put((True, filename))
+        else:
+            self.queue.put((False, (func, args)))
+
+    def write_mrc(self, rho, side, filename="map.mrc", coalesce=False, copy=True):
+        """Queue write_mrc(rho, side, filename). Set copy=False if rho will not be modified."""
+        if copy:
+            rho = np.array(rho)
+        self.submit(write_mrc, (rho, side, filename), filename, coalesce)
+
+    def write_xplor(self, rho, side, filename="map.xplor", coalesce=False, copy=True):
+        """Queue write_xplor(rho, side, filename). Set copy=False if rho will not be modified."""
+        if copy:
+            rho = np.array(rho)
+        self.submit(write_xplor, (rho, side, filename), filename, coalesce)
+
+    def flush(self):
+        """Wait until all queued maps are written. Raises the first error hit while writing."""
+        self.queue.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def close(self):
+        """Write all queued maps and stop the background thread."""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+_map_writer = None
+
+def get_map_writer():
+    """Return the shared AsyncMapWriter, which is flushed when the interpreter exits."""
+    global _map_writer
+    if _map_writer is None or not _map_writer.thread.is_alive():
+        _map_writer = AsyncMapWriter()
+        atexit.register(_map_writer.close)
+    return _map_writer
+
 def write_xplor(rho,side,filename="map.xplor"):
     """Write an XPLOR formatted electron density map."""
     xs, ys, zs = rho.shape
@@ -1096,23 +1303,877 @@ def filter_P(r,P,sigr=None,qmax=0.5,cutoff=0.75,qmin=0.0,cutoffmin=1.25):
         else:
             return r, Pfilt
 
+def _readonly(a):
+    """Mark a numpy array as read-only and return it."""
+    a = np.asarray(a)
+    a.flags.writeable = False
+    return a
+
+def shell_label_dtype(nlabels):
+    """Smallest integer type for labeling nlabels q shells."""
+    if nlabels <= np.iinfo(np.uint16).max + 1:
+        return np.dtype(np.uint16)
+    return np.dtype(np.int32)
+
+class Grid(object):
+    """Real and reciprocal space sampling of a cubic box of n^3 voxels.
+
+    Use get_grid() rather than creating a Grid directly so that grids are
+    shared between calls. All arrays are read-only. The dense x, y, z and
+    qx, qy, qz meshgrids are only built when first used, and most callers
+    only need the sparse grids from xyz_grids(sparse=True), which take n
+    rather than n^3 values each.
+
+    n - number of samples along each dimension
+    side - width of the box in angstroms
+    rfft - if True (default) the reciprocal space arrays cover the half grid
+           returned by rfftn, otherwise the full grid returned by fftn
+    arrays - dictionary of the arrays named in Grid.array_names, already calculated,
+             for example memory mapped from a cache on disk (optional)
+    """
+    array_names = ["qr", "qbin_labels", "xcount", "qbins", "qbinsc"]
+
+    def __init__(self, n, side, rfft=True, arrays=None):
+        self.n = int(n)
+        self.side = float(side)
+        self.rfft = bool(rfft)
+        self.halfside = self.side/2
+        self.dx = self.side/self.n
+        self.dV = self.dx**3
+        self.V = self.side**3
+        self.df = 1/self.side
+        self.x_ = _readonly(np.linspace(-self.halfside,self.halfside,self.n))
+        self.qx_ = _readonly(np.fft.fftfreq(self.n)*self.n*self.df*2*np.pi)
+        if self.rfft:
+            self.qz_ = _readonly(np.fft.rfftfreq(self.n)*self.n*self.df*2*np.pi)
+        else:
+            self.qz_ = self.qx_
+        if arrays is None:
+            arrays = self.calc_arrays()
+        for name in Grid.array_names:
+            setattr(self, name, _readonly(arrays[name]))
+        #grids cached on disk by older versions have int64 labels
+        label_dtype = shell_label_dtype(len(self.xcount))
+        if self.qbin_labels.dtype != label_dtype:
+            self.qbin_labels = _readonly(self.qbin_labels.astype(label_dtype))
+        self.qblravel = self.qbin_labels.ravel()
+        self.nbins = len(self.qbins) - 1
+        self.qstep = self.qbins[1]
+        self.qmax = self.qr.max()
+        self._xyz = None
+        self._qxyz = None
+        self._r = None
+
+    def calc_arrays(self):
+        """Calculate the q magnitudes and q shell of each reciprocal space voxel."""
+        qx_, qz_ = self.qx_, self.qz_
+        #same as sqrt(qx**2+qy**2+qz**2) of the meshgrids, without making them
+        qr = np.sqrt(qx_[:,None,None]**2 + qx_[None,:,None]**2 + qz_[None,None,:]**2)
+        qmax = np.max(qr)
+        qstep = np.min(qr[qr>0]) - 1e-8 #subtract a tiny bit to deal with floating point error
+        nbins = int(qmax/qstep)
+        qbins = np.linspace(0,nbins*qstep,nbins+1)
+        #create an array labeling each voxel according to which qbin it belongs
+        qbin_labels = np.searchsorted(qbins,qr,"right")
+        qbin_labels -= 1
+        #the labels are read every step, so store them as compactly as possible
+        qbin_labels = qbin_labels.astype(shell_label_dtype(qbin_labels.max()+1))
+        qblravel = qbin_labels.ravel()
+        xcount = np.bincount(qblravel)
+        #calculate qbinsc as average of q values in shell
+        qbinsc = mybinmean(qr.ravel(), qblravel, xcount)
+        return {"qr": qr, "qbin_labels": qbin_labels, "xcount": xcount,
+            "qbins": qbins, "qbinsc": qbinsc}
+
+    def binsum(self, x):
+        """Sum x over each q shell.
+
+        x - array with the shape of the reciprocal space grid
+        """
+        return np.bincount(self.qblravel, weights=np.ravel(x), minlength=len(self.xcount))
+
+    def binmean(self, x):
+        """Average x over each q shell, e.g. the spherical average of |F|^2."""
+        return self.binsum(x)/self.xcount
+
+    @property
+    def x(self):
+        return self.xyz_grids()[0]
+
+    @property
+    def y(self):
+        return self.xyz_grids()[1]
+
+    @property
+    def z(self):
+        return self.xyz_grids()[2]
+
+    @property
+    def qx(self):
+        return self.qxyz_grids()[0]
+
+    @property
+    def qy(self):
+        return self.qxyz_grids()[1]
+
+    @property
+    def qz(self):
+        return self.qxyz_grids()[2]
+
+    @property
+    def r(self):
+        """Distance of each real space voxel from the center of the box."""
+        if self._r is None:
+            x_ = self.x_
+            self._r = _readonly(np.sqrt(x_[:,None,None]**2 + x_[None,:,None]**2 + x_[None,None,:]**2))
+        return self._r
+
+    def xyz_grids(self, sparse=False):
+        """Dense x, y, z real space meshgrids.
+
+        sparse - if True return open grids of shapes (n,1,1), (1,n,1) and (1,1,n)
+                 that broadcast against each other, without making the dense grids
+        """
+        if sparse:
+            return [_readonly(a) for a in np.meshgrid(self.x_,self.x_,self.x_,indexing='ij',sparse=True)]
+        if self._xyz is None:
+            self._xyz = [_readonly(a) for a in np.meshgrid(self.x_,self.x_,self.x_,indexing='ij')]
+        return self._xyz
+
+    def qxyz_grids(self, sparse=False):
+        """Dense qx, qy, qz reciprocal space meshgrids.
+
+        sparse - if True return open grids that broadcast against each other
+        """
+        if sparse:
+            return [_readonly(a) for a in np.meshgrid(self.qx_,self.qx_,self.qz_,indexing='ij',sparse=True)]
+        if self._qxyz is None:
+            self._qxyz = [_readonly(a) for a in np.meshgrid(self.qx_,self.qx_,self.qz_,indexing='ij')]
+        return self._qxyz
+
+#grids handed out by get_grid(), least recently used first
+GRID_CACHE_SIZE = 8
+_grid_cache = OrderedDict()
+
+def get_grid(n, side, rfft=True, cache_dir=None):
+    """Return the Grid for an n x n x n box of width side.
+
+    Grids are kept in an in-process cache of the GRID_CACHE_SIZE most
+    recently used grids. If cache_dir is given the grid arrays are also
+    stored there, as one .npy file per array, and memory mapped read-only
+    by later calls, including from other processes.
+
+    n - number of samples along each dimension
+    side - width of the box in angstroms
+    rfft - half (rfftn) reciprocal space grid rather than full (fftn) grid
+    cache_dir - directory for the on-disk grid cache (optional)
+    """
+    key = (int(n), float(side), bool(rfft))
+    grid = _grid_cache.pop(key, None)
+    if grid is None:
+        arrays = None
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, "grid_%i_%r_%s" % (key[0], key[1], "rfft" if rfft else "fft"))
+            arrays = _load_grid_arrays(path)
+        grid = Grid(*key, arrays=arrays)
+        if cache_dir is not None and arrays is None:
+            _save_grid_arrays(grid, path)
+    _grid_cache[key] = grid
+    while len(_grid_cache) > GRID_CACHE_SIZE:
+        _grid_cache.popitem(last=False)
+    return grid
+
+def _load_grid_arrays(path):
+    """Memory map the arrays of a grid saved in path, or return None."""
+    if not os.path.isdir(path):
+        return None
+    try:
+        return dict((name, np.load(os.path.join(path, name+".npy"), mmap_mode="r"))
+            for name in Grid.array_names)
+    except Exception:
+        return None
+
+def _save_grid_arrays(grid, path):
+    """Save the arrays of a grid to path, ignoring any failure."""
+    #write to a temporary directory first, so that other processes
+    #never see a partially written grid
+    tmppath = "%s.%i.tmp" % (path, os.getpid())
+    try:
+        if not os.path.isdir(tmppath):
+            os.makedirs(tmppath)
+        for name in Grid.array_names:
+            np.save(os.path.join(tmppath, name+".npy"), getattr(grid, name))
+        os.rename(tmppath, path)
+    except Exception:
+        #most likely another process saved the same grid first
+        shutil.rmtree(tmppath, ignore_errors=True)
+
+#wall clock used for profiling
+_timer = getattr(time, "perf_counter", time.time)
+
+class PhaseProfiler(object):
+    """Cumulative wall time and number of calls for each phase of a denss run.
+
+    Each phase is timed between start(name) and stop(name). If tracemalloc
+    is tracing, the net number of bytes allocated in each phase is recorded
+    as well. When disabled, start and stop return immediately. Phases run on
+    the GPU are timed as launched, not as completed.
+
+    enabled - boolean, whether or not to record anything
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stats = OrderedDict()
+        self._started = {}
+
+    def start(self, name):
+        if not self.enabled:
+            return
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            mem = tracemalloc.get_traced_memory()[0]
+        else:
+            mem = None
+        self._started[name] = (_timer(), mem)
+
+    def stop(self, name):
+        if not self.enabled:
+            return
+        t0, mem = self._started.pop(name)
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = self.stats[name] = {"time": 0.0, "calls": 0}
+        stat["time"] += _timer() - t0
+        stat["calls"] += 1
+        if mem is not None:
+            stat["bytes"] = stat.get("bytes", 0) + tracemalloc.get_traced_memory()[0] - mem
+
+    def merge(self, stats):
+        """Add the statistics of another profiler (or its stats dictionary) to this one."""
+        if isinstance(stats, PhaseProfiler):
+            stats = stats.stats
+        for name, other in stats.items():
+            stat = self.stats.setdefault(name, {"time": 0.0, "calls": 0})
+            for key, value in other.items():
+                stat[key] = stat.get(key, 0) + value
+
+    def log(self, my_logger=logging.getLogger(), title="phase"):
+        """Write a table of the phases to the log, slowest first, and their total.
+
+        title - heading of the first column, to tell tables of different
+                profilers apart. Fractions are of the total of this table.
+        """
+        total = sum(stat["time"] for stat in self.stats.values())
+        my_logger.info('Profile: %-22s   time (s)   fraction      calls', title)
+        for name, stat in sorted(self.stats.items(), key=lambda item: -item[1]["time"]):
+            my_logger.info('Profile: %-22s % 10.3f % 10.3f % 10i', name, stat["time"],
+                stat["time"]/total if total > 0 else 0.0, stat["calls"])
+        my_logger.info('Profile: %-22s % 10.3f', 'total', total)
+
+    def save(self, filename, **info):
+        """Write the statistics (plus any extra info) to a JSON file."""
+        with open(filename, "w") as f:
+            f.write(str(json.dumps(dict(info, phases=self.stats), indent=2)))
+
+def profiling_enabled(profile=None):
+    """Whether to profile denss runs: profile if given, otherwise the DENSS_PROFILE environment variable."""
+    if profile is not None:
+        return bool(profile)
+    return os.environ.get("DENSS_PROFILE", "0").lower() not in ("", "0", "false", "no", "off")
+
+CONVERGENCE_TESTS = ["chi", "adaptive"]
+
+class ConvergenceMonitor(object):
+    """Decide when a denss map has stopped changing, and record why.
+
+    The statistics of each step are passed to update(). check() then tests
+    the last window steps:
+
+    chi      - the standard deviation of chi2 is less than chi_end_fraction
+               of its mean (the test denss has always used)
+    adaptive - the chi test, or a plateau: once the shrinkwrap sigma has
+               reached its floor, the chi2 of the best scaled fit to the data,
+               Rg and the support volume have all stopped moving. Each is
+               the change between the medians of the two halves of the
+               window, relative to the first half, which is not thrown by
+               the odd outlying step.
+
+    steps - maximum number of steps of the run
+    test - "chi" or "adaptive"
+    chi_end_fraction - threshold of the chi test
+    tol - largest relative change over the window of a plateau
+    window - number of steps to judge convergence on
+    """
+    def __init__(self, steps, test="chi", chi_end_fraction=0.01, tol=0.005, window=100):
+        if test not in CONVERGENCE_TESTS:
+            raise ValueError("convergence must be one of %s, not %s" % (", ".join(CONVERGENCE_TESTS), test))
+        self.test = test
+        self.chi_end_fraction = chi_end_fraction
+        self.tol = tol
+        self.window = int(window)
+        #chi2, chi2 of the scaled fit, Rg and support volume at each step
+        self.history = np.zeros((4, steps+1))
+        #first step at which a plateau could be looked for
+        self.settled = -1
+        self.reason = None
+
+    @property
+    def adaptive(self):
+        return self.test == "adaptive"
+
+    def update(self, step, chi, rg, supportV, fit_chi=0.0):
+        """Record the statistics of a step."""
+        self.history[:,step] = float(chi), float(fit_chi), float(rg), float(supportV)
+
+    def changes(self, step):
+        """Relative change of the median of each statistic between the halves of the window up to step."""
+        half = self.window//2
+        first = np.median(self.history[:,step-2*half+1:step-half+1], axis=1)
+        second = np.median(self.history[:,step-half+1:step+1], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (second-first)/np.abs(first)
+
+    def volume_stable(self, step):
+        """Whether the support volume has stopped moving over the window up to step."""
+        return step >= self.window and abs(self.changes(step)[3]) < self.tol
+
+    def check(self, step, plateau=True):
+        """Return the reason the map has converged at step, or None.
+
+        Only call once at least window steps have been run. plateau - whether
+        the map may have settled at this step, e.g. shrinkwrap has reached its
+        smallest sigma and the map was not recentered. The adaptive test only
+        looks for a plateau over a window of steps that have all settled.
+        """
+        chi = self.history[0,step-self.window:step]
+        std, mean = np.std(chi), np.mean(chi)
+        if std < self.chi_end_fraction * mean:
+            self.reason = ("the standard deviation of chi2 over the last %i steps is %.2e of its mean"
+                % (self.window, std/mean))
+            return self.reason
+        if not plateau:
+            self.settled = -1
+        elif self.settled < 0:
+            self.settled = step
+        if self.adaptive and plateau and step >= self.settled + self.window:
+            dchi, dfit, drg, dV = self.changes(step)
+            if abs(dfit) < self.tol and abs(drg) < self.tol and abs(dV) < self.tol:
+                self.reason = ("plateau, over the last %i steps the fitted chi2 changed by %.1e, Rg by %.1e "
+                    "and the support volume by %.1e" % (self.window, dfit, drg, dV))
+                return self.reason
+        return None
+
+class EnsembleCuller(object):
+    """Spot maps whose trajectories are outliers among many runs on the same data.
+
+    Each run reports its chi2, Rg and support volume every so often (see the
+    progress_queue argument of denss()). A run is an outlier at a step when
+    its chi2 is too high, or its Rg or support volume too far from the other
+    runs at the same step. Distance is measured by a modified z-score: the
+    difference from the median of the other runs over their median absolute
+    deviation. Chi2 is taken on a log scale, since its scale varies a lot
+    between runs. A run should be culled once it has been an outlier at
+    persist reports in a row.
+
+    minstep - first step to judge runs at. The supports of good runs vary a lot
+              until the shrinkwrap schedule is finished (see shrinkwrap_schedule_steps).
+    threshold - modified z-score beyond which a run is an outlier
+    persist - number of reports in a row a run must be an outlier to be culled
+    min_runs - number of other runs needed at a step to judge a run against them
+    floor - smallest median absolute deviation, as a fraction of the median,
+            so that a tight ensemble does not make tiny differences look large
+    """
+    def __init__(self, minstep=0, threshold=6.0, persist=3, min_runs=8, floor=0.01):
+        self.minstep = minstep
+        self.threshold = threshold
+        self.persist = persist
+        self.min_runs = min_runs
+        self.floor = floor
+        #statistics of each step, as {step: {run: (log chi2, Rg, support volume)}}
+        self.reports = {}
+        #number of reports in a row each run has been an outlier
+        self.strikes = {}
+        self.culled = set()
+
+    def zscores(self, run, step):
+        """Modified z-scores of the log chi2, Rg and support volume of run against the other runs at step, or None."""
+        others = [stats for other, stats in self.reports[step].items() if other != run and other not in self.culled]
+        if len(others) < self.min_runs:
+            return None
+        others = np.array(others)
+        median = np.median(others, axis=0)
+        mad = np.median(np.abs(others - median), axis=0)
+        mad = np.maximum(mad, self.floor*np.abs(median))
+        mad[mad == 0] = np.inf
+        return 0.6745*(np.array(self.reports[step][run]) - median)/mad
+
+    def add(self, run, step, chi, rg, supportV):
+        """Record a report from run, and return the reason to cull it, or None.
+
+        run - any hashable label of the run, which should not be reused by a replacement
+        """
+        if run in self.culled:
+            return None
+        self.reports.setdefault(step, {})[run] = (np.log(max(chi, 1e-300)), rg, supportV)
+        if step < self.minstep:
+            return None
+        z = self.zscores(run, step)
+        if z is None:
+            return None
+        #only a high chi2 is bad, but Rg and the support volume can be off either way
+        if z[0] > self.threshold or abs(z[1]) > self.threshold or abs(z[2]) > self.threshold:
+            self.strikes[run] = self.strikes.get(run, 0) + 1
+        else:
+            self.strikes[run] = 0
+        if self.strikes[run] < self.persist:
+            return None
+        return ("outlier for %i reports, modified z-scores of chi2 %.1f, Rg %.1f, support volume %.1f"
+            % (self.strikes[run], z[0], z[1], z[2]))
+
+    def cull(self, run):
+        """Mark run as culled, so that it no longer counts towards the ensemble."""
+        self.culled.add(run)
+
+def fitted_chi2(Imean, Idata, sigq):
+    """chi2 of Imean against Idata after scaling Imean to best fit the data. Works with numpy or cupy arrays."""
+    w = 1/sigq**2
+    sf = (Imean*Idata*w).sum()/(Imean*Imean*w).sum()
+    return ((sf*Imean-Idata)**2*w).sum()/Idata.size
+
+#use the fused numba kernels for the reciprocal space step of denss when numba
+#is available. They give identical results to the numpy code, in fewer passes over F.
+NUMBA_KERNELS = numba
+
+def shell_sums_numpy(F, qbin_labels, nbins, tiny=1e-32):
+    """Sum |F|^2 over the q shells, one slab of F at a time.
+
+    Structure factors that are exactly zero are set to 1e-16 in place, and
+    contribute tiny to the sums. The slab by slab order of the sums is the
+    one used by shell_sums_numba, so the two give identical results.
+
+    F - complex reciprocal space grid
+    qbin_labels - q shell of each voxel of F
+    nbins - number of q shells
+    """
+    sums = np.zeros(nbins)
+    for i in range(F.shape[0]):
+        I = F[i].real*F[i].real
+        I += F[i].imag*F[i].imag
+        zeros = (I == 0)
+        if zeros.any():
+            F[i][zeros] = 1e-16
+            I[zeros] = tiny
+        sums += np.bincount(qbin_labels[i].ravel(), I.ravel(), minlength=nbins)
+    return sums
+
+def scale_shells_numpy(F, qbin_labels, factors):
+    """Multiply F in place by the factor of the q shell of each voxel."""
+    F *= np.take(factors, qbin_labels)
+    return F
+
+if numba:
+    @nb.njit(parallel=True,cache=True)
+    def shell_sums_numba(F, qbin_labels, nbins, tiny):
+        """Sum |F|^2 over the q shells in a single pass over F.
+
+        Each slab of F is summed into its own row, so the result does not
+        depend on the number of threads. See shell_sums_numpy.
+        """
+        n = F.shape[0]
+        partial = np.zeros((n, nbins))
+        for i in nb.prange(n):
+            for j in range(F.shape[1]):
+                for k in range(F.shape[2]):
+                    re = F[i,j,k].real
+                    im = F[i,j,k].imag
+                    I = re*re + im*im
+                    if I == 0:
+                        F[i,j,k] = 1e-16
+                        I = tiny
+                    partial[i,qbin_labels[i,j,k]] += I
+        sums = np.zeros(nbins)
+        for i in range(n):
+            sums += partial[i]
+        return sums
+
+    @nb.njit(parallel=True,cache=True)
+    def scale_shells_numba(F, qbin_labels, factors):
+        """Multiply F in place by the factor of the q shell of each voxel."""
+        for i in nb.prange(F.shape[0]):
+            for j in range(F.shape[1]):
+                for k in range(F.shape[2]):
+                    F[i,j,k] *= factors[qbin_labels[i,j,k]]
+        return F
+
+class DenssWorkspace(object):
+    """Preallocated buffers for the denss() reconstruction loop.
+
+    A workspace owns every grid sized array used by a step of the loop so
+    that the iterations themselves do not allocate new grids. With the pyfftw
+    backend the FFTs also run between workspace buffers, through FFTW plans
+    made for them. scipy.fft and numpy have no out= argument, so with those
+    backends (and on the GPU) each FFT still returns a newly allocated grid.
+    Create it once per run, or once per worker process and pass it to
+    consecutive denss() calls on the same grid, in which case the buffers are
+    reused rather than reallocated.
+
+    The grids are stacked along a first axis with one slot per map, so that
+    denss_batch() can transform several maps at once.
+
+    n - number of samples along each dimension of the real space grid (optional,
+        buffers are allocated on the first call to allocate() otherwise)
+    dtype - real data type of the buffers (default np.float64)
+    DENSS_GPU - allocate the buffers on the GPU using CuPy
+    nbatch - number of maps held in the workspace (default 1)
+    """
+    def __init__(self, n=None, dtype=np.float64, DENSS_GPU=False, nbatch=1):
+        self.n = None
+        self.dtype = None
+        self.DENSS_GPU = None
+        self.nbatch = None
+        self.fftw = None
+        if n is not None:
+            self.allocate(n, dtype=dtype, DENSS_GPU=DENSS_GPU, nbatch=nbatch)
+
+    def allocate(self, n, dtype=np.float64, DENSS_GPU=False, nbatch=1):
+        """Allocate buffers for nbatch n x n x n grids, unless they already exist."""
+        dtype = np.dtype(dtype)
+        fftw = PYFFTW and not DENSS_GPU
+        if (self.n == n and self.dtype == dtype and self.DENSS_GPU == DENSS_GPU
+                and self.nbatch == nbatch and self.fftw == fftw):
+            return
+        xp = cp if DENSS_GPU else np
+        shape = (nbatch, n, n, n)
+        #shape of the reciprocal space grid for real valued FFTs
+        fshape = (nbatch, n, n, n//2+1)
+        if fftw:
+            #the FFTs run between these buffers, which are aligned for FFTW
+            self.rho = pyfftw.zeros_aligned(shape, dtype=dtype)
+            self.F = pyfftw.zeros_aligned(fshape, dtype=np.result_type(dtype, np.complex64))
+            self.rhoprime = pyfftw.zeros_aligned(shape, dtype=dtype)
+        else:
+            self.rho = xp.zeros(shape, dtype=dtype)
+        #FFTW plans for the first m slots, by transform and m
+        self._plans = {}
+        self.support = xp.ones(shape, dtype=bool)
+        #the CPU code works through F slab by slab, and
+        #only the GPU needs full size temporary grids
+        if DENSS_GPU:
+            self.I3D = xp.zeros(fshape, dtype=dtype)
+            self.factor_grid = xp.zeros(fshape, dtype=dtype)
+            self.fmask = xp.zeros(fshape, dtype=bool)
+        #keep one view per slot so that update_rho can tell
+        #when it is handed the buffer it already holds
+        self.rho_slots = [self.rho[i] for i in range(nbatch)]
+        self.n = n
+        self.dtype = dtype
+        self.DENSS_GPU = DENSS_GPU
+        self.nbatch = nbatch
+        self.fftw = fftw
+        self.xp = xp
+
+    def _slots(self, x, buf):
+        """Number of leading slots of buf that x is, or None if x is not the start of buf."""
+        if not isinstance(x, np.ndarray) or x.dtype != buf.dtype or not x.flags.c_contiguous:
+            return None
+        if x.__array_interface__['data'][0] != buf.__array_interface__['data'][0]:
+            return None
+        if x.shape == buf.shape[1:]:
+            return 1
+        if x.ndim == 4 and x.shape[1:] == buf.shape[1:]:
+            return x.shape[0]
+        return None
+
+    def _plan(self, kind, m):
+        """FFTW plan of kind ("rfftn" or "irfftn") between the first m slots of the buffers."""
+        key = (kind, m, get_fft_threads())
+        plan = self._plans.get(key)
+        if plan is None:
+            if kind == "rfftn":
+                arrays = (self.rho[:m], self.F[:m])
+            else:
+                arrays = (self.F[:m], self.rhoprime[:m])
+            #planning overwrites the arrays it is given, so plan on empty ones
+            #of the same layout and then point the plan at the buffers
+            plan = pyfftw.FFTW(pyfftw.empty_aligned(arrays[0].shape, dtype=arrays[0].dtype),
+                pyfftw.empty_aligned(arrays[1].shape, dtype=arrays[1].dtype), axes=(-3,-2,-1),
+                direction="FFTW_FORWARD" if kind == "rfftn" else "FFTW_BACKWARD",
+                flags=("FFTW_MEASURE",), threads=get_fft_threads())
+            plan.update_arrays(*arrays)
+            self._plans[key] = plan
+            save_fftw_wisdom()
+        return plan
+
+    def rfftn(self, x):
+        """FFT of each of the maps stacked in x.
+
+        With the pyfftw backend, x held in the rho buffer is transformed into
+        the workspace's F buffer, which is returned and only valid until the
+        next call.
+        """
+        if self.fftw and PYFFTW:
+            m = self._slots(x, self.rho)
+            if m is not None:
+                self._plan("rfftn", m)()
+                return self.F[:m] if x.ndim == 4 else self.F[0]
+        return myrfftn(x, DENSS_GPU=self.DENSS_GPU, axes=(-3,-2,-1))
+
+    def irfftn(self, F):
+        """Inverse FFT of each of the structure factor grids stacked in F.
+
+        With the pyfftw backend, F from rfftn() is transformed into the
+        workspace's rhoprime buffer, which is returned and only valid until the
+        next call. F is overwritten.
+        """
+        if self.fftw and PYFFTW:
+            m = self._slots(F, self.F)
+            if m is not None:
+                self._plan("irfftn", m)()
+                return self.rhoprime[:m] if F.ndim == 4 else self.rhoprime[0]
+        return myirfftn(F, DENSS_GPU=self.DENSS_GPU, axes=(-3,-2,-1))
+
+    def intensities(self, F):
+        """Calculate |F|^2 into the workspace, returning the I3D buffer.
+
+        Structure factors that are exactly zero (which sometimes happens when
+        refining a non-random starting map) break the scaling, so they are
+        first set to a tiny non-zero value in place.
+        """
+        xp = self.xp
+        m = F.shape[0]
+        I3D = self.I3D[:m]
+        tmp = self.factor_grid[:m]
+        fmask = self.fmask[:m]
+        xp.multiply(F.real, F.real, out=I3D)
+        #factor_grid is free at this point, use it as a temporary
+        xp.multiply(F.imag, F.imag, out=tmp)
+        I3D += tmp
+        xp.equal(I3D, 0, out=fmask)
+        if fmask.any():
+            F[fmask] = 1e-16
+            I3D[fmask] = 1e-32
+        return I3D
+
+    def shell_intensities(self, F, qbin_labels, xcount):
+        """Spherical average of |F|^2 of each map in F, one row per map.
+
+        As for intensities(), structure factors that are exactly zero are
+        first set to a tiny non-zero value in place. On the CPU this uses
+        the fused numba kernel if NUMBA_KERNELS is set.
+        """
+        m = F.shape[0]
+        if self.DENSS_GPU:
+            I3D = self.intensities(F)
+            return cp.array([mybinmean(I3D[i].ravel(), qbin_labels.ravel(), xcount=xcount,
+                DENSS_GPU=True) for i in range(m)])
+        nbins = len(xcount)
+        tiny = self.dtype.type(1e-32)
+        if NUMBA_KERNELS:
+            shell_sums = shell_sums_numba
+        else:
+            shell_sums = shell_sums_numpy
+        return np.array([shell_sums(F[i], qbin_labels, nbins, tiny) for i in range(m)]) / xcount
+
+    def scale_amplitudes(self, F, factors, qbin_labels):
+        """Multiply F in place by the scale factor of the q shell of each voxel.
+
+        factors - one row of scale factors per map in F
+        """
+        m = F.shape[0]
+        factors = factors.astype(self.dtype, copy=False)
+        if not self.DENSS_GPU:
+            if NUMBA_KERNELS:
+                scale_shells = scale_shells_numba
+            else:
+                scale_shells = scale_shells_numpy
+            for i in range(m):
+                scale_shells(F[i], qbin_labels, factors[i])
+            return F
+        for i in range(m):
+            self.xp.take(factors[i], qbin_labels, out=self.factor_grid[i])
+        F *= self.factor_grid[:m]
+        return F
+
+    def update_rho(self, newrho, slot=0):
+        """Store newrho in the given rho slot and return the slot."""
+        rho = self.rho_slots[slot]
+        if newrho is not rho:
+            rho[...] = newrho
+        return rho
+
+    def move_rho(self, src, dst):
+        """Copy the map held in slot src into slot dst."""
+        if src != dst:
+            self.rho[dst] = self.rho[src]
+
 def denss(q, I, sigq, dmax, qraw=None, Iraw=None, sigqraw=None,
     ne=None, voxel=5., oversampling=3., recenter=True, recenter_steps=None,
     recenter_mode="com", positivity=True, positivity_steps=None, extrapolate=True, output="map",
     steps=None, seed=None, rho_start=None, support_start=None, add_noise=None,
     shrinkwrap=True, shrinkwrap_old_method=False,shrinkwrap_sigma_start=3,
     shrinkwrap_sigma_end=1.5, shrinkwrap_sigma_decay=0.99, shrinkwrap_threshold_fraction=0.2,
-    shrinkwrap_iter=20, shrinkwrap_minstep=100, chi_end_fraction=0.01,
+    shrinkwrap_iter=20, shrinkwrap_minstep=100, shrinkwrap_fft_blur=True, chi_end_fraction=0.01,
     write_xplor_format=False, write_freq=100, enforce_connectivity=True,
     enforce_connectivity_steps=[500], enforce_connectivity_max_features=1, cutout=True, quiet=False, ncs=0,
     ncs_steps=[500],ncs_axis=1, ncs_type="cyclical",abort_event=None, my_logger=logging.getLogger(),
-    path='.', gui=False, DENSS_GPU=False):
-    """Calculate electron density from scattering data."""
+    path='.', gui=False, DENSS_GPU=False, workspace=None, fft_backend=None, fft_threads=None,
+    grid_cache_dir=None, precision="double", map_writer=None, checkpoint_freq=None, resume=False,
+    profile=None, multires_steps=None, projector="er", projector_beta=0.9, projector_beta_start=None,
+    projector_beta_steps=500, projector_er_step=None, convergence="chi", convergence_tol=0.005,
+    shrinkwrap_skip_decay=False, progress_queue=None, progress_freq=100):
+    """Calculate electron density from scattering data.
+
+    fft_backend - FFT library for CPU transforms, "scipy", "pyfftw" or "numpy"
+                  (see set_fft_backend). None keeps the current backend.
+    fft_threads - number of threads per FFT. None keeps the current setting.
+    grid_cache_dir - directory to keep the grids in for reuse by later runs,
+                     see get_grid (optional)
+    shrinkwrap_fft_blur - blur the density for shrinkwrap with FFTs, which is
+                          faster than and equivalent to blurring in real space
+    precision - "double" (default) runs the iterations in float64/complex128,
+                "single" in float32/complex64, which halves the memory used and
+                speeds up the FFTs. Sums over the grid are still done in float64.
+    map_writer - AsyncMapWriter used to write maps in the background. Defaults to
+                 the shared writer (get_map_writer). All maps have been written
+                 by the time denss returns.
+    checkpoint_freq - save the complete state of the run to output_checkpoint.npz
+                      every checkpoint_freq steps, when aborted, and when finished.
+                      None or 0 disables checkpoints.
+    resume - continue from output_checkpoint.npz if it exists and matches this run.
+             The resumed run gives the same result as if it had not been interrupted.
+    profile - record the time spent in each phase of the iterations, and write it
+              to the log and to output_profile.json. None uses the DENSS_PROFILE
+              environment variable.
+    multires_steps - list of steps at which to move to a finer grid. The first
+                     steps run on a grid with 2**len(multires_steps) times fewer
+                     voxels along each side, and the grid doubles in size at each
+                     of the given steps until it reaches the requested voxel size
+                     (see denss_batch_multires). None runs every step on the final grid.
+    projector - real space projection (see project_real_space): "er" (error
+                reduction, default), "hio" (hybrid input-output), "raar" (relaxed
+                averaged alternating reflections) or "dm" (difference map)
+    projector_beta - feedback parameter of hio, raar and dm
+    projector_beta_start, projector_beta_steps - if projector_beta_start is given,
+                beta moves from projector_beta_start to projector_beta over about
+                projector_beta_steps steps (see projector_beta_schedule)
+    projector_er_step - step from which error reduction is used to polish the map.
+                        Defaults to the end of the shrinkwrap schedule. At most
+                        steps-100, so that the map is always polished.
+    convergence - test used to stop the map early (see ConvergenceMonitor): "chi"
+                  (default) stops when chi2 is flat to within chi_end_fraction,
+                  "adaptive" also stops on a plateau of the fitted chi2, Rg and
+                  support volume once shrinkwrap has reached shrinkwrap_sigma_end
+    convergence_tol - largest relative change over 100 steps of a plateau
+    shrinkwrap_skip_decay - go straight to shrinkwrap_sigma_end once the support
+                            volume has stopped changing
+    progress_queue - queue (or any object with a put() method) that is sent
+                     (output, seed, step, chi2, Rg, support volume) every
+                     progress_freq steps, e.g. so that the parent of many runs
+                     can follow them (see EnsembleCuller)
+
+    workspace - a DenssWorkspace holding the buffers used by each iteration. One
+                is created if not given. Pass the same workspace to consecutive
+                runs on the same grid to avoid reallocating it.
+    """
+    results = denss_batch(q=q, I=I, sigq=sigq, dmax=dmax, qraw=qraw, Iraw=Iraw, sigqraw=sigqraw,
+        ne=ne, voxel=voxel, oversampling=oversampling, recenter=recenter, recenter_steps=recenter_steps,
+        recenter_mode=recenter_mode, positivity=positivity, positivity_steps=positivity_steps,
+        extrapolate=extrapolate, output=[output], steps=steps, seeds=[seed], rho_start=rho_start,
+        support_start=support_start, add_noise=add_noise, shrinkwrap=shrinkwrap,
+        shrinkwrap_old_method=shrinkwrap_old_method, shrinkwrap_sigma_start=shrinkwrap_sigma_start,
+        shrinkwrap_sigma_end=shrinkwrap_sigma_end, shrinkwrap_sigma_decay=shrinkwrap_sigma_decay,
+        shrinkwrap_threshold_fraction=shrinkwrap_threshold_fraction, shrinkwrap_iter=shrinkwrap_iter,
+        shrinkwrap_minstep=shrinkwrap_minstep, shrinkwrap_fft_blur=shrinkwrap_fft_blur,
+        chi_end_fraction=chi_end_fraction,
+        write_xplor_format=write_xplor_format, write_freq=write_freq,
+        enforce_connectivity=enforce_connectivity, enforce_connectivity_steps=enforce_connectivity_steps,
+        enforce_connectivity_max_features=enforce_connectivity_max_features, cutout=cutout, quiet=quiet,
+        ncs=ncs, ncs_steps=ncs_steps, ncs_axis=ncs_axis, ncs_type=ncs_type, abort_event=abort_event,
+        my_logger=[my_logger], path=path, gui=gui, DENSS_GPU=DENSS_GPU, workspace=workspace,
+        fft_backend=fft_backend, fft_threads=fft_threads, grid_cache_dir=grid_cache_dir,
+        precision=precision, map_writer=map_writer, checkpoint_freq=checkpoint_freq, resume=resume,
+        profile=profile, multires_steps=multires_steps, projector=projector, projector_beta=projector_beta,
+        projector_beta_start=projector_beta_start, projector_beta_steps=projector_beta_steps,
+        projector_er_step=projector_er_step, convergence=convergence, convergence_tol=convergence_tol,
+        shrinkwrap_skip_decay=shrinkwrap_skip_decay, progress_queue=progress_queue,
+        progress_freq=progress_freq)
+    if not results:
+        return []
+    return results[0]
+
+def denss_batch(q, I, sigq, dmax, qraw=None, Iraw=None, sigqraw=None,
+    ne=None, voxel=5., oversampling=3., recenter=True, recenter_steps=None,
+    recenter_mode="com", positivity=True, positivity_steps=None, extrapolate=True, output="map",
+    steps=None, seeds=None, nmaps=None, rho_start=None, support_start=None, add_noise=None,
+    shrinkwrap=True, shrinkwrap_old_method=False,shrinkwrap_sigma_start=3,
+    shrinkwrap_sigma_end=1.5, shrinkwrap_sigma_decay=0.99, shrinkwrap_threshold_fraction=0.2,
+    shrinkwrap_iter=20, shrinkwrap_minstep=100, shrinkwrap_fft_blur=True, chi_end_fraction=0.01,
+    write_xplor_format=False, write_freq=100, enforce_connectivity=True,
+    enforce_connectivity_steps=[500], enforce_connectivity_max_features=1, cutout=True, quiet=False, ncs=0,
+    ncs_steps=[500],ncs_axis=1, ncs_type="cyclical",abort_event=None, my_logger=logging.getLogger(),
+    path='.', gui=False, DENSS_GPU=False, workspace=None, fft_backend=None, fft_threads=None,
+    grid_cache_dir=None, precision="double", map_writer=None, checkpoint_freq=None, resume=False,
+    profile=None, multires_steps=None, projector="er", projector_beta=0.9, projector_beta_start=None,
+    projector_beta_steps=500, projector_er_step=None, convergence="chi", convergence_tol=0.005,
+    shrinkwrap_skip_decay=False, progress_queue=None, progress_freq=100, start_state=None, stop_step=None):
+    """Calculate several electron density maps from the same scattering data at once.
+
+    The maps are advanced in lockstep as one stack of grids, so the FFTs of
+    all maps are done together and the real and reciprocal space grids, q shell
+    labels and interpolated data are only set up once. Each map keeps its own
+    random seed, support, shrinkwrap and convergence state, and drops out of
+    the stack once it has converged. Map k gives the same result as a call to
+    denss() with seed=seeds[k].
+
+    Takes the same arguments as denss(), except:
+
+    seeds - list of random seeds, one per map. None entries get a random seed.
+    nmaps - number of maps, if seeds is not given (all seeds random).
+    output - either a list of output prefixes, one per map, or a single prefix
+             in which case map k is written to output_k
+    my_logger - either a list of loggers, one per map, or a single logger
+    checkpoint_freq, resume - as for denss(), with one checkpoint for the whole
+                              batch, named after the first output prefix
+    profile - as for denss(), with one profile for the whole batch, named after
+              the first output prefix
+    start_state - state of a run to continue from, as saved in a checkpoint
+                  (used to move the maps of a multiresolution run to a finer grid)
+    stop_step - stop before running this step, and return the state of the run
+                instead of the results (used for the coarse grids of a
+                multiresolution run)
+
+    Returns a list with the results of each map, as returned by denss(), or
+    an empty list if aborted.
+    """
+    if multires_steps:
+        #only the arguments are defined at this point
+        return denss_batch_multires(**locals())
+
     if abort_event is not None:
         if abort_event.is_set():
-            my_logger.info('Aborted!')
+            for logger in set(my_logger if isinstance(my_logger, (list, tuple)) else [my_logger]):
+                logger.info('Aborted!')
             return []
 
+    if seeds is None:
+        if nmaps is None:
+            nmaps = 1
+        seeds = [None]*nmaps
+    seeds = list(seeds)
+    nseeds = len(seeds)
+    if isinstance(output, (list, tuple)):
+        outputs = list(output)
+    else:
+        outputs = [output+'_'+str(k) for k in range(nseeds)]
+    if isinstance(my_logger, (list, tuple)):
+        my_loggers = list(my_logger)
+    else:
+        my_loggers = [my_logger]*nseeds
+    my_logger = my_loggers[0]
+    if map_writer is None:
+        map_writer = get_map_writer()
+    profiler = PhaseProfiler(enabled=profiling_enabled(profile))
+    profiler.start('setup')
+
     if DENSS_GPU and CUPY_LOADED:
         DENSS_GPU = True
     elif DENSS_GPU:
@@ -1122,7 +2183,21 @@ def denss(q, I, sigq, dmax, qraw=None, Iraw=None, sigqraw=None,
             print("GPU option set, but CuPy failed to load")
         DENSS_GPU = False
 
-    fprefix = os.path.join(path, output)
+    if fft_backend is not None or fft_threads is not None:
+        if fft_backend is None:
+            fft_backend = FFT_BACKEND
+        if fft_threads is None:
+            fft_threads = FFT_THREADS
+        fft_backend = set_fft_backend(fft_backend, fft_threads, my_logger=my_logger)
+
+    if precision == "single":
+        dtype = np.float32
+    elif precision == "double":
+        dtype = np.float64
+    else:
+        raise ValueError("precision must be either single or double, not %s" % precision)
+
+    fprefixes = [os.path.join(path, output) for output in outputs]
 
     D = dmax
 
@@ -1138,32 +2213,21 @@ def denss(q, I, sigq, dmax, qraw=None, Iraw=None, sigqraw=None,
     #store n for later use if needed
     nbox = n
 
-    dx = side/n
-    dV = dx**3
-    V = side**3
-    x_ = np.linspace(-halfside,halfside,n)
-    x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-    r = np.sqrt(x**2 + y**2 + z**2)
-
-    df = 1/side
-    qx_ = np.fft.fftfreq(x_.size)*n*df*2*np.pi
-    qz_ = np.fft.rfftfreq(x_.size)*n*df*2*np.pi
-    # qx, qy, qz = np.meshgrid(qx_,qx_,qx_,indexing='ij')
-    qx, qy, qz = np.meshgrid(qx_,qx_,qz_,indexing='ij')
-    qr = np.sqrt(qx**2+qy**2+qz**2)
-    qmax = np.max(qr)
-    qstep = np.min(qr[qr>0]) - 1e-8 #subtract a tiny bit to deal with floating point error
-    nbins = int(qmax/qstep)
-    qbins = np.linspace(0,nbins*qstep,nbins+1)
-
-    #create an array labeling each voxel according to which qbin it belongs
-    qbin_labels = np.searchsorted(qbins,qr,"right")
-    qbin_labels -= 1
-    qblravel = qbin_labels.ravel()
-    xcount = np.bincount(qblravel)
-
-    #calculate qbinsc as average of q values in shell
-    qbinsc = mybinmean(qr.ravel(), qblravel, xcount)
+    #the real and reciprocal space grids and q shells (read-only, shared between runs)
+    grid = get_grid(n, side, rfft=True, cache_dir=grid_cache_dir)
+    dx = grid.dx
+    dV = grid.dV
+    V = grid.V
+    x_ = grid.x_
+    qx_ = grid.qx_
+    qstep = grid.qstep
+    nbins = grid.nbins
+    qbins = grid.qbins
+    qbin_labels = grid.qbin_labels
+    qblravel = grid.qblravel
+    xcount = grid.xcount
+    #qbinsc is returned to the caller, so give it a writeable copy
+    qbinsc = np.copy(grid.qbinsc)
 
     #allow for any range of q data
     qdata = qbinsc[np.where( (qbinsc>=q.min()) & (qbinsc<=q.max()) )]
@@ -1191,56 +2255,100 @@ def denss(q, I, sigq, dmax, qraw=None, Iraw=None, sigqraw=None,
     I *= scale_factor
     sigq *= scale_factor
 
-    if steps == 'None' or steps is None or np.int(steps) < 1:
-        stepsarr = np.concatenate((enforce_connectivity_steps,[shrinkwrap_minstep]))
-        maxec = np.max(stepsarr)
-        steps = int(shrinkwrap_iter * (np.log(shrinkwrap_sigma_end/shrinkwrap_sigma_start)/np.log(shrinkwrap_sigma_decay)) + maxec)
-        #add enough steps for convergence after shrinkwrap is finished
-        #something like 7000 seems reasonable, likely will finish before that on its own
-        #then just make a round number when using defaults
-        steps += 7621
-    else:
-        steps = np.int(steps)
-
-    Imean = np.zeros((len(qbins)))
-    chi = np.zeros((steps+1))
-    rg = np.zeros((steps+1))
-    supportV = np.zeros((steps+1))
-    if support_start is not None:
-        support = np.copy(support_start)
-    else:
-        support = np.ones(x.shape,dtype=bool)
-
-    if seed is None:
-        #Have to reset the random seed to get a random in different from other processes
-        prng = np.random.RandomState()
-        seed = prng.randint(2**31-1)
-    else:
-        seed = int(seed)
-
-    prng = np.random.RandomState(seed)
-
-    if rho_start is not None:
-        rho = rho_start #*dV
-        if add_noise is not None:
-            noise_factor = rho.max() * add_noise
-            noise = prng.random_sample(size=x.shape)*noise_factor
-            rho += noise
-    else:
-        rho = prng.random_sample(size=x.shape) #- 0.5
-    newrho = np.zeros_like(rho)
+    steps = denss_steps(steps, shrinkwrap_iter=shrinkwrap_iter, shrinkwrap_sigma_start=shrinkwrap_sigma_start,
+        shrinkwrap_sigma_end=shrinkwrap_sigma_end, shrinkwrap_sigma_decay=shrinkwrap_sigma_decay,
+        enforce_connectivity_steps=enforce_connectivity_steps, shrinkwrap_minstep=shrinkwrap_minstep)
+    if stop_step is not None and stop_step >= steps:
+        stop_step = None
+
+    projector = projector.lower()
+    if projector not in REAL_SPACE_PROJECTORS:
+        raise ValueError("projector must be one of %s, not %s" % (", ".join(REAL_SPACE_PROJECTORS), projector))
+    if projector == "er":
+        projector_er_step = 0
+    elif projector_er_step is None:
+        #polish with error reduction once the support has settled
+        projector_er_step = shrinkwrap_schedule_steps(shrinkwrap_iter=shrinkwrap_iter,
+            shrinkwrap_sigma_start=shrinkwrap_sigma_start, shrinkwrap_sigma_end=shrinkwrap_sigma_end,
+            shrinkwrap_sigma_decay=shrinkwrap_sigma_decay,
+            enforce_connectivity_steps=enforce_connectivity_steps, shrinkwrap_minstep=shrinkwrap_minstep)
+    projector_er_step = int(projector_er_step)
+
+    #each map keeps its own copy of the statistics and of the state
+    #of the support, indexed by its position k in the list of seeds
+    Imeans = [np.zeros((len(qbins))) for k in range(nseeds)]
+    chis = [np.zeros((steps+1)) for k in range(nseeds)]
+    rgs = [np.zeros((steps+1)) for k in range(nseeds)]
+    supportVs = [np.zeros((steps+1)) for k in range(nseeds)]
+    monitors = [ConvergenceMonitor(steps, test=convergence, chi_end_fraction=chi_end_fraction,
+        tol=convergence_tol) for k in range(nseeds)]
+    window = monitors[0].window
+    if projector != "er" and projector_er_step > steps - window:
+        #always leave at least a window of steps of error reduction to polish the map
+        er_step = max(steps - window, 0)
+        for my_logger in set(my_loggers):
+            my_logger.warning('Error reduction step %i is beyond the last %i of the %i steps, using step %i',
+                projector_er_step, window, steps, er_step)
+        projector_er_step = er_step
+    #a plateau is only looked for, and the shrinkwrap decay only skipped, once
+    #a whole window has passed since the support was last pruned to its
+    #connected features or had its symmetry imposed
+    settle_steps = [shrinkwrap_minstep]
+    if enforce_connectivity:
+        settle_steps += list(enforce_connectivity_steps)
+    if ncs != 0:
+        settle_steps += list(ncs_steps)
+    settle_step = max(settle_steps) + window
+
+    #all of the grids used in each step live in the workspace,
+    #with one slot for each map that is still running
+    if workspace is None:
+        workspace = DenssWorkspace()
+    workspace.allocate(n, dtype=dtype, DENSS_GPU=DENSS_GPU, nbatch=nseeds)
+    ws = workspace
+
+    supports = [ws.support[k] for k in range(nseeds)]
+    for support in supports:
+        if support_start is not None:
+            support[...] = ws.xp.asarray(support_start)
+        else:
+            support[...] = True
+
+    prngs = []
+    for k in range(nseeds):
+        seed = seeds[k]
+        if seed is None:
+            #Have to reset the random seed to get a random in different from other processes
+            prng = np.random.RandomState()
+            seed = prng.randint(2**31-1)
+        else:
+            seed = int(seed)
+        seeds[k] = seed
+
+        prng = np.random.RandomState(seed)
+        prngs.append(prng)
+
+        rho = ws.rho[k]
+        if rho_start is not None:
+            rho[...] = ws.xp.asarray(rho_start) #*dV
+            if add_noise is not None:
+                noise_factor = rho.max() * add_noise
+                noise = prng.random_sample(size=(n,n,n))*noise_factor
+                rho += ws.xp.asarray(noise)
+        else:
+            rho[...] = ws.xp.asarray(prng.random_sample(size=(n,n,n))) #- 0.5
 
-    sigma = shrinkwrap_sigma_start
+    sigmas = [shrinkwrap_sigma_start]*nseeds
 
     #calculate the starting shrinkwrap volume as the volume of a sphere
     #of radius Dmax, i.e. much larger than the particle size
     swbyvol = True
-    swV = V/2.0
+    swVs = [V/2.0]*nseeds
     Vsphere_Dover2 = 4./3 * np.pi * (D/2.)**3
     swVend = Vsphere_Dover2
     swV_decay = 0.9
-    first_time_swdensity = True
-    threshold = shrinkwrap_threshold_fraction
+    first_time_swdensities = [True]*nseeds
+    thresholds = [shrinkwrap_threshold_fraction]*nseeds
     #erode will make take five outer edge pixels of the support, like a shell,
     #and will make sure no negative density is in that region
     #this is to counter an artifact that occurs when allowing for negative density
@@ -1256,49 +2364,135 @@ def denss(q, I, sigq, dmax, qraw=None, Iraw=None, sigqraw=None,
         if erosion_width ==0:
             #make minimum of one pixel
             erosion_width = 1
-
-    my_logger.info('q range of input data: %3.3f < q < %3.3f', q.min(), q.max())
-    my_logger.info('Maximum dimension: %3.3f', D)
-    my_logger.info('Sampling ratio: %3.3f', oversampling)
-    my_logger.info('Requested real space voxel size: %3.3f', voxel)
-    my_logger.info('Number of electrons: %3.3f', ne)
-    my_logger.info('Recenter: %s', recenter)
-    my_logger.info('Recenter Steps: %s', recenter_steps)
-    my_logger.info('Recenter Mode: %s', recenter_mode)
-    my_logger.info('NCS: %s', ncs)
-    my_logger.info('NCS Steps: %s', ncs_steps)
-    my_logger.info('NCS Axis: %s', ncs_axis)
-    my_logger.info('Positivity: %s', positivity)
-    # my_logger.info('Positivity Steps: %s', positivity_steps)
-    my_logger.info('Extrapolate high q: %s', extrapolate)
-    my_logger.info('Shrinkwrap: %s', shrinkwrap)
-    my_logger.info('Shrinkwrap Old Method: %s', shrinkwrap_old_method)
-    my_logger.info('Shrinkwrap sigma start (angstroms): %s', shrinkwrap_sigma_start*dx)
-    my_logger.info('Shrinkwrap sigma end (angstroms): %s', shrinkwrap_sigma_end*dx)
-    my_logger.info('Shrinkwrap sigma start (voxels): %s', shrinkwrap_sigma_start)
-    my_logger.info('Shrinkwrap sigma end (voxels): %s', shrinkwrap_sigma_end)
-    my_logger.info('Shrinkwrap sigma decay: %s', shrinkwrap_sigma_decay)
-    my_logger.info('Shrinkwrap threshold fraction: %s', shrinkwrap_threshold_fraction)
-    my_logger.info('Shrinkwrap iterations: %s', shrinkwrap_iter)
-    my_logger.info('Shrinkwrap starting step: %s', shrinkwrap_minstep)
-    my_logger.info('Enforce connectivity: %s', enforce_connectivity)
-    my_logger.info('Enforce connectivity steps: %s', enforce_connectivity_steps)
-    my_logger.info('Chi2 end fraction: %3.3e', chi_end_fraction)
-    my_logger.info('Maximum number of steps: %i', steps)
-    my_logger.info('Grid size (voxels): %i x %i x %i', n, n, n)
-    my_logger.info('Real space box width (angstroms): %3.3f', side)
-    my_logger.info('Real space box range (angstroms): %3.3f < x < %3.3f', x_.min(), x_.max())
-    my_logger.info('Real space box volume (angstroms^3): %3.3f', V)
-    my_logger.info('Real space voxel size (angstroms): %3.3f', dx)
-    my_logger.info('Real space voxel volume (angstroms^3): %3.3f', dV)
-    my_logger.info('Reciprocal space box width (angstroms^(-1)): %3.3f', qx_.max()-qx_.min())
-    my_logger.info('Reciprocal space box range (angstroms^(-1)): %3.3f < qx < %3.3f', qx_.min(), qx_.max())
-    my_logger.info('Maximum q vector (diagonal) (angstroms^(-1)): %3.3f', qr.max())
-    my_logger.info('Number of q shells: %i', nbins)
-    my_logger.info('Width of q shells (angstroms^(-1)): %3.3f', qstep)
-    my_logger.info('Random seed: %i', seed)
-
-    if not quiet:
+    #the boundary region of each support, and the support it was calculated
+    #from, so that it is only recalculated when the support changes
+    erode_regions = [None]*nseeds
+    erode_supports = [None]*nseeds
+
+    #maps still running, in the order of their slots in the workspace
+    active = list(range(nseeds))
+    #final step, density and support of each map once it has finished
+    final_steps = [None]*nseeds
+    final_rhos = [None]*nseeds
+
+    #pick up the state of an interrupted run from its checkpoint,
+    #or of a coarser grid from the previous level of a multiresolution run
+    checkpoint_file = fprefixes[0]+"_checkpoint.npz"
+    start_step = 0
+    #step at which this grid took over, so that convergence is only judged on its own steps
+    first_step = 0
+    def matches(ckpt):
+        return (int(ckpt['n']) == n and int(ckpt['steps']) == steps
+            and str(ckpt['dtype']) == np.dtype(dtype).str
+            and [str(o) for o in ckpt['outputs']] == [str(o) for o in outputs])
+    ckpt = None
+    if start_state is not None:
+        if not matches(start_state):
+            raise ValueError("start_state does not match the grid, steps, precision or outputs of this run")
+        ckpt = start_state
+    elif resume:
+        if not os.path.exists(checkpoint_file):
+            my_logger.info('No checkpoint found at %s, starting from step 0', checkpoint_file)
+        else:
+            ckpt = load_denss_checkpoint(checkpoint_file)
+            if not matches(ckpt):
+                my_logger.info('Checkpoint %s does not match this run, starting from step 0', checkpoint_file)
+                ckpt = None
+    if ckpt is not None:
+        start_step = int(ckpt['next_step'])
+        if 'first_step' in ckpt:
+            first_step = int(ckpt['first_step'])
+        seeds = [int(seed) for seed in ckpt['seeds']]
+        active = [int(k) for k in ckpt['active']]
+        for k in range(nseeds):
+            prngs[k].set_state(('MT19937', ckpt['prng_keys'][k], int(ckpt['prng_pos'][k]),
+                int(ckpt['prng_has_gauss'][k]), float(ckpt['prng_cached_gaussian'][k])))
+            sigmas[k] = float(ckpt['sigmas'][k])
+            swVs[k] = float(ckpt['swVs'][k])
+            #keep the type of the threshold, which may be single precision
+            thresholds[k] = ckpt['threshold_%i' % k][()]
+            first_time_swdensities[k] = bool(ckpt['first_time_swdensities'][k])
+            chis[k][:] = ckpt['chis'][k]
+            rgs[k][:] = ckpt['rgs'][k]
+            supportVs[k][:] = ckpt['supportVs'][k]
+            if 'convergence' in ckpt:
+                monitors[k].history[:] = ckpt['convergence'][k]
+                monitors[k].settled = int(ckpt['convergence_settled'][k])
+            else:
+                #checkpoints from before the convergence monitor have no fitted chi2
+                monitors[k].history[:] = chis[k], np.nan, rgs[k], supportVs[k]
+            supports[k][...] = ws.xp.asarray(ckpt['supports'][k])
+            if ckpt['final_steps'][k] >= 0:
+                final_steps[k] = int(ckpt['final_steps'][k])
+                final_rhos[k] = ws.xp.asarray(ckpt['rhos'][k])
+        for i, k in enumerate(active):
+            ws.rho[i][...] = ws.xp.asarray(ckpt['rhos'][k])
+        if start_state is None:
+            for k in range(nseeds):
+                my_loggers[k].info('Resumed from checkpoint %s at step %i', checkpoint_file, start_step)
+
+    for my_logger in set(my_loggers):
+        my_logger.info('q range of input data: %3.3f < q < %3.3f', q.min(), q.max())
+        my_logger.info('Maximum dimension: %3.3f', D)
+        my_logger.info('Sampling ratio: %3.3f', oversampling)
+        my_logger.info('Requested real space voxel size: %3.3f', voxel)
+        my_logger.info('Number of electrons: %3.3f', ne)
+        my_logger.info('Recenter: %s', recenter)
+        my_logger.info('Recenter Steps: %s', recenter_steps)
+        my_logger.info('Recenter Mode: %s', recenter_mode)
+        my_logger.info('NCS: %s', ncs)
+        my_logger.info('NCS Steps: %s', ncs_steps)
+        my_logger.info('NCS Axis: %s', ncs_axis)
+        my_logger.info('Positivity: %s', positivity)
+        # my_logger.info('Positivity Steps: %s', positivity_steps)
+        my_logger.info('Extrapolate high q: %s', extrapolate)
+        my_logger.info('Shrinkwrap: %s', shrinkwrap)
+        my_logger.info('Shrinkwrap Old Method: %s', shrinkwrap_old_method)
+        my_logger.info('Shrinkwrap sigma start (angstroms): %s', shrinkwrap_sigma_start*dx)
+        my_logger.info('Shrinkwrap sigma end (angstroms): %s', shrinkwrap_sigma_end*dx)
+        my_logger.info('Shrinkwrap sigma start (voxels): %s', shrinkwrap_sigma_start)
+        my_logger.info('Shrinkwrap sigma end (voxels): %s', shrinkwrap_sigma_end)
+        my_logger.info('Shrinkwrap sigma decay: %s', shrinkwrap_sigma_decay)
+        my_logger.info('Shrinkwrap threshold fraction: %s', shrinkwrap_threshold_fraction)
+        my_logger.info('Shrinkwrap iterations: %s', shrinkwrap_iter)
+        my_logger.info('Shrinkwrap starting step: %s', shrinkwrap_minstep)
+        my_logger.info('Shrinkwrap FFT blur: %s', shrinkwrap_fft_blur)
+        my_logger.info('Enforce connectivity: %s', enforce_connectivity)
+        my_logger.info('Enforce connectivity steps: %s', enforce_connectivity_steps)
+        my_logger.info('Chi2 end fraction: %3.3e', chi_end_fraction)
+        my_logger.info('Convergence test: %s', convergence)
+        if convergence == "adaptive":
+            my_logger.info('Convergence tolerance: %3.3e', convergence_tol)
+        my_logger.info('Shrinkwrap skip decay: %s', shrinkwrap_skip_decay)
+        my_logger.info('Real space projector: %s', projector)
+        if projector != "er":
+            if projector_beta_start is None:
+                my_logger.info('Projector beta: %s', projector_beta)
+            else:
+                my_logger.info('Projector beta: %s to %s over %s steps', projector_beta_start, projector_beta, projector_beta_steps)
+            my_logger.info('Error reduction from step: %i', projector_er_step)
+        my_logger.info('Maximum number of steps: %i', steps)
+        my_logger.info('Grid size (voxels): %i x %i x %i', n, n, n)
+        my_logger.info('Real space box width (angstroms): %3.3f', side)
+        my_logger.info('Real space box range (angstroms): %3.3f < x < %3.3f', x_.min(), x_.max())
+        my_logger.info('Real space box volume (angstroms^3): %3.3f', V)
+        my_logger.info('Real space voxel size (angstroms): %3.3f', dx)
+        my_logger.info('Real space voxel volume (angstroms^3): %3.3f', dV)
+        my_logger.info('Reciprocal space box width (angstroms^(-1)): %3.3f', qx_.max()-qx_.min())
+        my_logger.info('Reciprocal space box range (angstroms^(-1)): %3.3f < qx < %3.3f', qx_.min(), qx_.max())
+        my_logger.info('Maximum q vector (diagonal) (angstroms^(-1)): %3.3f', grid.qmax)
+        my_logger.info('Number of q shells: %i', nbins)
+        my_logger.info('Width of q shells (angstroms^(-1)): %3.3f', qstep)
+        my_logger.info('Precision: %s', precision)
+        if not DENSS_GPU:
+            my_logger.info('FFT backend: %s (%i threads)', FFT_BACKEND, 1 if FFT_BACKEND == "numpy" else get_fft_threads())
+        if nseeds > 1:
+            my_logger.info('Maps run together in batch: %i', nseeds)
+    for k in range(nseeds):
+        my_loggers[k].info('Random seed: %i', seeds[k])
+
+    #the step by step statistics are only printed when running a single map
+    if not quiet and nseeds == 1:
         if gui:
             my_logger.info("\n Step     Chi2     Rg    Support Volume")
             my_logger.info(" ----- --------- ------- --------------")
@@ -1306,432 +2500,891 @@ def denss(q, I, sigq, dmax, qraw=None, Iraw=None, sigqraw=None,
             print("\n Step     Chi2     Rg    Support Volume")
             print(" ----- --------- ------- --------------")
 
-    if PYFFTW:
-        a = np.copy(rho)
-        rho = pyfftw.empty_aligned(a.shape, dtype='complex64')
-        rho[:] = a
-        rhoprime = pyfftw.empty_aligned(a.shape, dtype='complex64')
-        newrho = pyfftw.empty_aligned(a.shape, dtype='complex64')
-        try:
-            # Try to plan our transforms with the wisdom we have already
-            fftw_object = pyfftw.FFTW(rho,
-                                      rhoprime,
-                                      direction="FFTW_FORWARD",
-                                      flags=("FFTW_WISDOM_ONLY",))
-        except RuntimeError as e:
-            # If we don't have enough wisdom, print a warning and proceed.
-            print(e)
-            start = time.perf_counter()
-            fftw_object = pyfftw.FFTW(rho,
-                                      rhoprime,
-                                      direction="FFTW_FORWARD",
-                                      flags=("FFTW_MEASURE",))
-            print("Generating wisdom took {}s".format(time.perf_counter() - start))
-            with open("fft.wisdom", "wb") as the_file:
-                wisdom = pyfftw.export_wisdom()
-                pickle.dump(wisdom, the_file)
-
     if DENSS_GPU:
-        rho = cp.array(rho)
         qbin_labels = cp.array(qbin_labels)
         qbins = cp.array(qbins)
         qbinsc = cp.array(qbinsc)
         Idata = cp.array(Idata)
         qbin_args = cp.array(qbin_args)
         sigqdata = cp.array(sigqdata)
-        support = cp.array(support)
-        chi = cp.array(chi)
-        supportV = cp.array(supportV)
-        Imean = cp.array(Imean)
-        newrho = cp.array(newrho)
+        chis = [cp.array(chi) for chi in chis]
+        supportVs = [cp.array(supportV) for supportV in supportVs]
+        Imeans = [cp.array(Imean) for Imean in Imeans]
         qblravel = cp.array(qblravel)
         xcount = cp.array(xcount)
 
-    for j in range(steps):
+    Idata_qba = Idata[qba]
+    sigqdata_qba = sigqdata[qba]
+    factors = ws.xp.ones((nseeds, len(Idata)))
+    #chi2 of each map after scaling it to the data, for the adaptive convergence test
+    fit_chis = [0.0]*nseeds
+
+    def get_state(next_step):
+        """Everything needed to continue the run from next_step."""
+        if DENSS_GPU:
+            tonumpy = cp.asnumpy
+        else:
+            tonumpy = np.asarray
+        rhos = np.zeros((nseeds,n,n,n), dtype=dtype)
+        for i, k in enumerate(active):
+            rhos[k] = tonumpy(ws.rho[i])
+        for k in range(nseeds):
+            if final_steps[k] is not None:
+                rhos[k] = tonumpy(final_rhos[k])
+        prng_states = [prng.get_state() for prng in prngs]
+        state = dict(
+            n=n, steps=steps, dtype=np.dtype(dtype).str, outputs=np.array(outputs),
+            seeds=np.array(seeds), next_step=next_step, first_step=first_step,
+            active=np.array(active, dtype=int),
+            final_steps=np.array([-1 if fs is None else fs for fs in final_steps], dtype=int),
+            sigmas=np.array(sigmas, dtype=np.float64), swVs=np.array(swVs, dtype=np.float64),
+            first_time_swdensities=np.array(first_time_swdensities, dtype=bool),
+            chis=np.array([tonumpy(chi) for chi in chis]), rgs=np.array(rgs),
+            supportVs=np.array([tonumpy(supportV) for supportV in supportVs]),
+            supports=np.array([tonumpy(support) for support in supports], dtype=bool),
+            convergence=np.array([monitor.history for monitor in monitors]),
+            convergence_settled=np.array([monitor.settled for monitor in monitors], dtype=int),
+            rhos=rhos,
+            prng_keys=np.array([st[1] for st in prng_states]),
+            prng_pos=np.array([st[2] for st in prng_states]),
+            prng_has_gauss=np.array([st[3] for st in prng_states]),
+            prng_cached_gaussian=np.array([st[4] for st in prng_states]),
+            )
+        for k in range(nseeds):
+            state['threshold_%i' % k] = np.asarray(thresholds[k])
+        return state
+
+    def write_checkpoint(next_step):
+        """Save everything needed to continue the run from next_step."""
+        save_denss_checkpoint(checkpoint_file, **get_state(next_step))
+
+    profiler.stop('setup')
+
+    #a coarse grid of a multiresolution run stops at stop_step
+    if stop_step is None:
+        last_step = steps
+    else:
+        last_step = stop_step
+
+    for j in range(start_step, last_step):
         if abort_event is not None:
             if abort_event.is_set():
-                my_logger.info('Aborted!')
+                for my_logger in set(my_loggers):
+                    my_logger.info('Aborted!')
+                if checkpoint_freq:
+                    write_checkpoint(j)
+                map_writer.flush()
                 return []
+        if not active:
+            break
 
-        # F = myfftn(rho, DENSS_GPU=DENSS_GPU)
-        F = myrfftn(rho, DENSS_GPU=DENSS_GPU)
-
-        #sometimes, when using denss.refine.py with non-random starting rho,
-        #the resulting Fs result in zeros in some locations and the algorithm to break
-        #here just make those values to be 1e-16 to be non-zero
-        F[np.abs(F)==0] = 1e-16
+        #APPLY RECIPROCAL SPACE RESTRAINTS TO ALL RUNNING MAPS AT ONCE
+        nactive = len(active)
+        profiler.start('fft')
+        F = ws.rfftn(ws.rho[:nactive])
+        profiler.stop('fft')
 
-        #APPLY RECIPROCAL SPACE RESTRAINTS
         #calculate spherical average of intensities from 3D Fs
-        # I3D = myabs(F, DENSS_GPU=DENSS_GPU)**2
-        I3D = abs2(F)
-        Imean = mybinmean(I3D.ravel(), qblravel, xcount=xcount, DENSS_GPU=DENSS_GPU)
-
-        #scale Fs to match data
-        factors = mysqrt(Idata/Imean, DENSS_GPU=DENSS_GPU)
-        #do not scale bins outside of desired range
-        #so set those factors to 1.0
-        factors[~qba] = 1.0
-        F *= factors[qbin_labels]
-
-        chi[j] = mysum(((Imean[qba]-Idata[qba])/sigqdata[qba])**2, DENSS_GPU=DENSS_GPU)/Idata[qba].size
-
-        #APPLY REAL SPACE RESTRAINTS
-        # rhoprime = myifftn(F, DENSS_GPU=DENSS_GPU).real
-        rhoprime = myirfftn(F, DENSS_GPU=DENSS_GPU).real
-
-        # use Guinier's law to approximate quickly
-        rg[j] = calc_rg_by_guinier_first_2_points(qbinsc, Imean, DENSS_GPU=DENSS_GPU)
-
-        #Error Reduction
-        newrho *= 0
-        newrho[support] = rhoprime[support]
-
-        if not DENSS_GPU and j%write_freq == 0:
-            if write_xplor_format:
-                write_xplor(rhoprime/dV, side, fprefix+"_current.xplor")
-            write_mrc(rhoprime/dV, side, fprefix+"_current.mrc")
-
-        # enforce positivity by making all negative density points zero.
-        if positivity: # and j in positivity_steps:
-            newrho[newrho<0] = 0.0
-
-        #apply non-crystallographic symmetry averaging
-        if ncs != 0 and j in ncs_steps:
-            if DENSS_GPU:
-                newrho = cp.asnumpy(newrho)
-            newrho = align2xyz(newrho)
-            if DENSS_GPU:
-                newrho = cp.array(newrho)
-
-        if ncs != 0 and j in [stepi+1 for stepi in ncs_steps]:
-            if DENSS_GPU:
-                newrho = cp.asnumpy(newrho)
-            if ncs_axis == 1:
-                axes=(1,2) #longest
-                axes2=(0,1) #shortest
-            if ncs_axis == 2:
-                axes=(0,2) #middle
-                axes2=(0,1) #shortest
-            if ncs_axis == 3:
-                axes=(0,1) #shortest
-                axes2=(1,2) #longest
-            degrees = 360./ncs
-            newrho_total = np.copy(newrho)
-            if ncs_type == "dihedral":
-                #first, rotate original about perpendicular axis by 180
-                #then apply n-fold cyclical rotation
-                d2fold = ndimage.rotate(newrho,180,axes=axes2,reshape=False)
-                newrhosym = np.copy(newrho) + d2fold
-                newrhosym /= 2.0
-                newrho_total = np.copy(newrhosym)
-            else:
-                newrhosym = np.copy(newrho)
-            for nrot in range(1,ncs):
-                sym = ndimage.rotate(newrhosym,degrees*nrot,axes=axes,reshape=False)
-                newrho_total += np.copy(sym)
-            newrho = newrho_total / ncs
-
-            #run shrinkwrap after ncs averaging to get new support
-            if shrinkwrap_old_method:
-                #run the old method
-                absv = True
-                newrho, support = shrinkwrap_by_density_value(newrho,absv=absv,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode)
+        #(this also makes any Fs that are exactly zero slightly non-zero,
+        #which otherwise breaks the scaling when refining a starting map)
+        profiler.start('binmean')
+        Imeans_active = ws.shell_intensities(F, qbin_labels, xcount)
+        for i, k in enumerate(active):
+            Imean = Imeans_active[i]
+            Imeans[k] = Imean
+
+            #scale Fs to match data
+            factors[i] = mysqrt(Idata/Imean, DENSS_GPU=DENSS_GPU)
+            #do not scale bins outside of desired range
+            #so set those factors to 1.0
+            factors[i][~qba] = 1.0
+
+            chis[k][j] = mysum(((Imean[qba]-Idata_qba)/sigqdata_qba)**2, DENSS_GPU=DENSS_GPU)/Idata_qba.size
+            if monitors[k].adaptive:
+                fit_chis[k] = fitted_chi2(Imean[qba], Idata_qba, sigqdata_qba)
+        profiler.stop('binmean')
+        profiler.start('scale')
+        ws.scale_amplitudes(F, factors, qbin_labels)
+        profiler.stop('scale')
+
+        profiler.start('ifft')
+        rhoprimes = ws.irfftn(F).real
+        profiler.stop('ifft')
+
+        #APPLY REAL SPACE RESTRAINTS TO EACH MAP
+        finished = []
+        for i, k in enumerate(active):
+            rhoprime = rhoprimes[i]
+            support = supports[k]
+            sigma = sigmas[k]
+            swV = swVs[k]
+            threshold = thresholds[k]
+            first_time_swdensity = first_time_swdensities[k]
+            chi = chis[k]
+            rg = rgs[k]
+            supportV = supportVs[k]
+            fprefix = fprefixes[k]
+            my_logger = my_loggers[k]
+
+            # use Guinier's law to approximate quickly
+            rg[j] = calc_rg_by_guinier_first_2_points(qbinsc, Imeans[k], DENSS_GPU=DENSS_GPU)
+
+            #rho has already been transformed, so its buffer is reused for newrho
+            profiler.start('support_projection')
+            newrho = ws.rho_slots[i]
+            if projector == "er" or j >= projector_er_step:
+                #Error Reduction, with positivity
+                project_support(rhoprime, support, positivity=positivity, out=newrho)
             else:
-                swN = int(swV/dV)
-                #end this stage of shrinkwrap when the volume is less than a sphere of radius D/2
-                if swbyvol and swV > swVend:
-                    newrho, support, threshold = shrinkwrap_by_volume(newrho,absv=True,sigma=sigma,N=swN,recenter=recenter,recenter_mode=recenter_mode)
-                    swV *= swV_decay
+                #feedback from the previous density outside of the support
+                #(positivity is part of the projection here)
+                project_real_space(newrho, rhoprime, support, projector=projector,
+                    beta=projector_beta_schedule(j, projector_beta, projector_beta_start, projector_beta_steps),
+                    positivity=positivity, out=newrho)
+            profiler.stop('support_projection')
+
+            if not DENSS_GPU and j%write_freq == 0:
+                profiler.start('write_maps')
+                if write_xplor_format:
+                    map_writer.write_xplor(rhoprime/dV, side, fprefix+"_current.xplor", coalesce=True, copy=False)
+                map_writer.write_mrc(rhoprime/dV, side, fprefix+"_current.mrc", coalesce=True, copy=False)
+                profiler.stop('write_maps')
+
+            #apply non-crystallographic symmetry averaging
+            if ncs != 0 and j in ncs_steps:
+                profiler.start('ncs')
+                if DENSS_GPU:
+                    newrho = cp.asnumpy(newrho)
+                newrho = align2xyz(newrho)
+                if DENSS_GPU:
+                    newrho = cp.array(newrho)
+                profiler.stop('ncs')
+
+            if ncs != 0 and j in [stepi+1 for stepi in ncs_steps]:
+                profiler.start('ncs')
+                if DENSS_GPU:
+                    newrho = cp.asnumpy(newrho)
+                newrho = get_ncs_operator(newrho.shape, ncs, ncs_type=ncs_type, ncs_axis=ncs_axis)(newrho)
+
+                #run shrinkwrap after ncs averaging to get new support
+                if shrinkwrap_old_method:
+                    #run the old method
+                    absv = True
+                    newrho, support = shrinkwrap_by_density_value(newrho,absv=absv,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur)
                 else:
-                    threshold = shrinkwrap_threshold_fraction
-                    if first_time_swdensity:
-                        if not quiet:
-                            if gui:
-                                my_logger.info("switched to shrinkwrap by density threshold = %.4f" %threshold)
-                            else:
-                                print("\nswitched to shrinkwrap by density threshold = %.4f" %threshold)
-                        first_time_swdensity = False
-                    newrho, support = shrinkwrap_by_density_value(newrho,absv=True,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode)
-
-
-            if DENSS_GPU:
-                newrho = cp.array(newrho)
-
-        if recenter and j in recenter_steps:
-            if DENSS_GPU:
-                newrho = cp.asnumpy(newrho)
-                support = cp.asnumpy(support)
-
-            #cannot run center_rho_roll() function since we want to also recenter the support
-            #perhaps we should fix this in the future to clean it up
-            if recenter_mode == "max":
-                rhocom = np.unravel_index(newrho.argmax(), newrho.shape)
-            else:
-                rhocom = np.array(ndimage.measurements.center_of_mass(np.abs(newrho)))
-            gridcenter = (np.array(newrho.shape)-1.)/2.
-            shift = gridcenter-rhocom
-            shift = np.rint(shift).astype(int)
-            newrho = np.roll(np.roll(np.roll(newrho, shift[0], axis=0), shift[1], axis=1), shift[2], axis=2)
-            support = np.roll(np.roll(np.roll(support, shift[0], axis=0), shift[1], axis=1), shift[2], axis=2)
-
-            if DENSS_GPU:
-                newrho = cp.array(newrho)
-                support = cp.array(support)
-
-        #update support using shrinkwrap method
-        if shrinkwrap and j >= shrinkwrap_minstep and j%shrinkwrap_iter==1:
-            if DENSS_GPU:
-                newrho = cp.asnumpy(newrho)
-                support = cp.asnumpy(support)
-
-            if shrinkwrap_old_method:
-                absv = True
-                newrho, support = shrinkwrap_by_density_value(newrho,absv=absv,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode)
-            else:
-                swN = int(swV/dV)
-                #end this stage of shrinkwrap when the volume is less than a sphere of radius D/2
-                if swbyvol and swV > swVend:
-                    newrho, support, threshold = shrinkwrap_by_volume(newrho,absv=True,sigma=sigma,N=swN,recenter=recenter,recenter_mode=recenter_mode)
-                    swV *= swV_decay
+                    swN = int(swV/dV)
+                    #end this stage of shrinkwrap when the volume is less than a sphere of radius D/2
+                    if swbyvol and swV > swVend:
+                        newrho, support, threshold = shrinkwrap_by_volume(newrho,absv=True,sigma=sigma,N=swN,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur,threshold_guess=threshold)
+                        swV *= swV_decay
+                    else:
+                        threshold = shrinkwrap_threshold_fraction
+                        if first_time_swdensity:
+                            if not quiet:
+                                if gui:
+                                    my_logger.info("switched to shrinkwrap by density threshold = %.4f" %threshold)
+                                else:
+                                    print("\nswitched to shrinkwrap by density threshold = %.4f" %threshold)
+                            first_time_swdensity = False
+                        newrho, support = shrinkwrap_by_density_value(newrho,absv=True,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur)
+
+
+                if DENSS_GPU:
+                    newrho = cp.array(newrho)
+                profiler.stop('ncs')
+
+            if recenter and j in recenter_steps:
+                profiler.start('recenter')
+                if DENSS_GPU:
+                    newrho = cp.asnumpy(newrho)
+                    support = cp.asnumpy(support)
+
+                #cannot run center_rho_roll() function since we want to also recenter the support
+                #perhaps we should fix this in the future to clean it up
+                if recenter_mode == "max":
+                    rhocom = np.unravel_index(newrho.argmax(), newrho.shape)
                 else:
-                    threshold = shrinkwrap_threshold_fraction
-                    if first_time_swdensity:
-                        if not quiet:
-                            if gui:
-                                my_logger.info("switched to shrinkwrap by density threshold = %.4f" %threshold)
-                            else:
-                                print("\nswitched to shrinkwrap by density threshold = %.4f" %threshold)
-                        first_time_swdensity = False
-                    newrho, support = shrinkwrap_by_density_value(newrho,absv=True,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode)
-
-            if sigma > shrinkwrap_sigma_end:
-                sigma = shrinkwrap_sigma_decay*sigma
-
-            if DENSS_GPU:
-                newrho = cp.array(newrho)
-                support = cp.array(support)
-
-        #run erode when shrinkwrap is run
-        if erode and shrinkwrap and j > shrinkwrap_minstep and j%shrinkwrap_iter==1:
-            if DENSS_GPU:
-                newrho = cp.asnumpy(newrho)
-                support = cp.asnumpy(support)
-
-            #eroded is the region of the support _not_ including the boundary pixels
-            #so it is the entire interior. erode_region is _just_ the boundary pixels
-            eroded = ndimage.binary_erosion(support,np.ones((erosion_width,erosion_width,erosion_width)))
-            #get just boundary voxels, i.e. where support=True and eroded=False
-            erode_region = np.logical_and(support,~eroded)
-            #set all negative density in boundary pixels to zero.
-            newrho[(newrho<0)&(erode_region)] = 0
-
-            if DENSS_GPU:
-                newrho = cp.array(newrho)
-                support = cp.array(support)
-
-        if enforce_connectivity and j in enforce_connectivity_steps:
-            if DENSS_GPU:
-                newrho = cp.asnumpy(newrho)
-
-            #first run shrinkwrap to define the features
-            if shrinkwrap_old_method:
-                #run the old method
-                absv = True
-                newrho, support = shrinkwrap_by_density_value(newrho,absv=absv,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode)
-            else:
-                #end this stage of shrinkwrap when the volume is less than a sphere of radius D/2
-                swN = int(swV/dV)
-                if swbyvol and swV>swVend:
-                    newrho, support, threshold = shrinkwrap_by_volume(newrho,absv=True,sigma=sigma,N=swN,recenter=recenter,recenter_mode=recenter_mode)
+                    rhocom = center_of_mass(newrho)
+                gridcenter = (np.array(newrho.shape)-1.)/2.
+                shift = gridcenter-rhocom
+                shift = np.rint(shift).astype(int)
+                newrho = roll_rho(newrho, shift)
+                support = roll_rho(support, shift)
+
+                if DENSS_GPU:
+                    newrho = cp.array(newrho)
+                    support = cp.array(support)
+                profiler.stop('recenter')
+
+            #update support using shrinkwrap method
+            if shrinkwrap and j >= shrinkwrap_minstep and j%shrinkwrap_iter==1:
+                profiler.start('shrinkwrap')
+                if DENSS_GPU:
+                    newrho = cp.asnumpy(newrho)
+                    support = cp.asnumpy(support)
+
+                if shrinkwrap_old_method:
+                    absv = True
+                    newrho, support = shrinkwrap_by_density_value(newrho,absv=absv,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur)
                 else:
-                    newrho, support = shrinkwrap_by_density_value(newrho,absv=True,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode)
-
-            #label the support into separate segments based on a 3x3x3 grid
-            struct = ndimage.generate_binary_structure(3, 3)
-            labeled_support, num_features = ndimage.label(support, structure=struct)
-            sums = np.zeros((num_features))
-            num_features_to_keep = np.min([num_features,enforce_connectivity_max_features])
-            if not quiet:
-                if not gui:
-                    print("EC: %d -> %d " % (num_features,num_features_to_keep))
-
-            #find the feature with the greatest number of electrons
-            for feature in range(num_features+1):
-                sums[feature-1] = np.sum(newrho[labeled_support==feature])
-            big_feature = np.argmax(sums)+1
-            #order the indices of the features in descending order based on their sum/total density
-            sums_order = np.argsort(sums)[::-1]
-            sums_sorted = sums[sums_order]
-            #now grab the actual feature numbers (rather than the indices)
-            features_sorted = sums_order + 1
-
-            #remove features from the support that are not the primary feature
-            # support[labeled_support != big_feature] = False
-            #reset support to zeros everywhere
-            #then progressively add in regions of support up to num_features_to_keep
-            support *= False
-            for feature in range(num_features_to_keep):
-                support[labeled_support == features_sorted[feature]] = True
-
-            #clean up density based on new support
-            newrho[~support] = 0
-
-            if DENSS_GPU:
-                newrho = cp.array(newrho)
-                support = cp.array(support)
-
-        supportV[j] = mysum(support, DENSS_GPU=DENSS_GPU)*dV
-
-        if not quiet:
-            if gui:
-                my_logger.info("% 5i % 4.2e % 3.2f       % 5i          ", j, chi[j], rg[j], supportV[j])
-            else:
-                sys.stdout.write("\r% 5i % 4.2e % 3.2f       % 5i          " % (j, chi[j], rg[j], supportV[j]))
-                sys.stdout.flush()
-
-        #occasionally report progress in logger
-        if j%500==0 and not gui:
-            my_logger.info('Step % 5i: % 4.2e % 3.2f       % 5i          ', j, chi[j], rg[j], supportV[j])
-
-
-        if j > 101 + shrinkwrap_minstep:
-            if DENSS_GPU:
-                lesser = mystd(chi[j-100:j], DENSS_GPU=DENSS_GPU).get() < chi_end_fraction * mymean(chi[j-100:j], DENSS_GPU=DENSS_GPU).get()
+                    swN = int(swV/dV)
+                    #end this stage of shrinkwrap when the volume is less than a sphere of radius D/2
+                    if swbyvol and swV > swVend:
+                        newrho, support, threshold = shrinkwrap_by_volume(newrho,absv=True,sigma=sigma,N=swN,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur,threshold_guess=threshold)
+                        swV *= swV_decay
+                    else:
+                        threshold = shrinkwrap_threshold_fraction
+                        if first_time_swdensity:
+                            if not quiet:
+                                if gui:
+                                    my_logger.info("switched to shrinkwrap by density threshold = %.4f" %threshold)
+                                else:
+                                    print("\nswitched to shrinkwrap by density threshold = %.4f" %threshold)
+                            first_time_swdensity = False
+                        newrho, support = shrinkwrap_by_density_value(newrho,absv=True,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur)
+
+                if sigma > shrinkwrap_sigma_end:
+                    if (shrinkwrap_skip_decay and j > max(settle_step, first_step+window)
+                            and (shrinkwrap_old_method or not first_time_swdensity)
+                            and monitors[k].volume_stable(j-1)):
+                        my_logger.info('Step % 5i: support volume is stable, skipping to shrinkwrap sigma end', j)
+                        sigma = shrinkwrap_sigma_end
+                    else:
+                        sigma = shrinkwrap_sigma_decay*sigma
+
+                if DENSS_GPU:
+                    newrho = cp.array(newrho)
+                    support = cp.array(support)
+                profiler.stop('shrinkwrap')
+
+            #run erode when shrinkwrap is run, whatever the projector
+            if erode and shrinkwrap and j > shrinkwrap_minstep and j%shrinkwrap_iter==1:
+                profiler.start('erode')
+                #erode_region is just the boundary voxels of the support. it is
+                #only calculated again when shrinkwrap has changed the support
+                if erode_supports[k] is None or not ws.xp.array_equal(support, erode_supports[k]):
+                    if DENSS_GPU:
+                        erode_regions[k] = cp.array(support_boundary(cp.asnumpy(support), erosion_width))
+                    else:
+                        erode_regions[k] = support_boundary(support, erosion_width)
+                    erode_supports[k] = support.copy()
+                #set all negative density in boundary voxels to zero.
+                newrho[(newrho<0)&erode_regions[k]] = 0
+                profiler.stop('erode')
+
+            if enforce_connectivity and j in enforce_connectivity_steps:
+                profiler.start('enforce_connectivity')
+                if DENSS_GPU:
+                    newrho = cp.asnumpy(newrho)
+
+                #first run shrinkwrap to define the features
+                if shrinkwrap_old_method:
+                    #run the old method
+                    absv = True
+                    newrho, support = shrinkwrap_by_density_value(newrho,absv=absv,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur)
+                else:
+                    #end this stage of shrinkwrap when the volume is less than a sphere of radius D/2
+                    swN = int(swV/dV)
+                    if swbyvol and swV>swVend:
+                        newrho, support, threshold = shrinkwrap_by_volume(newrho,absv=True,sigma=sigma,N=swN,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur,threshold_guess=threshold)
+                    else:
+                        newrho, support = shrinkwrap_by_density_value(newrho,absv=True,sigma=sigma,threshold=threshold,recenter=recenter,recenter_mode=recenter_mode,fft_blur=shrinkwrap_fft_blur)
+
+                support, ec_stats = enforce_support_connectivity(newrho, support,
+                    max_features=enforce_connectivity_max_features)
+                num_features = ec_stats['labels'].size
+                num_features_to_keep = np.min([num_features,enforce_connectivity_max_features])
+                if not quiet:
+                    if not gui:
+                        print("EC: %d -> %d " % (num_features,num_features_to_keep))
+                my_logger.info('Step % 5i: EC kept %i of %i features', j, num_features_to_keep, num_features)
+                for feature in range(min(num_features, 5)):
+                    my_logger.info('  feature %i: electrons % .4e, volume % .4e, centroid (%.1f, %.1f, %.1f)',
+                        ec_stats['labels'][feature], ec_stats['sums'][feature], ec_stats['volumes'][feature]*dV,
+                        *ec_stats['centroids'][feature])
+
+                #clean up density based on new support
+                newrho[~support] = 0
+
+                if DENSS_GPU:
+                    newrho = cp.array(newrho)
+                    support = cp.array(support)
+                profiler.stop('enforce_connectivity')
+
+            profiler.start('statistics')
+            supportV[j] = mysum(support, DENSS_GPU=DENSS_GPU)*dV
+            monitors[k].update(j, chi[j], rg[j], supportV[j], fit_chis[k])
+            if progress_queue is not None and j % progress_freq == 0:
+                progress_queue.put((outputs[k], seeds[k], j, float(chi[j]), float(rg[j]), float(supportV[j])))
+
+            if not quiet and nseeds == 1:
+                if gui:
+                    my_logger.info("% 5i % 4.2e % 3.2f       % 5i          ", j, chi[j], rg[j], supportV[j])
+                else:
+                    sys.stdout.write("\r% 5i % 4.2e % 3.2f       % 5i          " % (j, chi[j], rg[j], supportV[j]))
+                    sys.stdout.flush()
+
+            #occasionally report progress in logger
+            if j%500==0 and not gui:
+                my_logger.info('Step % 5i: % 4.2e % 3.2f       % 5i          ', j, chi[j], rg[j], supportV[j])
+
+            profiler.stop('statistics')
+
+            #keep the state of this map for the next step
+            supports[k] = support
+            sigmas[k] = sigma
+            swVs[k] = swV
+            thresholds[k] = threshold
+            first_time_swdensities[k] = first_time_swdensity
+
+            profiler.start('convergence')
+            converged = False
+            #maps on a coarse grid keep running until they move to the finer grid,
+            #and maps are only judged on steps of error reduction
+            if stop_step is None and j > window + 1 + max(shrinkwrap_minstep, first_step, projector_er_step):
+                #recentering makes chi2 jump, so a plateau is not judged across it
+                plateau = (j > max(settle_step, first_step+window) and (not shrinkwrap or sigma <= shrinkwrap_sigma_end)
+                    and not (recenter and j in recenter_steps))
+                reason = monitors[k].check(j, plateau=plateau)
+                if reason is not None:
+                    my_logger.info('Step % 5i: converged, %s', j, reason)
+                    converged = True
+            if not converged and j == steps-1:
+                my_logger.info('Step % 5i: reached the maximum number of steps', j)
+
+            if converged or j == steps-1:
+                #this map is finished, so take it out of the workspace
+                #this is the density after the real space restraints of step j,
+                #which denss has always finished from, as the loop used to set
+                #rho = newrho so that both were the same array when it stopped.
+                #the final chi2, Rg and fit below are those of this density,
+                #before the last reciprocal space projection gives the map returned
+                final_steps[k] = j
+                final_rhos[k] = ws.xp.array(newrho, copy=True)
+                finished.append(k)
             else:
-                lesser = mystd(chi[j-100:j], DENSS_GPU=DENSS_GPU) < chi_end_fraction * mymean(chi[j-100:j], DENSS_GPU=DENSS_GPU)
-            if lesser:
-                break
-
-        rho = newrho
+                #some of the restraints above return new arrays rather than
+                #modifying newrho in place, so put it back into the workspace
+                ws.update_rho(newrho, i)
+            profiler.stop('convergence')
+
+        if finished:
+            #move the maps still running to the front of the workspace
+            still_active = [k for k in active if k not in finished]
+            for i, k in enumerate(still_active):
+                ws.move_rho(active.index(k), i)
+            active = still_active
+        if not active:
+            break
+        if checkpoint_freq and (j+1) % checkpoint_freq == 0:
+            profiler.start('checkpoint')
+            write_checkpoint(j+1)
+            profiler.stop('checkpoint')
+
+    if stop_step is not None:
+        #hand the maps on to the next grid, with the input data back to its original scale
+        state = get_state(stop_step)
+        if checkpoint_freq:
+            save_denss_checkpoint(checkpoint_file, **state)
+        I /= scale_factor
+        sigq /= scale_factor
+        map_writer.flush()
+        return state
+
+    if checkpoint_freq:
+        profiler.start('checkpoint')
+        write_checkpoint(steps)
+        profiler.stop('checkpoint')
+
+    profiler.start('finalize')
 
     #convert back to numpy outside of for loop
     if DENSS_GPU:
-        rho = cp.asnumpy(rho)
         qbin_labels = cp.asnumpy(qbin_labels)
         qbin_args = cp.asnumpy(qbin_args)
         sigqdata = cp.asnumpy(sigqdata)
-        Imean = cp.asnumpy(Imean)
-        chi = cp.asnumpy(chi)
         qbins = cp.asnumpy(qbins)
         qbinsc = cp.asnumpy(qbinsc)
         Idata = cp.asnumpy(Idata)
-        support = cp.asnumpy(support)
-        supportV = cp.asnumpy(supportV)
-        Idata = cp.asnumpy(Idata)
-        newrho = cp.asnumpy(newrho)
         qblravel = cp.asnumpy(qblravel)
         xcount = cp.asnumpy(xcount)
 
-    # F = myfftn(rho)
-    F = myrfftn(rho)
-    #calculate spherical average intensity from 3D Fs
-    I3D = abs2(F)
-    # I3D = myabs(F)**2
-    Imean = mybinmean(I3D.ravel(), qblravel, xcount=xcount)
-
-    #scale Fs to match data
-    factors = np.sqrt(Idata/Imean)
-    factors[~qba] = 1.0
-    F *= factors[qbin_labels]
-    # rho = myifftn(F)
-    rho = myirfftn(F)
-    rho = rho.real
-
-    #negative images yield the same scattering, so flip the image
-    #to have more positive than negative values if necessary
-    #to make sure averaging is done properly
-    #whether theres actually more positive than negative values
-    #is ambiguous, but this ensures all maps are at least likely
-    #the same designation when averaging
-    if np.sum(np.abs(rho[rho<0])) > np.sum(rho[rho>0]):
-        rho *= -1
-
-    #scale total number of electrons
-    if ne is not None:
-        rho *= ne / np.sum(rho)
-
-    rg[j+1] = calc_rg_by_guinier_first_2_points(qbinsc, Imean)
-    supportV[j+1] = supportV[j]
+    results = []
+    for k in range(nseeds):
+        rho = final_rhos[k]
+        support = supports[k]
+        j = final_steps[k]
+        chi = chis[k]
+        rg = rgs[k]
+        supportV = supportVs[k]
+        Imean = Imeans[k]
+        fprefix = fprefixes[k]
+        my_logger = my_loggers[k]
+
+        #convert back to numpy outside of for loop
+        if DENSS_GPU:
+            rho = cp.asnumpy(rho)
+            Imean = cp.asnumpy(Imean)
+            chi = cp.asnumpy(chi)
+            support = cp.asnumpy(support)
+            supportV = cp.asnumpy(supportV)
+
+        # F = myfftn(rho)
+        F = myrfftn(rho)
+        #calculate spherical average intensity from 3D Fs
+        I3D = abs2(F)
+        # I3D = myabs(F)**2
+        Imean = mybinmean(I3D.ravel(), qblravel, xcount=xcount)
 
-    #change rho to be the electron density in e-/angstroms^3, rather than number of electrons,
-    #which is what the FFT assumes
-    rho /= dV
-    my_logger.info('FINISHED DENSITY REFINEMENT')
-
-
-    if cutout:
-        #here were going to cut rho out of the large real space box
-        #to the voxels that contain the particle
-        #use D to estimate particle size
-        #assume the particle is in the center of the box
-        #calculate how many voxels needed to contain particle of size D
-        #use bigger than D to make sure we don't crop actual particle in case its larger than expected
-        #lets clip it to a maximum of 2*D to be safe
-        nD = int(2*D/dx)+1
-        #make sure final box will still have even samples
-        if nD%2==1:
-            nD += 1
-
-        nmin = nbox//2 - nD//2
-        nmax = nbox//2 + nD//2 + 2
-        #create new rho array containing only the particle
-        newrho = rho[nmin:nmax,nmin:nmax,nmin:nmax]
-        rho = newrho
-        #do the same for the support
-        newsupport = support[nmin:nmax,nmin:nmax,nmin:nmax]
-        support = newsupport
-        #update side to new size of box
-        side = dx * (nmax-nmin)
-
-    if write_xplor_format:
-        write_xplor(rho,side,fprefix+".xplor")
-        write_xplor(np.ones_like(rho)*support, side, fprefix+"_support.xplor")
-
-    write_mrc(rho,side,fprefix+".mrc")
-    write_mrc(np.ones_like(rho)*support,side, fprefix+"_support.mrc")
-
-    #return original unscaled values of Idata (and therefore Imean) for comparison with real data
+        #scale Fs to match data
+        factors = np.sqrt(Idata/Imean)
+        factors[~qba] = 1.0
+        F *= factors[qbin_labels]
+        # rho = myifftn(F)
+        rho = myirfftn(F)
+        rho = rho.real
+
+        #negative images yield the same scattering, so flip the image
+        #to have more positive than negative values if necessary
+        #to make sure averaging is done properly
+        #whether theres actually more positive than negative values
+        #is ambiguous, but this ensures all maps are at least likely
+        #the same designation when averaging
+        if np.sum(np.abs(rho[rho<0])) > np.sum(rho[rho>0]):
+            rho *= -1
+
+        #scale total number of electrons
+        if ne is not None:
+            rho *= ne / np.sum(rho, dtype=np.float64)
+
+        rg[j+1] = calc_rg_by_guinier_first_2_points(qbinsc, Imean)
+        supportV[j+1] = supportV[j]
+
+        #change rho to be the electron density in e-/angstroms^3, rather than number of electrons,
+        #which is what the FFT assumes
+        rho /= dV
+        my_logger.info('FINISHED DENSITY REFINEMENT')
+
+        side_k = side
+        if cutout:
+            #here were going to cut rho out of the large real space box
+            #to the voxels that contain the particle
+            #use D to estimate particle size
+            #assume the particle is in the center of the box
+            #calculate how many voxels needed to contain particle of size D
+            #use bigger than D to make sure we don't crop actual particle in case its larger than expected
+            #lets clip it to a maximum of 2*D to be safe
+            nD = int(2*D/dx)+1
+            #make sure final box will still have even samples
+            if nD%2==1:
+                nD += 1
+
+            nmin = nbox//2 - nD//2
+            nmax = nbox//2 + nD//2 + 2
+            #create new rho array containing only the particle
+            newrho = rho[nmin:nmax,nmin:nmax,nmin:nmax]
+            rho = newrho
+            #do the same for the support
+            newsupport = support[nmin:nmax,nmin:nmax,nmin:nmax]
+            support = newsupport
+            #update side to new size of box
+            side_k = dx * (nmax-nmin)
+
+        if write_xplor_format:
+            map_writer.write_xplor(rho,side_k,fprefix+".xplor")
+            map_writer.write_xplor(np.ones_like(rho)*support, side_k, fprefix+"_support.xplor", copy=False)
+
+        map_writer.write_mrc(rho,side_k,fprefix+".mrc")
+        map_writer.write_mrc(np.ones_like(rho)*support,side_k, fprefix+"_support.mrc", copy=False)
+
+        #return original unscaled values of Imean for comparison with real data
+        #(Idata and the input data are returned to their original scale below)
+        Imean /= scale_factor
+        I_k = I / scale_factor
+        sigq_k = sigq / scale_factor
+
+        #Write some more output files
+        qraw_k, Iraw_k, sigqraw_k = qraw, Iraw, sigqraw
+        if qraw_k is None:
+            qraw_k = q
+        if Iraw_k is None:
+            Iraw_k = I_k
+        if sigqraw_k is None:
+            sigqraw_k = sigq_k
+        Iq_exp = np.vstack((qraw_k,Iraw_k,sigqraw_k)).T
+        Iq_calc = np.vstack((qbinsc, Imean, Imean*0.01)).T
+        idx = np.where(Iraw_k>0)
+        Iq_exp = Iq_exp[idx]
+        qmax = np.min([Iq_exp[:,0].max(),Iq_calc[:,0].max()])
+        Iq_exp = Iq_exp[Iq_exp[:,0]<=qmax]
+        Iq_calc = Iq_calc[Iq_calc[:,0]<=qmax]
+        final_chi2, exp_scale_factor, offset, fit = calc_chi2(Iq_exp, Iq_calc, scale=True, offset=False, interpolation=True,return_sf=True,return_fit=True)
+
+        np.savetxt(fprefix+'_map.fit', fit, delimiter=' ', fmt='%.5e'.encode('ascii'),
+            header='q(data),I(data),error(data),I(density); chi2=%.3f'%final_chi2)
+        np.savetxt(fprefix+'_stats_by_step.dat',np.vstack((chi, rg, supportV)).T,
+            delimiter=" ", fmt="%.5e".encode('ascii'), header='Chi2 Rg SupportVolume')
+
+        chi[j+1] = final_chi2
+
+        my_logger.info('Number of steps: %i', j)
+        my_logger.info('Final Chi2: %.3e', chi[j+1])
+        my_logger.info('Final Rg: %3.3f', rg[j+1])
+        my_logger.info('Final Support Volume: %3.3f', supportV[j+1])
+        my_logger.info('Mean Density (all voxels): %3.5f', np.mean(rho))
+        my_logger.info('Std. Dev. of Density (all voxels): %3.5f', np.std(rho))
+        my_logger.info('RMSD of Density (all voxels): %3.5f', np.sqrt(np.mean(np.square(rho))))
+
+        results.append((qdata, Idata, sigqdata, qbinsc, Imean, chi, rg, supportV, rho, side_k, fit, final_chi2))
+
+    #return original unscaled values of Idata for comparison with real data,
+    #and the input data to its original scale as it was scaled in place
     Idata /= scale_factor
     sigqdata /= scale_factor
-    Imean /= scale_factor
     I /= scale_factor
     sigq /= scale_factor
 
-    #Write some more output files
-    if qraw is None:
-        qraw = q
-    if Iraw is None:
-        Iraw = I
-    if sigqraw is None:
-        sigqraw = sigq
-    Iq_exp = np.vstack((qraw,Iraw,sigqraw)).T
-    Iq_calc = np.vstack((qbinsc, Imean, Imean*0.01)).T
-    idx = np.where(Iraw>0)
-    Iq_exp = Iq_exp[idx]
-    qmax = np.min([Iq_exp[:,0].max(),Iq_calc[:,0].max()])
-    Iq_exp = Iq_exp[Iq_exp[:,0]<=qmax]
-    Iq_calc = Iq_calc[Iq_calc[:,0]<=qmax]
-    final_chi2, exp_scale_factor, offset, fit = calc_chi2(Iq_exp, Iq_calc, scale=True, offset=False, interpolation=True,return_sf=True,return_fit=True)
-
-    np.savetxt(fprefix+'_map.fit', fit, delimiter=' ', fmt='%.5e'.encode('ascii'),
-        header='q(data),I(data),error(data),I(density); chi2=%.3f'%final_chi2)
-    np.savetxt(fprefix+'_stats_by_step.dat',np.vstack((chi, rg, supportV)).T,
-        delimiter=" ", fmt="%.5e".encode('ascii'), header='Chi2 Rg SupportVolume')
-
-    chi[j+1] = final_chi2
-
-    my_logger.info('Number of steps: %i', j)
-    my_logger.info('Final Chi2: %.3e', chi[j+1])
-    my_logger.info('Final Rg: %3.3f', rg[j+1])
-    my_logger.info('Final Support Volume: %3.3f', supportV[j+1])
-    my_logger.info('Mean Density (all voxels): %3.5f', np.mean(rho))
-    my_logger.info('Std. Dev. of Density (all voxels): %3.5f', np.std(rho))
-    my_logger.info('RMSD of Density (all voxels): %3.5f', np.sqrt(np.mean(np.square(rho))))
-
-    return qdata, Idata, sigqdata, qbinsc, Imean, chi, rg, supportV, rho, side, fit, final_chi2
-
-def shrinkwrap_by_density_value(rho,absv=True,sigma=3.0,threshold=0.2,recenter=True,recenter_mode="com"):
+    map_writer.flush()
+    profiler.stop('finalize')
+
+    if profiler.enabled:
+        for my_logger in set(my_loggers):
+            profiler.log(my_logger)
+        profiler.save(fprefixes[0]+'_profile.json', outputs=outputs, nmaps=nseeds, n=n,
+            steps=steps, precision=precision, fft_backend="cupy" if DENSS_GPU else FFT_BACKEND)
+
+    return results
+
+def save_denss_checkpoint(filename, **arrays):
+    """Save the state of a denss run to a compressed .npz file.
+        The file is replaced atomically, so an interrupted save leaves the previous checkpoint."""
+    tmpname = "%s.%i.tmp.npz" % (filename, os.getpid())
+    np.savez_compressed(tmpname, **arrays)
+    os.replace(tmpname, filename)
+
+def load_denss_checkpoint(filename):
+    """Load the state of a denss run saved with save_denss_checkpoint."""
+    with np.load(filename, allow_pickle=False) as f:
+        return dict((key, f[key]) for key in f.files)
+
+def shrinkwrap_schedule_steps(shrinkwrap_iter=20, shrinkwrap_sigma_start=3, shrinkwrap_sigma_end=1.5,
+    shrinkwrap_sigma_decay=0.99, enforce_connectivity_steps=[500], shrinkwrap_minstep=100):
+    """Number of steps until the shrinkwrap sigma and connectivity schedule of a denss run is finished."""
+    stepsarr = np.concatenate((enforce_connectivity_steps,[shrinkwrap_minstep]))
+    maxec = np.max(stepsarr)
+    return int(shrinkwrap_iter * (np.log(shrinkwrap_sigma_end/shrinkwrap_sigma_start)/np.log(shrinkwrap_sigma_decay)) + maxec)
+
+def denss_steps(steps=None, shrinkwrap_iter=20, shrinkwrap_sigma_start=3, shrinkwrap_sigma_end=1.5,
+    shrinkwrap_sigma_decay=0.99, enforce_connectivity_steps=[500], shrinkwrap_minstep=100):
+    """Maximum number of steps of a denss run, given steps, or from the shrinkwrap schedule if steps is None."""
+    if steps == 'None' or steps is None or np.int(steps) < 1:
+        steps = shrinkwrap_schedule_steps(shrinkwrap_iter=shrinkwrap_iter,
+            shrinkwrap_sigma_start=shrinkwrap_sigma_start, shrinkwrap_sigma_end=shrinkwrap_sigma_end,
+            shrinkwrap_sigma_decay=shrinkwrap_sigma_decay,
+            enforce_connectivity_steps=enforce_connectivity_steps, shrinkwrap_minstep=shrinkwrap_minstep)
+        #add enough steps for convergence after shrinkwrap is finished
+        #something like 7000 seems reasonable, likely will finish before that on its own
+        #then just make a round number when using defaults
+        steps += 7621
+    else:
+        steps = np.int(steps)
+    return steps
+
+def multires_grid_sizes(n, nlevels):
+    """Number of samples of the grids of a multiresolution run, coarsest first, ending with n.
+
+    Each grid has half as many samples along each side as the next one, rounded down to be even.
+    """
+    ns = [n]
+    for level in range(nlevels-1):
+        nc = ns[0]//2
+        nc -= nc%2
+        ns.insert(0, max(nc, 2))
+    return ns
+
+def resample_denss_state(state, n):
+    """Move the state of a denss run (as saved in a checkpoint) to an n x n x n grid.
+
+    The densities are resampled by Fourier padding, so the number of electrons
+    is unchanged, and the supports are resampled the same way and kept where
+    they are at least half filled. Shrinkwrap sigmas, which are in voxels, are
+    scaled to the new voxel size. The new grid takes over at the next step.
+    """
+    state = dict(state)
+    n0 = int(state['n'])
+    rhos = state['rhos']
+    state['rhos'] = np.array([fourier_resample(rho, n) for rho in rhos], dtype=rhos.dtype)
+    state['supports'] = np.array([fourier_resample(support.astype(np.float64), n) > 0.5*n0**3/n**3
+        for support in state['supports']], dtype=bool)
+    state['sigmas'] = state['sigmas'] * float(n)/n0
+    state['n'] = n
+    state['first_step'] = int(state['next_step'])
+    return state
+
+def denss_batch_multires(multires_steps, start_state=None, stop_step=None, **kwargs):
+    """Run denss_batch() on successively finer grids.
+
+    The side of the box is the same for each grid, only the voxels change. The
+    first steps, which only find the rough envelope of the particle, run on a
+    grid with 2**len(multires_steps) times fewer samples along each side than the
+    final grid. At each of multires_steps the densities and supports move to a
+    grid with twice as many samples (see resample_denss_state), until the
+    requested voxel size is reached. Each grid only uses the data within its own
+    q range. Shrinkwrap sigmas are given in voxels of the final grid, and are
+    scaled to the voxels of each grid so that they are the same in angstroms.
+
+    multires_steps - steps at which to move to the next finer grid
+    kwargs - arguments of denss_batch()
+
+    Returns the results of the final grid, as returned by denss_batch().
+    """
+    multires_steps = sorted(int(step) for step in multires_steps)
+    side = kwargs['oversampling']*kwargs['dmax']
+    n = int(side/kwargs['voxel'])
+    if n%2==1:
+        n += 1
+    ns = multires_grid_sizes(n, len(multires_steps)+1)
+    steps = denss_steps(kwargs['steps'], shrinkwrap_iter=kwargs['shrinkwrap_iter'],
+        shrinkwrap_sigma_start=kwargs['shrinkwrap_sigma_start'],
+        shrinkwrap_sigma_end=kwargs['shrinkwrap_sigma_end'],
+        shrinkwrap_sigma_decay=kwargs['shrinkwrap_sigma_decay'],
+        enforce_connectivity_steps=kwargs['enforce_connectivity_steps'],
+        shrinkwrap_minstep=kwargs['shrinkwrap_minstep'])
+    if kwargs['projector'].lower() != "er" and kwargs['projector_er_step'] is None:
+        #from the schedule of the final grid, rather than the rescaled sigmas of each grid
+        kwargs['projector_er_step'] = shrinkwrap_schedule_steps(shrinkwrap_iter=kwargs['shrinkwrap_iter'],
+            shrinkwrap_sigma_start=kwargs['shrinkwrap_sigma_start'],
+            shrinkwrap_sigma_end=kwargs['shrinkwrap_sigma_end'],
+            shrinkwrap_sigma_decay=kwargs['shrinkwrap_sigma_decay'],
+            enforce_connectivity_steps=kwargs['enforce_connectivity_steps'],
+            shrinkwrap_minstep=kwargs['shrinkwrap_minstep'])
+    my_loggers = kwargs['my_logger']
+    if not isinstance(my_loggers, (list, tuple)):
+        my_loggers = [my_loggers]
+
+    #continue an interrupted run on the grid it was interrupted on
+    first_level = 0
+    if kwargs['resume']:
+        if isinstance(kwargs['output'], (list, tuple)):
+            output = kwargs['output'][0]
+        else:
+            output = kwargs['output']+'_0'
+        checkpoint_file = os.path.join(kwargs['path'], output)+"_checkpoint.npz"
+        if os.path.exists(checkpoint_file):
+            ckpt_n = int(load_denss_checkpoint(checkpoint_file)['n'])
+            if ckpt_n in ns:
+                first_level = ns.index(ckpt_n)
+
+    state = None
+    for level in range(first_level, len(ns)):
+        nl = ns[level]
+        kw = dict(kwargs)
+        kw['steps'] = steps
+        kw['resume'] = kwargs['resume'] and level == first_level
+        if level < len(ns)-1:
+            #voxel size that gives exactly nl samples
+            voxel = side/nl
+            while int(side/voxel) < nl:
+                voxel = np.nextafter(voxel, 0)
+            kw['voxel'] = voxel
+            kw['stop_step'] = multires_steps[level]
+            #the data are scaled in place during a run, so give each coarse grid
+            #its own copy to leave the final grid the data exactly as given
+            kw['I'] = np.copy(kwargs['I'])
+            kw['sigq'] = np.copy(kwargs['sigq'])
+            kw['shrinkwrap_sigma_start'] = kwargs['shrinkwrap_sigma_start'] * float(nl)/n
+            kw['shrinkwrap_sigma_end'] = kwargs['shrinkwrap_sigma_end'] * float(nl)/n
+            if kwargs['rho_start'] is not None:
+                kw['rho_start'] = fourier_resample(kwargs['rho_start'], nl)
+            if kwargs['support_start'] is not None:
+                kw['support_start'] = fourier_resample(np.asarray(kwargs['support_start'], dtype=np.float64), nl) > 0.5*n**3/nl**3
+        if state is not None:
+            kw['start_state'] = state
+        for my_logger in set(my_loggers):
+            my_logger.info('Multiresolution grid %i of %i: %i x %i x %i voxels from step %i',
+                level+1, len(ns), nl, nl, nl, multires_steps[level-1] if level > 0 else 0)
+        result = denss_batch(**kw)
+        if not isinstance(result, dict):
+            #the final grid, or aborted
+            return result
+        state = resample_denss_state(result, ns[level+1])
+
+#Gaussian transfer functions used by gaussian_filter_fft, most recently used last
+GAUSSIAN_CACHE_SIZE = 4
+_gaussian_transfer_cache = OrderedDict()
+
+def gaussian_transfer_function(shape, sigma, truncate=4.0, dtype=np.float64):
+    """Fourier transform of the kernel used by ndimage.gaussian_filter with mode='wrap'.
+
+    The kernel is truncated at truncate*sigma and wrapped around the grid
+    exactly as ndimage does, so that multiplying an rfftn by this array is
+    the same as filtering in real space. The result is laid out like the
+    output of rfftn for an array of the given shape and is cached by shape,
+    sigma, truncate and dtype. Do not modify it.
+    """
+    sigmas = np.broadcast_to(np.asarray(sigma, dtype=np.float64), (len(shape),))
+    key = (tuple(shape), tuple(sigmas), truncate, np.dtype(dtype).str)
+    H = _gaussian_transfer_cache.pop(key, None)
+    if H is None:
+        H = np.ones([1]*len(shape), dtype=dtype)
+        for axis, (n, sig) in enumerate(zip(shape, sigmas)):
+            #same kernel as ndimage._gaussian_kernel1d
+            radius = int(truncate * sig + 0.5)
+            x = np.arange(-radius, radius+1)
+            phi_x = np.exp(-0.5 / sig**2 * x**2)
+            phi_x /= phi_x.sum()
+            #wrap the kernel around the grid
+            kernel = np.zeros(n)
+            np.add.at(kernel, x % n, phi_x)
+            #the kernel is symmetric, so its transform is real
+            if axis == len(shape)-1:
+                Hi = np.fft.rfft(kernel).real
+            else:
+                Hi = np.fft.fft(kernel).real
+            bshape = [1]*len(shape)
+            bshape[axis] = Hi.size
+            H = H * Hi.reshape(bshape).astype(dtype)
+    _gaussian_transfer_cache[key] = H
+    while len(_gaussian_transfer_cache) > GAUSSIAN_CACHE_SIZE:
+        _gaussian_transfer_cache.popitem(last=False)
+    return H
+
+def gaussian_filter_fft(x, sigma, truncate=4.0):
+    """Gaussian blur with periodic boundaries, calculated with FFTs.
+
+    Gives the same result as ndimage.gaussian_filter(x, sigma, mode='wrap',
+    truncate=truncate) (to floating point precision), but costs one forward
+    and one inverse FFT regardless of sigma.
+
+    x - real array, the last dimension must be even
+    sigma - standard deviation of the Gaussian, in voxels
+    truncate - truncate the kernel at this many standard deviations
+    """
+    x = np.asarray(x)
+    if x.shape[-1] % 2 == 1:
+        #irfftn cannot recover an odd length last axis without being told
+        return ndimage.filters.gaussian_filter(x,sigma=sigma,mode='wrap',truncate=truncate)
+    F = myrfftn(x)
+    F *= gaussian_transfer_function(x.shape, sigma, truncate, dtype=x.dtype)
+    return myirfftn(F).real.astype(x.dtype, copy=False)
+
+REAL_SPACE_PROJECTORS = ["er", "hio", "raar", "dm"]
+
+def project_real_space(rho, rhoprime, support, projector="er", beta=0.9, positivity=True, out=None):
+    """Apply the real space restraints of one iteration of a phase retrieval algorithm.
+
+    rhoprime is the density after the reciprocal space restraints. Where the
+    restraints are met (inside the support, and positive if positivity is set)
+    the new density is rhoprime. Elsewhere it is
+
+    er   - zero (error reduction)
+    hio  - rho - beta*rhoprime (hybrid input-output)
+    raar - beta*rho + (1-2*beta)*rhoprime (relaxed averaged alternating
+           reflections), with the restraints tested on 2*rhoprime - rho
+    dm   - rho - beta*rhoprime (difference map with gamma_S = -1 and
+           gamma_M = 1/beta), with the restraints tested on
+           rhoprime + (rhoprime-rho)/beta
+
+    rho - density before the reciprocal space restraints (previous iterate)
+    rhoprime - density after the reciprocal space restraints
+    support - boolean array
+    beta - feedback parameter
+    positivity - boolean, whether or not negative density breaks the restraints
+    out - optional array for the result, which may be rho
+
+    Returns the new density. Works with numpy or cupy arrays.
+    """
+    xp = cp if CUPY_LOADED and not isinstance(rhoprime, np.ndarray) else np
+    if projector == "raar":
+        test = 2*rhoprime - rho
+        outside = beta*rho + (1-2*beta)*rhoprime
+    elif projector == "dm":
+        test = rhoprime + (rhoprime-rho)/beta
+        outside = rho - beta*rhoprime
+    elif projector == "hio":
+        test = rhoprime
+        outside = rho - beta*rhoprime
+    elif projector == "er":
+        test = rhoprime
+        outside = xp.zeros_like(rhoprime)
+    else:
+        raise ValueError("projector must be one of %s, not %s" % (", ".join(REAL_SPACE_PROJECTORS), projector))
+    if positivity:
+        inside = support & (test > 0)
+    else:
+        inside = support
+    newrho = xp.where(inside, rhoprime, outside)
+    if out is None:
+        return newrho
+    out[...] = newrho
+    return out
+
+def project_support_numpy(rhoprime, support, positivity=True, clamp=None, out=None):
+    """Error reduction: keep rhoprime inside the support and zero it elsewhere.
+
+    rhoprime - density after the reciprocal space restraints
+    support - boolean array
+    positivity - also zero negative density
+    clamp - boolean array of voxels where negative density is zeroed,
+            e.g. the boundary of the support from support_boundary (optional)
+    out - optional array for the result, which may be rhoprime
+
+    Works with numpy or cupy arrays.
+    """
+    xp = cp if CUPY_LOADED and not isinstance(rhoprime, np.ndarray) else np
+    out = xp.multiply(rhoprime, support, out=out)
+    if positivity:
+        xp.maximum(out, 0.0, out=out)
+    if clamp is not None:
+        out[(out<0)&clamp] = 0
+    return out
+
+if numba:
+    @nb.njit(parallel=True,cache=True)
+    def _project_support_numba(rhoprime, support, positivity, clamp, use_clamp, out):
+        for i in nb.prange(rhoprime.shape[0]):
+            for j in range(rhoprime.shape[1]):
+                for k in range(rhoprime.shape[2]):
+                    v = rhoprime[i,j,k]
+                    if not support[i,j,k]:
+                        v = 0.0
+                    elif v < 0 and (positivity or (use_clamp and clamp[i,j,k])):
+                        v = 0.0
+                    out[i,j,k] = v
+        return out
+
+def project_support(rhoprime, support, positivity=True, clamp=None, out=None):
+    """Error reduction, as project_support_numpy but in a single pass over
+    the grid when NUMBA_KERNELS is set."""
+    if not (NUMBA_KERNELS and isinstance(rhoprime, np.ndarray)):
+        return project_support_numpy(rhoprime, support, positivity=positivity, clamp=clamp, out=out)
+    if out is None:
+        out = np.empty_like(rhoprime)
+    if clamp is None:
+        return _project_support_numba(rhoprime, support, positivity, support, False, out)
+    return _project_support_numba(rhoprime, support, positivity, clamp, True, out)
+
+def support_boundary(support, width):
+    """Voxels of the support within width voxels of its edge.
+
+    This is the support minus its binary erosion by a width^3 cube, with
+    the erosion done as a separable minimum filter.
+    """
+    eroded = ndimage.minimum_filter(support, size=width, mode='constant', cval=False)
+    return np.logical_and(support, ~eroded)
+
+def projector_beta_schedule(step, beta=0.9, beta_start=None, beta_steps=500):
+    """Feedback parameter of a real space projector at a given step.
+
+    Without beta_start, beta is constant. Otherwise it moves smoothly from
+    beta_start to beta as beta + (beta_start-beta)*exp(-(step/beta_steps)**3),
+    as suggested for RAAR by Luke (2005).
+    """
+    if beta_start is None:
+        return beta
+    return beta + (beta_start-beta)*np.exp(-(float(step)/beta_steps)**3)
+
+def shrinkwrap_by_density_value(rho,absv=True,sigma=3.0,threshold=0.2,recenter=True,recenter_mode="com",fft_blur=False):
     """Create support using shrinkwrap method based on threshold as fraction of maximum density
 
     rho - electron density; numpy array
@@ -1740,6 +3393,7 @@ def shrinkwrap_by_density_value(rho,absv=True,sigma=3.0,threshold=0.2,recenter=T
     threshold - fraction of maximum gaussian filtered density (0 to 1)
     recenter - boolean, whether or not to recenter the density prior to calculating support
     recenter_mode - either com (center of mass) or max (maximum density value)
+    fft_blur - boolean, blur with FFTs (gaussian_filter_fft) rather than in real space
     """
     if recenter:
         rho = center_rho_roll(rho, recenter_mode)
@@ -1748,14 +3402,17 @@ def shrinkwrap_by_density_value(rho,absv=True,sigma=3.0,threshold=0.2,recenter=T
         tmp = np.abs(rho)
     else:
         tmp = rho
-    rho_blurred = ndimage.filters.gaussian_filter(tmp,sigma=sigma,mode='wrap')
+    if fft_blur:
+        rho_blurred = gaussian_filter_fft(tmp,sigma=sigma)
+    else:
+        rho_blurred = ndimage.filters.gaussian_filter(tmp,sigma=sigma,mode='wrap')
 
     support = np.zeros(rho.shape,dtype=bool)
     support[rho_blurred >= threshold*rho_blurred.max()] = True
 
     return rho, support
 
-def shrinkwrap_by_volume(rho,N,absv=True,sigma=3.0,recenter=True,recenter_mode="com"):
+def shrinkwrap_by_volume(rho,N,absv=True,sigma=3.0,recenter=True,recenter_mode="com",fft_blur=False,threshold_guess=None):
     """Create support using shrinkwrap method based on threshold as fraction of maximum density
 
     rho - electron density; numpy array
@@ -1764,6 +3421,8 @@ def shrinkwrap_by_volume(rho,N,absv=True,sigma=3.0,recenter=True,recenter_mode="
     N - set the threshold such that N voxels are in the support (must precalculate this based on volume)
     recenter - boolean, whether or not to recenter the density prior to calculating support
     recenter_mode - either com (center of mass) or max (maximum density value)
+    fft_blur - boolean, blur with FFTs (gaussian_filter_fft) rather than in real space
+    threshold_guess - optional threshold from a previous call, used to bracket the search
     """
     if recenter:
         rho = center_rho_roll(rho, recenter_mode)
@@ -1772,17 +3431,66 @@ def shrinkwrap_by_volume(rho,N,absv=True,sigma=3.0,recenter=True,recenter_mode="
         tmp = np.abs(rho)
     else:
         tmp = rho
-    rho_blurred = ndimage.filters.gaussian_filter(tmp,sigma=sigma,mode='wrap')
-
-    #grab the N largest values of the array
-    idx = largest_indices(rho_blurred, N)
-    support = np.zeros(rho.shape,dtype=bool)
-    support[idx] = True
+    if fft_blur:
+        rho_blurred = gaussian_filter_fft(tmp,sigma=sigma)
+    else:
+        rho_blurred = ndimage.filters.gaussian_filter(tmp,sigma=sigma,mode='wrap')
+
+    #find the value of the N-th largest voxel, and keep everything at or above it
+    rho_max = rho_blurred.max()
+    if threshold_guess is not None:
+        threshold_guess = threshold_guess*rho_max
+    value = nth_largest(rho_blurred, N, guess=threshold_guess)
+    support = rho_blurred >= value
     #now, calculate the threshold that would correspond to the by_density_value method
-    threshold = np.min(rho_blurred[idx])/rho_blurred.max()
+    threshold = value/rho_max
 
     return rho, support, threshold
 
+def enforce_support_connectivity(rho, support, max_features=1, structure=None):
+    """Keep only the connected features of the support containing the most electrons
+
+    Feature statistics are accumulated for all labels at once with bincount
+    and the new support is rebuilt through a lookup table over the labels.
+
+    rho - electron density; numpy array
+    support - boolean support array
+    max_features - maximum number of features to keep
+    structure - connectivity structure for labeling (default 3x3x3)
+
+    returns the new support and a dictionary of per-feature statistics
+    (labels, sums, volumes in voxels, centroids in voxel coordinates),
+    sorted by descending number of electrons
+    """
+    if structure is None:
+        structure = ndimage.generate_binary_structure(3, 3)
+    labeled_support, num_features = ndimage.label(support, structure=structure)
+    labels = labeled_support.ravel()
+    nlabels = num_features + 1
+    sums = np.bincount(labels, weights=rho.ravel(), minlength=nlabels)[1:]
+    volumes = np.bincount(labels, minlength=nlabels)[1:]
+    centroids = np.zeros((num_features, rho.ndim))
+    for axis in range(rho.ndim):
+        shape = [1]*rho.ndim
+        shape[axis] = rho.shape[axis]
+        coords = np.broadcast_to(np.arange(rho.shape[axis]).reshape(shape), rho.shape).ravel()
+        centroids[:,axis] = np.bincount(labels, weights=coords, minlength=nlabels)[1:]
+    centroids /= np.maximum(volumes, 1)[:,None]
+
+    #order the features in descending order based on their sum/total density
+    order = np.argsort(sums)[::-1]
+    keep = np.zeros(nlabels, dtype=bool)
+    keep[order[:max_features]+1] = True
+    support = keep[labeled_support]
+
+    stats = {
+        'labels': order + 1,
+        'sums': sums[order],
+        'volumes': volumes[order],
+        'centroids': centroids[order],
+        }
+    return support, stats
+
 def ecdf(x):
     """convenience function for computing the empirical CDF"""
     n = x.size
@@ -1795,6 +3503,77 @@ def find_nearest_i(array,value):
     """Return the index of the array item nearest to specified value"""
     return (np.abs(array-value)).argmin()
 
+def center_of_mass(rho, absv=True):
+    """Center of mass of a map in voxel coordinates, calculated from its axis marginals.
+
+    The absolute value is taken one slab at a time, so no full size copy of
+    the map is made.
+
+    rho - electron density array
+    absv - boolean, whether or not to use the absolute value of the density
+    """
+    m0 = np.zeros(rho.shape[0])
+    proj = np.zeros(rho.shape[1:])
+    for i in range(rho.shape[0]):
+        if absv:
+            slab = np.abs(rho[i])
+        else:
+            slab = rho[i]
+        m0[i] = np.sum(slab, dtype=np.float64)
+        proj += slab
+    marginals = [m0]
+    for axis in range(proj.ndim):
+        others = tuple(ax for ax in range(proj.ndim) if ax != axis)
+        marginals.append(np.sum(proj, axis=others))
+    total = np.sum(m0)
+    return np.array([np.dot(m, np.arange(m.size))/total for m in marginals])
+
+def roll_rho(rho, shift):
+    """Cyclically shift an array by an integer number of voxels along every axis in one copy."""
+    shift = tuple(int(s) for s in shift)
+    return np.roll(rho, shift, axis=tuple(range(len(shift))))
+
+def fourier_shift(rho, shift):
+    """Shift a real array by a (sub-voxel) translation with periodic boundaries.
+
+    The translation is applied as a phase ramp on the rfftn of the array, so
+    unlike spline interpolation the map is not blurred.
+
+    rho - real array
+    shift - translation in voxels along each axis
+    """
+    F = fft.rfftn(rho)
+    for axis, (n, s) in enumerate(zip(rho.shape, shift)):
+        if axis == rho.ndim-1:
+            f = np.fft.rfftfreq(n)
+        else:
+            f = np.fft.fftfreq(n)
+        bshape = [1]*rho.ndim
+        bshape[axis] = f.size
+        F *= np.exp(-2j*np.pi*f*s).reshape(bshape)
+    return fft.irfftn(F, s=rho.shape).astype(rho.dtype, copy=False)
+
+def fourier_resample(rho, n):
+    """Resample a cubic grid to n x n x n samples by zero padding or truncating its Fourier transform.
+
+    The box stays the same size, only the voxels change, and the sum of the
+    grid (i.e. the number of electrons) is preserved. The centre of the grid,
+    at sample n//2, stays where it is.
+
+    rho - real n0 x n0 x n0 array
+    n - number of samples along each side of the new grid
+    """
+    rho = np.asarray(rho)
+    n0 = rho.shape[0]
+    F = np.fft.fftshift(fft.fftn(rho))
+    #keep the m lowest frequencies, which are centred after the shift
+    m = min(n, n0)
+    old = slice(n0//2 - m//2, n0//2 - m//2 + m)
+    new = slice(n//2 - m//2, n//2 - m//2 + m)
+    G = np.zeros((n,n,n), dtype=F.dtype)
+    G[new,new,new] = F[old,old,old]
+    return fft.ifftn(np.fft.ifftshift(G)).real
+
 def center_rho(rho, centering="com", return_shift=False, maxfirst=True, iterations=1):
     """Move electron density map so its center of mass aligns with the center of the grid
 
@@ -1816,9 +3595,9 @@ def center_rho(rho, centering="com", return_shift=False, maxfirst=True, iteratio
         if centering == "max":
             rhocom = np.unravel_index(rho.argmax(), rho.shape)
         else:
-            rhocom = np.array(ndimage.measurements.center_of_mass(np.abs(rho)))
+            rhocom = center_of_mass(rho)
         shift = gridcenter-rhocom
-        rho = ndimage.interpolation.shift(rho,shift,order=3,mode='wrap')
+        rho = fourier_shift(rho, shift)
         rho = rho*ne_rho/np.sum(rho)
         total_shift += shift
     if return_shift:
@@ -1843,15 +3622,15 @@ def center_rho_roll(rho, recenter_mode="com", maxfirst=True, return_shift=False)
         rhoargmax = np.unravel_index(np.abs(rho).argmax(), rho.shape)
         shift = gridcenter - rhoargmax
         shift = np.rint(shift).astype(int)
-        rho = np.roll(np.roll(np.roll(rho, shift[0], axis=0), shift[1], axis=1), shift[2], axis=2)
+        rho = roll_rho(rho, shift)
         total_shift += shift
     if recenter_mode == "max":
         rhocom = np.unravel_index(np.abs(rho).argmax(), rho.shape)
     else:
-        rhocom = np.array(ndimage.measurements.center_of_mass(np.abs(rho)))
+        rhocom = center_of_mass(rho)
     shift = gridcenter-rhocom
     shift = np.rint(shift).astype(int)
-    rho = np.roll(np.roll(np.roll(rho, shift[0], axis=0), shift[1], axis=1), shift[2], axis=2)
+    rho = roll_rho(rho, shift)
     total_shift += shift
     if return_shift:
         return rho, total_shift
@@ -1868,8 +3647,8 @@ def euler_grid_search(refrho, movrho, topn=1, abort_event=None):
     #first translate both refrho and movrho to center of grid, then
     #calculate optimal coarse rotations, the translate back
     gridcenter = (np.array(refrho.shape)-1.)/2.
-    refrhocom = np.array(ndimage.measurements.center_of_mass(np.abs(refrho)))
-    movrhocom = np.array(ndimage.measurements.center_of_mass(np.abs(movrho)))
+    refrhocom = center_of_mass(refrho)
+    movrhocom = center_of_mass(movrho)
     refshift = gridcenter-refrhocom
     movshift = gridcenter-movrhocom
     refrhocen = ndimage.interpolation.shift(refrho,refshift,order=3,mode='wrap')
@@ -1919,6 +3698,47 @@ def largest_indices(a, n):
     indices = indices[np.argsort(-flat[indices])]
     return np.unravel_index(indices, a.shape)
 
+def nth_largest(a, n, guess=None, nbins=4096):
+    """Returns the value of the n-th largest element of a numpy array.
+
+    Rather than sorting, the values are histogrammed and only the bin
+    containing the n-th largest value is partitioned.
+
+    a - numpy array
+    n - rank of the value to return (1 returns the maximum)
+    guess - optional lower bracket for the value, e.g. from a previous call
+    nbins - number of histogram bins
+    """
+    flat = np.ravel(a)
+    n = int(min(max(n, 1), flat.size))
+    hi = flat.max()
+    if guess is not None and guess < hi:
+        value = _nth_largest_in_range(flat, n, guess, hi, nbins)
+        if value is not None:
+            return value
+    return _nth_largest_in_range(flat, n, flat.min(), hi, nbins)
+
+def _nth_largest_in_range(flat, n, lo, hi, nbins):
+    """Select the n-th largest value of flat, assuming it lies in [lo, hi].
+        Returns None if fewer than n values lie in that range."""
+    if lo >= hi:
+        if np.count_nonzero(flat >= hi) >= n:
+            return hi
+        return None
+    counts, edges = np.histogram(flat, bins=nbins, range=(lo, hi))
+    #number of values in each bin or any bin above it
+    above = np.cumsum(counts[::-1])[::-1]
+    if above[0] < n:
+        return None
+    i = np.nonzero(above >= n)[0][-1]
+    if i == nbins-1:
+        inbin = flat[flat >= edges[i]]
+        k = n
+    else:
+        inbin = flat[(flat >= edges[i]) & (flat < edges[i+1])]
+        k = n - above[i+1]
+    return np.partition(inbin, inbin.size-k)[inbin.size-k]
+
 def coarse_then_fine_alignment(refrho, movrho, coarse=True, topn=1,
     abort_event=None):
     """Course alignment followed by fine alignment.
@@ -1960,8 +3780,8 @@ def minimize_rho(refrho, movrho, T = np.zeros(6)):
     #first translate both to center
     #then afterwards translate back by -refshift
     gridcenter = (np.array(refrho.shape)-1.)/2.
-    refrhocom = np.array(ndimage.measurements.center_of_mass(np.abs(refrho)))
-    movrhocom = np.array(ndimage.measurements.center_of_mass(np.abs(movrho)))
+    refrhocom = center_of_mass(refrho)
+    movrhocom = center_of_mass(movrho)
     refshift = gridcenter-refrhocom
     movshift = gridcenter-movrhocom
     refrho = ndimage.interpolation.shift(refrho,refshift,order=3,mode='wrap')
@@ -2020,7 +3840,7 @@ def transform_rho(rho, T, order=1):
     """
     ne_rho= np.sum((rho))
     R = euler2matrix(T[0],T[1],T[2])
-    c_in = np.array(ndimage.measurements.center_of_mass(np.abs(rho)))
+    c_in = center_of_mass(rho)
     c_out = (np.array(rho.shape)-1.)/2.
     offset = c_in-c_out.dot(R)
     offset += T[3:]
@@ -2064,13 +3884,23 @@ def inertia_tensor(rho,side):
     halfside = side/2.
     n = rho.shape[0]
     x_ = np.linspace(-halfside,halfside,n)
-    x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-    Ixx = np.sum((y**2 + z**2)*rho)
-    Iyy = np.sum((x**2 + z**2)*rho)
-    Izz = np.sum((x**2 + y**2)*rho)
-    Ixy = -np.sum(x*y*rho)
-    Iyz = -np.sum(y*z*rho)
-    Ixz = -np.sum(x*z*rho)
+    #each moment only needs a 2D projection of rho, so
+    #the 3D coordinate meshgrids are never needed
+    rhoxy = rho.sum(axis=2)
+    rhoxz = rho.sum(axis=1)
+    rhoyz = rho.sum(axis=0)
+    rhox = rhoxy.sum(axis=1)
+    rhoy = rhoxy.sum(axis=0)
+    rhoz = rhoxz.sum(axis=0)
+    x2 = np.sum(x_**2*rhox)
+    y2 = np.sum(x_**2*rhoy)
+    z2 = np.sum(x_**2*rhoz)
+    Ixx = y2 + z2
+    Iyy = x2 + z2
+    Izz = x2 + y2
+    Ixy = -np.sum(x_[:,None]*x_[None,:]*rhoxy)
+    Iyz = -np.sum(x_[:,None]*x_[None,:]*rhoyz)
+    Ixz = -np.sum(x_[:,None]*x_[None,:]*rhoxz)
     I = np.array([[Ixx, Ixy, Ixz],
                   [Ixy, Iyy, Iyz],
                   [Ixz, Iyz, Izz]])
@@ -2086,7 +3916,7 @@ def principal_axis_alignment(refrho,movrho):
     side = 1.0
     ne_movrho = np.sum((movrho))
     #first center refrho and movrho, save refrho shift
-    rhocom = np.array(ndimage.measurements.center_of_mass(np.abs(refrho)))
+    rhocom = center_of_mass(refrho)
     gridcenter = (np.array(refrho.shape)-1.)/2.
     shift = gridcenter-rhocom
     refrho = ndimage.interpolation.shift(refrho,shift,order=3,mode='wrap')
@@ -2105,7 +3935,7 @@ def principal_axis_alignment(refrho,movrho):
     movrho = enans[np.argmax(scores)]
     #now rotate movrho by the inverse of the refrho rotation
     R = np.linalg.inv(refR)
-    c_in = np.array(ndimage.measurements.center_of_mass(np.abs(movrho)))
+    c_in = center_of_mass(movrho)
     c_out = (np.array(movrho.shape)-1.)/2.
     offset=c_in-c_out.dot(R)
     movrho = ndimage.interpolation.affine_transform(movrho,R.T,order=3,offset=offset,mode='wrap')
@@ -2114,12 +3944,130 @@ def principal_axis_alignment(refrho,movrho):
     movrho *= ne_movrho/np.sum(movrho)
     return movrho
 
+#NCS averaging operators, most recently used last
+NCS_CACHE_SIZE = 4
+_ncs_operators = OrderedDict()
+
+class NCSOperator(object):
+    """Non-crystallographic symmetry averaging of a density map.
+
+    Equivalent to averaging the map with copies rotated by ndimage.rotate
+    (order=3, reshape=False), but the cubic spline weights of every rotation
+    are calculated once and summed into a single sparse resampling matrix
+    acting on the planes perpendicular to the symmetry axis. Applying the
+    operator then takes one spline prefilter and one sparse product for all
+    rotations together, instead of a prefilter and interpolation per plane
+    and rotation.
+
+    shape - shape of the density map
+    ncs - rotational symmetry order
+    ncs_type - "cyclical" or "dihedral"
+    ncs_axis - symmetry axis, 1 (longest), 2 (middle) or 3 (shortest) principal axis
+    """
+    def __init__(self, shape, ncs, ncs_type="cyclical", ncs_axis=1):
+        if ncs_axis == 1:
+            axes = (1,2) #longest
+            axes2 = (0,1) #shortest
+        elif ncs_axis == 2:
+            axes = (0,2) #middle
+            axes2 = (0,1) #shortest
+        elif ncs_axis == 3:
+            axes = (0,1) #shortest
+            axes2 = (1,2) #longest
+        else:
+            raise ValueError("ncs_axis must be 1, 2 or 3")
+        self.shape = tuple(shape)
+        self.ncs = ncs
+        self.ncs_type = ncs_type
+        self.ncs_axis = ncs_axis
+        self.axes = axes
+        self.axes2 = axes2
+        degrees = 360./ncs
+        #all rotations other than the identity, which is applied exactly
+        self.rotations = sum([self.rotation_matrix(degrees*nrot, axes) for nrot in range(1,ncs)],
+            sparse.csr_matrix((self.plane_size(axes),)*2))
+        if ncs_type == "dihedral":
+            self.d2fold = self.rotation_matrix(180, axes2)
+        else:
+            self.d2fold = None
+
+    def plane_size(self, axes):
+        return self.shape[axes[0]]*self.shape[axes[1]]
+
+    def rotation_matrix(self, angle, axes):
+        """Sparse matrix taking cubic spline coefficients of a plane to the plane
+            rotated by angle (degrees), matching ndimage.rotate with mode='constant'."""
+        c, s = special.cosdg(angle), special.sindg(angle)
+        rot_matrix = np.array([[c, s],
+                               [-s, c]])
+        plane_shape = np.array(self.shape)[sorted(axes)]
+        center = (plane_shape - 1) / 2.
+        offset = center - rot_matrix.dot(center)
+        out = np.indices(plane_shape, dtype=np.float64).reshape(2,-1)
+        coords = rot_matrix.dot(out) + offset[:,None]
+        #points mapping from outside the input are zero
+        valid = np.all((coords >= 0) & (coords <= (plane_shape-1)[:,None]), axis=0)
+        rows = np.nonzero(valid)[0]
+        coords = coords[:,valid]
+        #cubic B-spline weights and mirrored tap indices along each axis
+        taps = []
+        for d in range(2):
+            start = np.floor(coords[d])
+            t = coords[d] - start
+            w = np.array([(1-t)**3, 4-6*t**2+3*t**3, 1+3*t+3*t**2-3*t**3, t**3]) / 6.
+            idx = start.astype(int)[None,:] + np.arange(-1,3)[:,None]
+            nd = plane_shape[d]
+            idx = np.abs(idx)
+            idx = np.where(idx > nd-1, 2*(nd-1)-idx, idx)
+            taps.append((w, idx))
+        (w0, i0), (w1, i1) = taps
+        weights = (w0[:,None,:]*w1[None,:,:]).ravel()
+        cols = (i0[:,None,:]*plane_shape[1] + i1[None,:,:]).ravel()
+        rows = np.broadcast_to(rows, (4,4,rows.size)).ravel()
+        n = plane_shape.prod()
+        return sparse.csr_matrix((weights, (rows, cols)), shape=(n,n))
+
+    def apply(self, rho, matrix, axes):
+        """Prefilter rho in the plane of axes and apply a resampling matrix to every plane."""
+        axes = sorted(axes)
+        coeffs = rho.astype(np.float64)
+        for axis in axes:
+            coeffs = ndimage.spline_filter1d(coeffs, order=3, axis=axis, mode='mirror')
+        coeffs = np.moveaxis(coeffs, axes, (0,1))
+        out = matrix.dot(coeffs.reshape(self.plane_size(axes), -1))
+        out = np.moveaxis(out.reshape(coeffs.shape), (0,1), axes)
+        return out.astype(rho.dtype, copy=False)
+
+    def __call__(self, rho):
+        """Return the symmetry averaged map."""
+        rho = np.asarray(rho)
+        if self.d2fold is not None:
+            #first, rotate original about perpendicular axis by 180
+            #then apply n-fold cyclical rotation
+            rhosym = rho + self.apply(rho, self.d2fold, self.axes2)
+            rhosym /= 2.0
+        else:
+            rhosym = rho
+        total = rhosym + self.apply(rhosym, self.rotations, self.axes)
+        return total / self.ncs
+
+def get_ncs_operator(shape, ncs, ncs_type="cyclical", ncs_axis=1):
+    """Return a (cached) NCSOperator for the given map shape and symmetry."""
+    key = (tuple(shape), ncs, ncs_type, ncs_axis)
+    op = _ncs_operators.pop(key, None)
+    if op is None:
+        op = NCSOperator(shape, ncs, ncs_type=ncs_type, ncs_axis=ncs_axis)
+    _ncs_operators[key] = op
+    while len(_ncs_operators) > NCS_CACHE_SIZE:
+        _ncs_operators.popitem(last=False)
+    return op
+
 def align2xyz(rho, return_transform=False):
     """ Align rho such that principal axes align with XYZ axes."""
     side = 1.0
-    ne_rho = np.sum(rho)
+    ne_rho = np.sum(rho, dtype=np.float64)
     #shift refrho to the center
-    rhocom = np.array(ndimage.measurements.center_of_mass(np.abs(rho)))
+    rhocom = center_of_mass(rho)
     gridcenter = (np.array(rho.shape)-1.)/2.
     shift = gridcenter-rhocom
     rho = ndimage.interpolation.shift(rho,shift,order=3,mode='wrap')
@@ -2135,17 +4083,17 @@ def align2xyz(rho, return_transform=False):
         I = inertia_tensor(rho, side)
         w,v = np.linalg.eigh(I) #principal axes
         R = v.T #rotation matrix
-        c_in = np.array(ndimage.measurements.center_of_mass(np.abs(rho)))
+        c_in = center_of_mass(rho)
         c_out = (np.array(rho.shape)-1.)/2.
         offset=c_in-c_out.dot(R)
         rho = ndimage.interpolation.affine_transform(rho, R.T, order=3,
             offset=offset, mode='wrap')
     #also need to run recentering a few times
     for i in range(3):
-        rhocom = np.array(ndimage.measurements.center_of_mass(np.abs(rho)))
+        rhocom = center_of_mass(rho)
         shift = gridcenter-rhocom
         rho = ndimage.interpolation.shift(rho,shift,order=3,mode='wrap')
-    rho *= ne_rho/np.sum(rho)
+    rho *= ne_rho/np.sum(rho, dtype=np.float64)
     if return_transform:
         return rho, refR, refshift
     else:
@@ -2166,7 +4114,6 @@ def align(refrho, movrho, coarse=True, abort_event=None):
             return None, None
 
     try:
-        sleep(1)
         ne_rho = np.sum((movrho))
         movrho, score = coarse_then_fine_alignment(refrho=refrho, movrho=movrho, coarse=coarse, topn=1,
             abort_event=abort_event)
@@ -2187,7 +4134,6 @@ def select_best_enantiomer(refrho, rho, abort_event=None):
     #fine adjustments and interpolation will happen during alignment step
 
     try:
-        sleep(1)
         c_refrho = center_rho_roll(refrho)
         #center rho in case it is not centered. use roll to get approximate location
         #and avoid interpolation
@@ -2249,20 +4195,24 @@ def select_best_enantiomers(rhos, refrho=None, cores=1, avg_queue=None,
 
     return best_enans, best_scores
 
+def shift_to_reference(refrho, rho):
+    """ Center rho, then shift it to where refrho is, by whole voxels to avoid interpolation."""
+    cen_refrho, refshift = center_rho_roll(refrho, return_shift=True)
+    rho = center_rho_roll(rho)
+    ne_rho = np.sum(rho)
+    #now shift rho back to where refrho was originally
+    #rho = ndimage.interpolation.shift(rho,-refshift,order=3,mode='wrap')
+    rho = roll_rho(rho, -refshift)
+    rho *= ne_rho/np.sum(rho)
+    return rho
+
 def align_multiple(refrho, rhos, cores=1, abort_event=None, single_proc=False):
     """ Align multiple (or a single) maps to the reference."""
     if rhos.ndim == 3:
         rhos = rhos[np.newaxis,...]
     #first, center all the rhos, then shift them to where refrho is
-    cen_refrho, refshift = center_rho_roll(refrho, return_shift=True)
-    shift = -refshift
     for i in range(rhos.shape[0]):
-        rhos[i] = center_rho_roll(rhos[i])
-        ne_rho = np.sum(rhos[i])
-        #now shift each rho back to where refrho was originally
-        #rhos[i] = ndimage.interpolation.shift(rhos[i],-refshift,order=3,mode='wrap')
-        rhos[i] = np.roll(np.roll(np.roll(rhos[i], shift[0], axis=0), shift[1], axis=1), shift[2], axis=2)
-        rhos[i] *= ne_rho/np.sum(rhos[i])
+        rhos[i] = shift_to_reference(refrho, rhos[i])
 
     if abort_event is not None:
         if abort_event.is_set():
@@ -2297,7 +4247,6 @@ def average_two(rho1, rho2, abort_event=None):
 def multi_average_two(niter, **kwargs):
     """ Wrapper script for averaging two maps for multiprocessing."""
     try:
-        sleep(1)
         return average_two(kwargs['rho1'][niter],kwargs['rho2'][niter],abort_event=kwargs['abort_event'])
     except KeyboardInterrupt:
         print("KeyboardInterrupt")
@@ -2342,27 +4291,17 @@ def binary_average(rhos, cores=1, abort_event=None, single_proc=False):
 
 def calc_fsc(rho1, rho2, side):
     """ Calculate the Fourier Shell Correlation between two electron density maps."""
-    df = 1.0/side
     n = rho1.shape[0]
-    qx_ = np.fft.fftfreq(n)*n*df
-    qx, qy, qz = np.meshgrid(qx_,qx_,qx_,indexing='ij')
-    qx_max = qx.max()
-    qr = np.sqrt(qx**2+qy**2+qz**2)
-    qmax = np.max(qr)
-    qstep = np.min(qr[qr>0])
-    nbins = int(qmax/qstep)
-    qbins = np.linspace(0,nbins*qstep,nbins+1)
-    #create an array labeling each voxel according to which qbin it belongs
-    qbin_labels = np.searchsorted(qbins, qr, "right")
-    qbin_labels -= 1
+    grid = get_grid(n, side, rfft=False)
+    #grid q values include the factor of 2pi, the FSC is given against 1/resolution
+    df = grid.df
+    qx_max = np.max(np.fft.fftfreq(n)*n*df)
+    qbins = np.linspace(0,grid.nbins*df,grid.nbins+1)
     F1 = np.fft.fftn(rho1)
     F2 = np.fft.fftn(rho2)
-    numerator = ndimage.sum(np.real(F1*np.conj(F2)), labels=qbin_labels,
-        index=np.arange(0,qbin_labels.max()+1))
-    term1 = ndimage.sum(np.abs(F1)**2, labels=qbin_labels,
-        index=np.arange(0,qbin_labels.max()+1))
-    term2 = ndimage.sum(np.abs(F2)**2, labels=qbin_labels,
-        index=np.arange(0,qbin_labels.max()+1))
+    numerator = grid.binsum(np.real(F1*np.conj(F2)))
+    term1 = grid.binsum(abs2(F1))
+    term2 = grid.binsum(abs2(F2))
     denominator = (term1*term2)**0.5
     FSC = numerator/denominator
     qidx = np.where(qbins<qx_max)
@@ -3690,31 +5629,29 @@ class PDB2MRC(object):
         #want n to be even for speed/memory optimization with the FFT, 
         #ideally a power of 2, but wont enforce that
         if n%2==1: n += 1
-        dx = side/n
-        dV = dx**3
-        x_ = np.linspace(-halfside,halfside,n)
-        x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-        xyz = np.column_stack((x.ravel(),y.ravel(),z.ravel()))
-
-        #make the reciprocal space grid
-        df = 1/side
-        qx_ = np.fft.fftfreq(x_.size)*n*df*2*np.pi
-        qx, qy, qz = np.meshgrid(qx_,qx_,qx_,indexing='ij')
-        qr = np.sqrt(qx**2+qy**2+qz**2)
-        qmax = np.max(qr)
-        qstep = np.min(qr[qr>0]) - 1e-8
-        nbins = int(qmax/qstep)
-        qbins = np.linspace(0,nbins*qstep,nbins+1)
-        #create an array labeling each voxel according to which qbin it belongs
-        qbin_labels = np.searchsorted(qbins,qr,"right")
-        qbin_labels -= 1
-        qblravel = qbin_labels.ravel()
-        xcount = np.bincount(qblravel)
-        #create modified qbins and put qbins in center of bin rather than at left edge of bin.
-        qbinsc = mybinmean(qr.ravel(), qblravel, xcount=xcount, DENSS_GPU=False)
+        #the real and reciprocal space grids are shared, read-only arrays
+        grid = get_grid(n, side, rfft=False)
+        dx = grid.dx
+        dV = grid.dV
+        x_ = grid.x_
+        #sparse grids, which broadcast to the full n x n x n box
+        x,y,z = grid.xyz_grids(sparse=True)
+
+        df = grid.df
+        qx_ = grid.qx_
+        qx, qy, qz = grid.qxyz_grids(sparse=True)
+        qr = grid.qr
+        qmax = grid.qmax
+        qstep = grid.qstep
+        nbins = grid.nbins
+        qbins = grid.qbins
+        qblravel = grid.qblravel
+        xcount = grid.xcount
+        qbinsc = grid.qbinsc
         q_calc = np.copy(qbinsc)
 
         #make attributes for all that
+        self.grid = grid
         self.halfside = halfside
         self.side = side
         self.n = n
@@ -3722,7 +5659,6 @@ class PDB2MRC(object):
         self.dV = dV
         self.x_ = x_
         self.x, self.y, self.z = x,y,z
-        self.xyz = xyz
         self.df = df
         self.qx_ = qx_
         self.qx, self.qy, self.qz = qx, qy, qz
@@ -3740,6 +5676,11 @@ class PDB2MRC(object):
         qmax4calc = self.qx_.max()*1.1
         self.qidx = np.where((self.qr<=qmax4calc))
 
+    @property
+    def xyz(self):
+        """Column stack of the coordinates of every voxel, made only when needed."""
+        return np.column_stack([a.ravel() for a in np.broadcast_arrays(self.x,self.y,self.z)])
+
     def calculate_global_B(self):
         if self.dx is None:
             #if make_grids has not been run yet, run it
@@ -3803,7 +5744,7 @@ class PDB2MRC(object):
             #allow user to provide mrc filename to read in a custom shell
             rho_shell, sidex = read_mrc(self.shell_mrcfile)
             rho_shell *= self.dV #assume mrc file is in units of density, convert to electron count
-            if not np.isclose(sidex,self.side,rtol=1e-3,atol=1e-3) or (rho_shell.shape[0] != self.x.shape[0]):
+            if not np.isclose(sidex,self.side,rtol=1e-3,atol=1e-3) or (rho_shell.shape[0] != self.n):
                 print("Error: shell_mrcfile does not match grid.")
                 print("Use denss.mrcops.py to resample onto the desired grid.")
                 exit()
@@ -3818,24 +5759,24 @@ class PDB2MRC(object):
             protein_rw_idx = pdb2support_fast(self.pdb,self.x,self.y,self.z,radius=self.pdb.vdW,probe=self.r_water-self.dx/2)
             print('Calculating dist transform...')
             #calculate the distance of each voxel outside the particle to the surface of the protein+water support
-            dist1 = np.zeros(self.x.shape)
+            dist1 = np.zeros(self.qr.shape)
             dist1 = ndimage.distance_transform_edt(protein_rw_idx)
             #now calculate the distance of each voxel inside the protein+water support by inverting it, but first add one voxel
             protein_rw_idx2 = ndimage.binary_dilation(protein_rw_idx)
-            dist2 = np.zeros(self.x.shape)
+            dist2 = np.zeros(self.qr.shape)
             dist2 = ndimage.distance_transform_edt(~protein_rw_idx2)
             #now merge the distances of the outer voxels and the inner voxels
             dist = dist1 + dist2
             #convert dist from pixels to angstroms
             dist *= self.dx
             #for form factor calculation, look at only the voxels near the shell for efficiency
-            rho_shell = np.zeros(self.x.shape)
+            rho_shell = np.zeros(self.qr.shape)
             print('Calculating shell values...')
             shell_idx = np.where(dist<2*r_water)
-            shell_idx_bool = np.zeros(self.x.shape, dtype=bool)
+            shell_idx_bool = np.zeros(self.qr.shape, dtype=bool)
             shell_idx_bool[shell_idx] = True
             if shell_idx_bool.sum() == 0:
-                shell_idx_bool = np.ones(self.x.shape, dtype=bool)
+                shell_idx_bool = np.ones(self.qr.shape, dtype=bool)
             rho_shell[shell_idx_bool] = realspace_formfactor(element='HOH',r=dist[shell_idx_bool],B=u2B(0.25)+self.global_B)
             #estimate initial shell scale based on contrast using mean density
             shell_mean_density = np.mean(rho_shell[water_shell_idx]) / self.dV
@@ -3847,7 +5788,7 @@ class PDB2MRC(object):
             rho_shell *= self.dV #convert to electron units
         else:
             print("Error: no valid shell_type given (water or uniform). Disabling hydration shell.")
-            rho_shell = self.x*0.0
+            rho_shell = np.zeros(self.qr.shape)
         self.rho_shell = rho_shell
         print('Finished hydration shell.')
 
@@ -4059,7 +6000,7 @@ class PDB2MRC(object):
             self.F_exvol = myfftn(self.rho_exvol)
         self.calc_F_with_modified_params(params)
         self.I3D = abs2(self.F)
-        self.I_calc = mybinmean(self.I3D.ravel(), self.qblravel, xcount=self.xcount)
+        self.I_calc = self.grid.binmean(self.I3D)
         self.Iq_calc = np.vstack((self.qbinsc, self.I_calc, self.I_calc*.01 + self.I_calc[0]*0.002)).T
 
     def calc_rho_with_modified_params(self,params):
@@ -4180,6 +6121,16 @@ if numba:
             I[qi]=acc
         return I
 
+def grid_block(x,y,z,slc):
+    """Return a column stack of the coordinates of the grid points in slc.
+
+    x,y,z - dense meshgrids or sparse (broadcastable) grids for x, y, and z
+    slc - tuple of three slices of the box
+    """
+    x_, y_, z_ = x[:,0,0], y[0,:,0], z[0,0,:]
+    xb, yb, zb = np.meshgrid(x_[slc[0]],y_[slc[1]],z_[slc[2]],indexing='ij')
+    return np.column_stack((xb.ravel(),yb.ravel(),zb.ravel()))
+
 def pdb2map_simple_gauss_by_radius(pdb,x,y,z,cutoff=3.0,global_B=None,rho0=0.334,ignore_waters=True):
     """Simple isotropic single gaussian sum at coordinate locations.
 
@@ -4187,7 +6138,7 @@ def pdb2map_simple_gauss_by_radius(pdb,x,y,z,cutoff=3.0,global_B=None,rho0=0.334
     grid points near the atom for speed.
 
     pdb - instance of PDB class (required, must have pdb.radius attribute)
-    x,y,z - meshgrids for x, y, and z (required)
+    x,y,z - meshgrids or sparse grids for x, y, and z (required)
     cutoff - maximum distance from atom to calculate density
     rho0 - average bulk solvent density used for excluded volume estimation (0.334 for water)
     """
@@ -4200,8 +6151,8 @@ def pdb2map_simple_gauss_by_radius(pdb,x,y,z,cutoff=3.0,global_B=None,rho0=0.334
     x_ = x[:,0,0]
     shift = np.ones(3)*dx/2.
     # print("\n Calculate density map from PDB... ")
-    values = np.zeros(x.shape)
-    support = np.zeros(x.shape,dtype=bool)
+    values = np.zeros(np.broadcast(x,y,z).shape)
+    support = np.zeros(values.shape,dtype=bool)
     if global_B is None:
         global_B = 0.0
     B = global_B * np.ones(pdb.natoms)
@@ -4255,7 +6206,7 @@ def pdb2map_simple_gauss_by_radius(pdb,x,y,z,cutoff=3.0,global_B=None,rho0=0.334
         ny = ymax-ymin
         nz = zmax-zmin
         #now lets create a column stack of coordinates for the cropped grid
-        xyz = np.column_stack((x[slc].ravel(),y[slc].ravel(),z[slc].ravel()))
+        xyz = grid_block(x,y,z,slc)
         dist = spatial.distance.cdist(pdb.coords[None,i]-shift, xyz)
 
         V = sphere_volume_from_radius(pdb.radius[i])
@@ -4281,7 +6232,7 @@ def pdb2map_multigauss(pdb,x,y,z,cutoff=3.0,global_B=None,use_b=False,ignore_wat
     grid points near the atom for speed.
 
     pdb - instance of PDB class (required)
-    x,y,z - meshgrids for x, y, and z (required)
+    x,y,z - meshgrids or sparse grids for x, y, and z (required)
     cutoff - maximum distance from atom to calculate density
     global_B - desired resolution of density map, calculated as a B-factor
     corresonding to atomic displacement equal to resolution. 
@@ -4295,8 +6246,8 @@ def pdb2map_multigauss(pdb,x,y,z,cutoff=3.0,global_B=None,use_b=False,ignore_wat
     x_ = x[:,0,0]
     shift = np.ones(3)*dx/2.
     # print("\n Calculate density map from PDB... ")
-    values = np.zeros(x.shape)
-    support = np.zeros(x.shape,dtype=bool)
+    values = np.zeros(np.broadcast(x,y,z).shape)
+    support = np.zeros(values.shape,dtype=bool)
     if global_B is None:
         global_B = 0.0
     cutoff = max(cutoff,2*B2u(global_B))
@@ -4350,7 +6301,7 @@ def pdb2map_multigauss(pdb,x,y,z,cutoff=3.0,global_B=None,use_b=False,ignore_wat
         ny = ymax-ymin
         nz = zmax-zmin
         #now lets create a column stack of coordinates for the cropped grid
-        xyz = np.column_stack((x[slc].ravel(),y[slc].ravel(),z[slc].ravel()))
+        xyz = grid_block(x,y,z,slc)
         dist = spatial.distance.cdist(pdb.coords[None,i]-shift, xyz)[0]
         try:
             element = pdb.atomtype[i]
@@ -4456,32 +6407,17 @@ def pdb2map_FFT(pdb,x,y,z,radii=None,restrict=True):
     """Calculate electron density from pdb coordinates by FFT of Fs.
 
     pdb - instance of PDB class (required)
-    x,y,z - meshgrids for x, y, and z (required)
+    x,y,z - meshgrids or sparse grids for x, y, and z (required)
     radii - float or list of radii of atoms in pdb (optional, uses spherical form factor rather than Kromer-Mann)
     """
     radii = np.atleast_1d(radii)
     side = x[-1,0,0] - x[0,0,0]
-    halfside = side/2
     n = x.shape[0]
-    dx = side/n
-    dV = dx**3
-    V = side**3
-    x_ = x[:,0,0]
-    df = 1/side
-    qx_ = np.fft.fftfreq(x_.size)*n*df*2*np.pi
-    qx, qy, qz = np.meshgrid(qx_,qx_,qx_,indexing='ij')
-    qr = np.sqrt(qx**2+qy**2+qz**2)
-    qmax = np.max(qr)
-    qstep = np.min(qr[qr>0])
-    nbins = int(qmax/qstep)
-    qbins = np.linspace(0,nbins*qstep,nbins+1)
-    #create an array labeling each voxel according to which qbin it belongs
-    qbin_labels = np.searchsorted(qbins,qr,"right")
-    qbin_labels -= 1
-    qblravel = qbin_labels.ravel()
-    xcount = np.bincount(qblravel)
-    #create modified qbins and put qbins in center of bin rather than at left edge of bin.
-    qbinsc = mybinmean(qr.ravel(), qblravel, xcount=xcount, DENSS_GPU=False)
+    grid = get_grid(n, side, rfft=False)
+    dx = grid.dx
+    qx, qy, qz = grid.qxyz_grids(sparse=True)
+    qr = grid.qr
+    qbinsc = grid.qbinsc
     F = np.zeros(qr.shape,dtype=complex)
     natoms = pdb.coords.shape[0]
     if radii[0] is None:
@@ -4497,14 +6433,14 @@ def pdb2map_FFT(pdb,x,y,z,radii=None,restrict=True):
         else:
             F += formfactor(element=pdb.atomtype[i],q=qr) * np.exp(-1j * (qx*pdb.coords[i,0] + qy*pdb.coords[i,1] + qz*pdb.coords[i,2]))
     I3D = abs2(F)
-    Imean = mybinmean(I3D.ravel(), qblravel, xcount=xcount, DENSS_GPU=False)
+    Imean = grid.binmean(I3D)
     rho = myifftn(F).real
     # rho[rho<0] = 0
     #need to shift rho to center of grid, since FFT is offset by half a grid length
     shift = [n//2-1,n//2-1,n//2-1]
-    rho = np.roll(np.roll(np.roll(rho, shift[0], axis=0), shift[1], axis=1), shift[2], axis=2)
+    rho = roll_rho(rho, shift)
     if restrict:
-        xyz = np.column_stack([x.flat,y.flat,z.flat])
+        xyz = np.column_stack([a.ravel() for a in np.broadcast_arrays(x,y,z)])
         pdb.coords -= np.ones(3)*dx/2.
         pdbidx = pdb2support(pdb, xyz=xyz,probe=0.0)
         rho[~pdbidx] = 0.0
@@ -4513,7 +6449,7 @@ def pdb2map_FFT(pdb,x,y,z,radii=None,restrict=True):
 def pdb2support_fast(pdb,x,y,z,radius=None,probe=0.0):
     """Return a boolean 3D density map with support from PDB coordinates"""
 
-    support = np.zeros(x.shape,dtype=np.bool_)
+    support = np.zeros(np.broadcast(x,y,z).shape,dtype=np.bool_)
     n = x.shape[0]
     side = x.max()-x.min()
     dx = side/n
@@ -4560,7 +6496,7 @@ def pdb2support_fast(pdb,x,y,z,radius=None,probe=0.0):
         ny = ymax-ymin
         nz = zmax-zmin
         #now lets create a column stack of coordinates for the cropped grid
-        xyz = np.column_stack((x[slc].ravel(),y[slc].ravel(),z[slc].ravel()))
+        xyz = grid_block(x,y,z,slc)
         #now calculate all distances from the atom to the minigrid points
         dist = spatial.distance.cdist(pdb.coords[None,i]-shift, xyz)
         #now, add any grid points within dr of atom to the env grid
@@ -4752,7 +6688,7 @@ def calc_uniform_shell(pdb,x,y,z,thickness=2.8,distance=1.4):
     """Create a uniform density hydration shell around the particle.
 
     pdb - instance of PDB class (required)
-    x,y,z - meshgrids for x, y, and z (required)
+    x,y,z - meshgrids or sparse grids for x, y, and z (required)
     thickness - thickness of the shell (e.g. water diameter)
     distance - distance from the protein surface defining the center of the shell (e.g., water radius)
     """
@@ -4767,114 +6703,118 @@ def denss_3DFs(rho_start, dmax, ne=None, voxel=5., oversampling=3., positivity=T
         output="map", steps=2001, seed=None, shrinkwrap=True, shrinkwrap_sigma_start=3,
         shrinkwrap_sigma_end=1.5, shrinkwrap_sigma_decay=0.99, shrinkwrap_threshold_fraction=0.2,
         shrinkwrap_iter=20, shrinkwrap_minstep=50, write_freq=100,support=None,
-        enforce_connectivity=True, enforce_connectivity_steps=[6000],quiet=False):
-    """Calculate electron density from starting map by refining phases only."""
+        enforce_connectivity=True, enforce_connectivity_steps=[6000],quiet=False,
+        chi_end_fraction=0.01, stats_freq=None, workspace=None):
+    """Calculate electron density from starting map by refining phases only.
+
+    The amplitudes of the Fourier transform of rho_start are kept and the
+    phases are refined by error reduction in real space. chi is the fraction
+    of the amplitudes not matched at each step, sum((|F|-|F0|)^2)/sum(|F0|^2),
+    and as in denss() the refinement stops once chi has settled.
+
+    rho_start - starting n x n x n map, with n set by dmax, voxel and oversampling
+    chi_end_fraction - stop when the standard deviation of chi over the last
+                       100 steps is less than this fraction of its mean
+    stats_freq - steps between calculations of Rg (default write_freq)
+    workspace - DenssWorkspace to reuse between calls (optional)
+    """
     D = dmax
     side = oversampling*D
-    halfside = side/2
     n = int(side/voxel)
     #want n to be even for speed/memory optimization with the FFT, ideally a power of 2, but wont enforce that
     if n%2==1: n += 1
-    #store n for later use if needed
-    nbox = n
-    dx = side/n
-    dV = dx**3
-    V = side**3
-    x_ = np.linspace(-halfside,halfside,n)
-    x,y,z = np.meshgrid(x_,x_,x_,indexing='ij')
-    r = np.sqrt(x**2 + y**2 + z**2)
-    df = 1/side
-    qx_ = np.fft.fftfreq(x_.size)*n*df*2*np.pi
-    qz_ = np.fft.rfftfreq(x_.size)*n*df*2*np.pi
-    qx, qy, qz = np.meshgrid(qx_,qx_,qx_,indexing='ij')
-    qr = np.sqrt(qx**2+qy**2+qz**2)
-    qmax = np.max(qr)
-    qstep = np.min(qr[qr>0])
-    nbins = int(qmax/qstep)
-    qbins = np.linspace(0,nbins*qstep,nbins+1)
-    #create modified qbins and put qbins in center of bin rather than at left edge of bin.
-    qbinsc = np.copy(qbins)
-    qbinsc[1:] += qstep/2.
-    #create an array labeling each voxel according to which qbin it belongs
-    qbin_labels = np.searchsorted(qbins,qr,"right")
-    qbin_labels -= 1
+    if rho_start.shape != (n,n,n):
+        raise ValueError("rho_start must be a %i x %i x %i map for this dmax, voxel and oversampling" % (n,n,n))
+    grid = get_grid(n, side, rfft=True)
+    dx = grid.dx
+    dV = grid.dV
     if steps == 'None' or steps is None or steps < 1:
         steps = int(shrinkwrap_iter * (np.log(shrinkwrap_sigma_end/shrinkwrap_sigma_start)/np.log(shrinkwrap_sigma_decay)) + shrinkwrap_minstep)
         steps += 3000
     else:
-        steps = np.int(steps)
-    Imean = np.zeros((steps+1,len(qbins)))
-    chi = np.zeros((steps+1))
-    rg = np.zeros((steps+1))
-    supportV = np.zeros((steps+1))
-    chibest = np.inf
-    usesupport = True
+        steps = int(steps)
+    if stats_freq is None:
+        stats_freq = write_freq
     if support is None:
-        support = np.ones(x.shape,dtype=bool)
+        support = np.ones((n,n,n),dtype=bool)
     else:
         support = support.astype(bool)
-    update_support = True
-    sigma = shrinkwrap_sigma_start
-
-    rho = rho_start
-    F = np.fft.fftn(rho)
-    Amp = np.abs(F)
+    supportV = np.sum(support)*dV
+
+    if workspace is None:
+        workspace = DenssWorkspace()
+    ws = workspace
+    ws.allocate(n)
+    rho = ws.update_rho(rho_start)
+    #the amplitudes to keep, on the half grid of the real valued FFT
+    Amp = np.abs(ws.rfftn(rho))
+    Amp2 = np.vdot(Amp, Amp)
+    absF = np.empty_like(Amp)
+    factor = np.empty_like(Amp)
+    #only the last 100 values of chi are needed to judge convergence
+    chis = []
+    rg = 0.0
+
+    def project_amplitudes(F):
+        """Give F the amplitudes Amp, keeping its phases, and return the amplitude error."""
+        np.abs(F, out=absF)
+        if not absF.all():
+            #Fs that are exactly zero have no phase, so give them one
+            zero = (absF == 0)
+            F[zero] = 1e-16
+            absF[zero] = 1e-16
+        np.subtract(absF, Amp, out=factor)
+        chi = np.vdot(factor, factor) / Amp2
+        np.divide(Amp, absF, out=factor)
+        F *= factor
+        return chi
 
     if not quiet:
         print("\n Step     Chi2     Rg    Support Volume")
         print(" ----- --------- ------- --------------")
 
     for j in range(steps):
-        F = np.fft.fftn(rho)
         #APPLY RECIPROCAL SPACE RESTRAINTS
-        #calculate spherical average of intensities from 3D Fs
-        I3D = np.abs(F)**2
-        Imean[j] = ndimage.mean(I3D, labels=qbin_labels, index=np.arange(0,qbin_labels.max()+1))
-        #scale Fs to match data
-        F *= Amp/np.abs(F)
-        chi[j] = 1.0
-        #APPLY REAL SPACE RESTRAINTS
-        rhoprime = np.fft.ifftn(F,rho.shape)
-        rhoprime = rhoprime.real
+        F = ws.rfftn(rho)
+        chi = project_amplitudes(F)
+        rhoprime = ws.irfftn(F).real
         if j%write_freq == 0:
             write_mrc(rhoprime/dV,side,output+"_current.mrc")
-        rg[j] = rho2rg(rhoprime,r=r,support=support,dx=dx)
-        newrho = np.zeros_like(rho)
+        if j%stats_freq == 0:
+            rg = rho2rg(rhoprime,side=side,support=support,dx=dx)
+        #APPLY REAL SPACE RESTRAINTS
         #Error Reduction
-        newrho[support] = rhoprime[support]
-        newrho[~support] = 0.0
+        np.multiply(rhoprime, support, out=rho)
         #enforce positivity by making all negative density points zero.
         if positivity:
-            netmp = np.sum(newrho)
-            newrho[newrho<0] = 0.0
-            if np.sum(newrho) != 0:
-                newrho *= netmp / np.sum(newrho)
-        supportV[j] = np.sum(support)*dV
+            netmp = np.sum(rho)
+            np.maximum(rho, 0.0, out=rho)
+            total = np.sum(rho)
+            if total != 0:
+                rho *= netmp / total
 
         if not quiet:
-            sys.stdout.write("\r% 5i % 4.2e % 3.2f       % 5i          " % (j, chi[j], rg[j], supportV[j]))
+            sys.stdout.write("\r% 5i % 4.2e % 3.2f       % 5i          " % (j, chi, rg, supportV))
             sys.stdout.flush()
 
-        rho = newrho
+        chis.append(chi)
+        if len(chis) > 100:
+            del chis[0]
+            if np.std(chis) < chi_end_fraction * np.mean(chis):
+                break
 
     if not quiet:
         print()
 
-    F = np.fft.fftn(rho)
-    #calculate spherical average intensity from 3D Fs
-    Imean[j+1] = ndimage.mean(np.abs(F)**2, labels=qbin_labels, index=np.arange(0,qbin_labels.max()+1))
-    #scale Fs to match data
-    F *= Amp/np.abs(F)
-    rho = np.fft.ifftn(F,rho.shape)
-    rho = rho.real
+    F = ws.rfftn(rho)
+    project_amplitudes(F)
+    #copy the map out of the workspace, which may be reused
+    rho = np.array(ws.irfftn(F).real)
 
     #scale total number of electrons
     if ne is not None:
         rho *= ne / np.sum(rho)
 
-    rg[j+1] = rho2rg(rho=rho,r=r,support=support,dx=dx)
-    supportV[j+1] = supportV[j]
-
     #change rho to be the electron density in e-/angstroms^3, rather than number of electrons,
     #which is what the FFT assumes
     rho /= dV